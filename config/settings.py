@@ -48,6 +48,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'leave_app.roles.RoleMiddleware',
+    'leave_app.middleware.UserSessionMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -92,6 +94,17 @@ DATABASES = {
     }
 }
 
+# cache ในเครื่อง ไม่ต้องมี Redis / memcached (ใช้กับ CEO dashboard ดู leave_app/caching.py)
+# ตั้ง CACHE_DIR เพื่อใช้ไฟล์ร่วมกันระหว่างหลาย worker process บนเครื่องเดียวกัน
+CACHE_DIR = env("CACHE_DIR", default="")
+CACHES = {
+    "default": (
+        {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": CACHE_DIR}
+        if CACHE_DIR
+        else {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "leave-system"}
+    )
+}
+
 # # ใช้ console backend (แนะนำสำหรับ dev)
 # EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
 
@@ -116,6 +129,9 @@ EMAIL_HOST_PASSWORD = env("EMAIL_HOST_PASSWORD")
 
 DEFAULT_FROM_EMAIL = f"LeaveSystem <{EMAIL_HOST_USER}>"
 
+# True = หัวหน้าได้รับอีเมลสรุป (send_manager_digests) แทนอีเมลทุกครั้งที่มีคนยื่นลา
+MANAGER_DIGEST_ENABLED = env.bool("MANAGER_DIGEST_ENABLED", default=False)
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -167,4 +183,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
 MEDIA_URL = "/media/"
-MEDIA_ROOT = BASE_DIR / "media"
\ No newline at end of file
+MEDIA_ROOT = BASE_DIR / "media"
+
+# ไฟล์ภายใน (ไฟล์นำเข้าพนักงาน / ไฟล์ export) อยู่นอก MEDIA_ROOT ไม่มี URL สาธารณะ ดู leave_app/storage.py
+PRIVATE_MEDIA_ROOT = env("PRIVATE_MEDIA_ROOT", default=str(BASE_DIR / "private_media"))
\ No newline at end of file
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Department, EmployeeProfile, LeaveType, LeaveBalance, Holiday, LeaveRequest
+from .models import Department, EmployeeProfile, LeaveType, LeaveBalance, Holiday, LeaveRequest, DataVersion, LeaveDayAllocation, EmailOutbox, EmployeeImportJob, UserSession, LeaveExportJob, LeaveStatsRollup, OrgClosure
 
 
 # Register your models here.
@@ -8,4 +8,12 @@ admin.site.register(EmployeeProfile)
 admin.site.register(LeaveType)
 admin.site.register(LeaveBalance)
 admin.site.register(Holiday)
+admin.site.register(DataVersion)
+admin.site.register(LeaveDayAllocation)
+admin.site.register(EmailOutbox)
+admin.site.register(EmployeeImportJob)
+admin.site.register(UserSession)
+admin.site.register(LeaveExportJob)
+admin.site.register(LeaveStatsRollup)
+admin.site.register(OrgClosure)
 admin.site.register(LeaveRequest)
\ No newline at end of file
@@ -0,0 +1,60 @@
+"""
+cache ผลลัพธ์ที่คำนวณหนักโดยผูก key กับ DataVersion
+
+- key มี version ของข้อมูลอยู่ด้วย เมื่อข้อมูลเปลี่ยน (bump_data_version) key ใหม่จะ miss แล้วคำนวณใหม่เอง
+  ไม่ต้องตามลบ cache ค่าเก่าหมดอายุไปตาม timeout
+- ระหว่างที่ request หนึ่งกำลังคำนวณ request อื่นที่ miss key เดียวกันจะรอผลแทนการคำนวณซ้ำ
+  (stampede lock ด้วย cache.add)
+- lock กว้างเท่าที่ cache ใช้ร่วมกัน: LocMem (ค่าเริ่มต้น) กันได้แค่ใน process เดียว
+  แต่ละ worker จึงคำนวณเองได้ครั้งละหนึ่งครั้งต่อ version, FileBasedCache (CACHE_DIR) ใช้ร่วมกันทั้งเครื่อง
+  แต่ add() ไม่ atomic อาจคำนวณซ้ำบ้าง, Redis / Memcached add() atomic กันได้ทุกเครื่อง
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .services import get_data_version
+
+VERSIONED_CACHE_TIMEOUT = getattr(settings, "VERSIONED_CACHE_TIMEOUT", 60 * 60)
+# lock ค้างได้นานสุดเท่านี้ (กัน process ที่ตายระหว่างคำนวณถือ lock ไว้ตลอด)
+VERSIONED_CACHE_LOCK_TIMEOUT = getattr(settings, "VERSIONED_CACHE_LOCK_TIMEOUT", 30)
+# request ที่ไม่ได้ lock รอผลได้นานสุดเท่านี้ แล้วคำนวณเอง
+VERSIONED_CACHE_WAIT_SECONDS = getattr(settings, "VERSIONED_CACHE_WAIT_SECONDS", 5)
+_POLL_INTERVAL = 0.05
+
+
+def versioned_cache_key(prefix: str, version_key: str, *parts) -> str:
+    """เช่น ceo_dashboard:2026:v42 (อ่าน version จาก DB หนึ่ง query)"""
+    version = get_data_version(version_key)
+    return ":".join([prefix, *map(str, parts), f"v{version}"])
+
+
+def get_or_compute(key: str, compute, timeout: int | None = None):
+    """คืนค่าจาก cache ถ้ามี ไม่มีก็ compute() แล้วเก็บ (compute ต้องไม่คืน None)"""
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f"{key}:lock"
+    if cache.add(lock_key, 1, VERSIONED_CACHE_LOCK_TIMEOUT):
+        try:
+            # อีก request อาจเพิ่งคำนวณเสร็จระหว่างที่เราเช็กครั้งแรก
+            value = cache.get(key)
+            if value is None:
+                value = compute()
+                cache.set(key, value, timeout or VERSIONED_CACHE_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    deadline = time.monotonic() + VERSIONED_CACHE_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        time.sleep(_POLL_INTERVAL)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if cache.get(lock_key) is None:
+            # คนที่ถือ lock คำนวณไม่สำเร็จ
+            break
+    return compute()
@@ -0,0 +1,405 @@
+"""
+นำเข้าพนักงานจากไฟล์ Excel แบบ streaming + bulk insert
+
+- อ่านไฟล์ด้วย openpyxl โหมด read-only ทีละแถว (ไม่โหลดทั้ง workbook เข้าหน่วยความจำ)
+- โหลด username / แผนก / โปรไฟล์ที่มีอยู่แล้วครั้งเดียวตอนเริ่ม แล้วเช็กในหน่วยความจำ
+- สร้าง User / EmployeeProfile ด้วย bulk_create ทีละ chunk และโควต้าวันลาด้วย provision_leave_balances
+- hash รหัสผ่านใน process pool (PBKDF2 กิน CPU เป็นหลัก) เปิด pool ครั้งเดียวต่อการนำเข้า
+- ตรวจทุกแถวก่อนสร้าง User แถวที่ถูกข้ามจึงไม่ทิ้ง User ค้างไว้
+- ต่อสายบังคับบัญชา (OrgClosure) ของโปรไฟล์ใหม่ทีละแถวใน transaction ของ chunk
+- ไฟล์มีคอลัมน์รหัสผ่าน: เก็บใน private storage ลบทันทีเมื่อ job เสร็จ ส่วน job ที่ล้มเหลว / ค้าง
+  ลบไฟล์เมื่อเกิน EMPLOYEE_IMPORT_RETENTION_DAYS (purge_import_jobs)
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from itertools import islice
+
+import openpyxl
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .hierarchy import ensure_org_nodes, set_manager
+from .models import Department, EmployeeImportJob, EmployeeProfile, LeaveType
+from .services import (
+    DASHBOARD_VERSION_KEY,
+    bump_data_version,
+    employee_search_text,
+    provision_leave_balances,
+)
+
+User = get_user_model()
+
+EMPLOYEE_IMPORT_CHUNK_SIZE = getattr(settings, "EMPLOYEE_IMPORT_CHUNK_SIZE", 500)
+# จำนวน process สำหรับ hash รหัสผ่าน (1 = hash ใน process เดียว)
+EMPLOYEE_IMPORT_HASH_WORKERS = getattr(
+    settings, "EMPLOYEE_IMPORT_HASH_WORKERS", os.cpu_count() or 1
+)
+# job ที่สถานะ RUNNING แต่ไม่มี heartbeat นานเกินนี้ ถือว่า worker ตาย ให้ worker อื่นรับไปทำต่อ
+EMPLOYEE_IMPORT_STALE_SECONDS = getattr(settings, "EMPLOYEE_IMPORT_STALE_SECONDS", 300)
+# ไฟล์ของ job ที่ล้มเหลว / ค้างเก็บไว้ให้ลองใหม่ได้นานเท่านี้ แล้วลบทิ้ง
+EMPLOYEE_IMPORT_RETENTION_DAYS = getattr(settings, "EMPLOYEE_IMPORT_RETENTION_DAYS", 7)
+# เก็บ error รายแถวใน job ไม่เกินจำนวนนี้
+EMPLOYEE_IMPORT_MAX_ERRORS = 500
+# ถ้ารหัสผ่านใน chunk น้อยกว่านี้ hash ตรง ๆ ไม่คุ้มที่จะเปิด process pool
+_MIN_PASSWORDS_FOR_POOL = 16
+
+
+def read_employee_rows(file, start_row: int = 2):
+    """
+    อ่านแถวจากไฟล์ .xlsx ทีละแถว คืน (เลขแถว, (username, password, employee_code, dept_code, manager_username))
+    ถ้าไฟล์ไม่ใช่ .xlsx จะ raise BadZipFile ตามเดิม
+    """
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        for row_no, row in enumerate(
+            ws.iter_rows(min_row=start_row, values_only=True), start=start_row
+        ):
+            row = tuple(row[:5]) + (None,) * (5 - len(row[:5]))
+            yield row_no, row
+    finally:
+        wb.close()
+
+
+def count_employee_rows(file) -> int:
+    """จำนวนแถวข้อมูล (ไม่รวมหัวตาราง) ใช้ขนาดจาก dimension ของ sheet ถ้ามี"""
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        max_row = ws.max_row
+        if max_row is None:
+            max_row = sum(1 for _ in ws.iter_rows(values_only=True))
+        return max(max_row - 1, 0)
+    finally:
+        wb.close()
+
+
+def chunked(iterable, size: int):
+    it = iter(iterable)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def _clean(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def hash_passwords(raw_passwords: list[str], pool: ProcessPoolExecutor | None = None) -> list[str]:
+    if pool is None or len(raw_passwords) < _MIN_PASSWORDS_FOR_POOL:
+        return [make_password(p) for p in raw_passwords]
+    return list(pool.map(make_password, raw_passwords, chunksize=8))
+
+
+class EmployeeImporter:
+    """
+    เก็บสถานะของการนำเข้าหนึ่งครั้ง (map ของข้อมูลที่มีอยู่ + ผลลัพธ์)
+    เรียก import_chunk() ซ้ำได้หลายครั้ง ข้อมูลที่สร้างใน chunk ก่อนหน้าจะถูกใช้ต่อ
+    ใช้ผ่าน `with` เพื่อให้ process pool สำหรับ hash รหัสผ่านเปิดครั้งเดียวต่อการนำเข้า
+    """
+
+    def __init__(self, year: int | None = None):
+        self.year = year or timezone.now().year
+        self.user_ids: dict[str, int] = dict(User.objects.values_list("username", "id"))
+        self.department_ids: dict[str, int] = dict(Department.objects.values_list("code", "id"))
+        self.profile_ids: dict[int, int] = dict(EmployeeProfile.objects.values_list("user_id", "id"))
+        self.employee_codes: set[str] = set(
+            EmployeeProfile.objects.values_list("employee_code", flat=True)
+        )
+        self.leave_types = list(LeaveType.objects.all())
+        self._pool: ProcessPoolExecutor | None = None
+
+        self.processed = 0
+        self.created = 0
+        self.errors: list[tuple[int, str]] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _hash_pool(self) -> ProcessPoolExecutor | None:
+        if self._pool is None and EMPLOYEE_IMPORT_HASH_WORKERS > 1:
+            self._pool = ProcessPoolExecutor(max_workers=EMPLOYEE_IMPORT_HASH_WORKERS)
+        return self._pool
+
+    def import_chunk(self, rows):
+        """rows: list ของ (เลขแถว, row) จาก read_employee_rows"""
+        touched_profile_ids = []
+        accepted = []
+        chunk_usernames: set[str] = set()
+        chunk_codes: set[str] = set()
+        # 1) ตรวจทุกแถวก่อน แล้วค่อยสร้าง User ให้เฉพาะแถวที่จะได้ EmployeeProfile จริง
+        for row_no, row in rows:
+            username, password, employee_code, dept_code, manager_username = map(_clean, row)
+            if not username:
+                continue
+
+            user_id = self.user_ids.get(username)
+            if user_id in self.profile_ids:
+                touched_profile_ids.append(self.profile_ids[user_id])
+                self.processed += 1
+                continue
+
+            if username in chunk_usernames:
+                self.errors.append((row_no, f"ชื่อผู้ใช้ {username} ซ้ำในไฟล์ ข้ามแถวนี้"))
+                continue
+
+            if employee_code and (employee_code in self.employee_codes or employee_code in chunk_codes):
+                self.errors.append((row_no, f"รหัสพนักงาน {employee_code} ซ้ำ ข้ามแถวนี้"))
+                continue
+
+            chunk_usernames.add(username)
+            if employee_code:
+                chunk_codes.add(employee_code)
+            accepted.append((row_no, username, password, employee_code, dept_code, manager_username))
+
+        self._create_departments({p[4] for p in accepted if p[4]})
+        new_user_ids = self._create_users(accepted)
+
+        # 2) รหัสเริ่มต้น EMP<user id> รู้ได้หลังสร้าง User ถ้าซ้ำให้ลบ User ของแถวนั้นทิ้งใน transaction เดียวกัน
+        rows_with_codes = []
+        rejected_user_ids = []
+        for row_no, username, _, employee_code, dept_code, manager_username in accepted:
+            user_id = self.user_ids[username]
+            if not employee_code:
+                employee_code = f"EMP{user_id:04d}"
+                if employee_code in self.employee_codes or employee_code in chunk_codes:
+                    self.errors.append((row_no, f"รหัสพนักงาน {employee_code} ซ้ำ ข้ามแถวนี้"))
+                    if user_id in new_user_ids:
+                        rejected_user_ids.append(user_id)
+                        del self.user_ids[username]
+                    continue
+                chunk_codes.add(employee_code)
+            rows_with_codes.append((row_no, username, user_id, employee_code, dept_code, manager_username))
+        if rejected_user_ids:
+            User.objects.filter(pk__in=rejected_user_ids).delete()
+
+        new_profiles = []
+        managed_rows = []
+        for row_no, username, user_id, employee_code, dept_code, manager_username in rows_with_codes:
+            manager_id = None
+            if manager_username:
+                manager_id = self.user_ids.get(manager_username)
+                if manager_id is None:
+                    self.errors.append(
+                        (row_no, f"ไม่พบหัวหน้า {manager_username} นำเข้าโดยไม่ระบุหัวหน้า")
+                    )
+                else:
+                    managed_rows.append((row_no, manager_username, len(new_profiles)))
+
+            self.processed += 1
+            new_profiles.append(
+                EmployeeProfile(
+                    user_id=user_id,
+                    employee_code=employee_code,
+                    department_id=self.department_ids.get(dept_code) if dept_code else None,
+                    manager_id=manager_id,
+                    # bulk_create ไม่ผ่าน signal จึงต้องเติม search_text เอง (ไฟล์นำเข้าไม่มีชื่อ-นามสกุล)
+                    search_text=employee_search_text(employee_code, username),
+                )
+            )
+
+        EmployeeProfile.objects.bulk_create(new_profiles)
+        for profile in new_profiles:
+            self.profile_ids[profile.user_id] = profile.pk
+            self.employee_codes.add(profile.employee_code)
+            touched_profile_ids.append(profile.pk)
+        self.created += len(new_profiles)
+        self._link_managers(new_profiles, managed_rows)
+        if new_profiles:
+            # bulk_create ไม่ผ่าน signal → แจ้ง dashboard เองว่าจำนวนพนักงานเปลี่ยน
+            bump_data_version(DASHBOARD_VERSION_KEY)
+
+        provision_leave_balances(
+            self.year, employee_ids=touched_profile_ids, leave_types=self.leave_types
+        )
+
+    def _link_managers(self, new_profiles, managed_rows):
+        """bulk_create ไม่ผ่าน signal → ต่อสายงานใน OrgClosure เองใน transaction ของ chunk"""
+        ensure_org_nodes([profile.user_id for profile in new_profiles])
+        for row_no, manager_username, index in managed_rows:
+            profile = new_profiles[index]
+            try:
+                set_manager(profile.user_id, profile.manager_id)
+            except ValidationError:
+                # user ที่มีอยู่แล้วอาจเป็นหัวหน้าของหัวหน้าที่ระบุในไฟล์ (สายงานจะวน)
+                EmployeeProfile.objects.filter(pk=profile.pk).update(manager=None)
+                profile.manager_id = None
+                self.errors.append(
+                    (row_no, f"หัวหน้า {manager_username} อยู่ในสายงานของพนักงานคนนี้ นำเข้าโดยไม่ระบุหัวหน้า")
+                )
+
+    def _create_departments(self, codes: set[str]):
+        missing = codes - self.department_ids.keys()
+        if not missing:
+            return
+        Department.objects.bulk_create(
+            [Department(code=code, name=code) for code in sorted(missing)],
+            ignore_conflicts=True,
+        )
+        self.department_ids.update(
+            Department.objects.filter(code__in=missing).values_list("code", "id")
+        )
+
+    def _create_users(self, accepted) -> set[int]:
+        """สร้าง User ที่ยังไม่มี คืน id ของ User ที่สร้างใหม่"""
+        new_users: dict[str, str] = {}
+        for _, username, password, *_ in accepted:
+            if username not in self.user_ids:
+                new_users[username] = password or username
+        if not new_users:
+            return set()
+
+        hashed = hash_passwords(list(new_users.values()), self._hash_pool())
+        users = User.objects.bulk_create(
+            [User(username=u, password=h) for u, h in zip(new_users, hashed)]
+        )
+        for user in users:
+            self.user_ids[user.username] = user.pk
+        return {user.pk for user in users}
+
+
+def claim_import_job() -> EmployeeImportJob | None:
+    """
+    หยิบ job ถัดไปมาทำ: job ที่ยังไม่เริ่ม หรือ job ที่ worker เดิมตายไป (heartbeat เก่า)
+    lock ด้วย skip_locked เพื่อให้รันหลาย worker พร้อมกันได้
+    job ที่กำลังทำ chunk อยู่ถูก lock ไว้ทั้ง transaction ของ chunk (run_import_job) จึงไม่ถูกหยิบซ้ำ
+    แม้ chunk นั้นจะนานเกิน EMPLOYEE_IMPORT_STALE_SECONDS
+    """
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=EMPLOYEE_IMPORT_STALE_SECONDS)
+    with transaction.atomic():
+        job = (
+            EmployeeImportJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=EmployeeImportJob.STATUS_PENDING)
+                | Q(status=EmployeeImportJob.STATUS_RUNNING, heartbeat_at__lt=stale_before)
+            )
+            .order_by("created_at")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = EmployeeImportJob.STATUS_RUNNING
+        job.heartbeat_at = now
+        job.save(update_fields=["status", "heartbeat_at"])
+    return job
+
+
+def run_import_job(job: EmployeeImportJob, chunk_size: int | None = None):
+    """
+    ประมวลผล job ทีละ chunk โดยแต่ละ chunk commit พร้อมกับ checkpoint (last_row)
+    ถ้า worker ตายกลางทาง รอบถัดไปจะเริ่มต่อจากแถวหลัง last_row ไม่ต้องเริ่มใหม่
+    """
+    chunk_size = chunk_size or EMPLOYEE_IMPORT_CHUNK_SIZE
+
+    job.status = EmployeeImportJob.STATUS_RUNNING
+    job.run_started_at = job.heartbeat_at = timezone.now()
+    job.run_start_row = job.last_row
+    if job.total_rows is None:
+        with job.file.open("rb") as f:
+            job.total_rows = count_employee_rows(f)
+    job.save(update_fields=["status", "run_started_at", "heartbeat_at", "run_start_row", "total_rows"])
+
+    try:
+        with EmployeeImporter() as importer, job.file.open("rb") as f:
+            rows = read_employee_rows(f, start_row=job.last_row + 1)
+            for chunk in chunked(rows, chunk_size):
+                processed, created, errors = importer.processed, importer.created, len(importer.errors)
+                with transaction.atomic():
+                    # lock แถวของ job ตลอด chunk (claim_import_job ข้ามแถวที่ถูก lock)
+                    # ถ้า worker อื่นรับ job ไปแล้ว (run_started_at เปลี่ยน) ให้หยุดโดยไม่แตะ job
+                    owner = EmployeeImportJob.objects.select_for_update().only("run_started_at").get(pk=job.pk)
+                    if owner.run_started_at != job.run_started_at:
+                        return
+                    importer.import_chunk(chunk)
+
+                    job.last_row = chunk[-1][0]
+                    job.processed += importer.processed - processed
+                    job.created_count += importer.created - created
+                    room = EMPLOYEE_IMPORT_MAX_ERRORS - len(job.errors)
+                    if room > 0:
+                        job.errors.extend(importer.errors[errors:errors + room])
+                    job.heartbeat_at = timezone.now()
+                    job.save(
+                        update_fields=["last_row", "processed", "created_count", "errors", "heartbeat_at"]
+                    )
+    except Exception as exc:
+        job.status = EmployeeImportJob.STATUS_FAILED
+        job.error_message = f"{type(exc).__name__}: {exc}"
+        job.finished_at = timezone.now()
+        job.save(update_fields=["status", "error_message", "finished_at"])
+        raise
+
+    job.status = EmployeeImportJob.STATUS_DONE
+    job.finished_at = timezone.now()
+    # นำเข้าครบแล้ว ไม่ต้องเก็บไฟล์ที่มีรหัสผ่านไว้อีก
+    _delete_import_file(job)
+    job.save(update_fields=["status", "finished_at", "file"])
+
+
+def _delete_import_file(job: EmployeeImportJob):
+    if job.file:
+        job.file.delete(save=False)
+    job.file = ""
+
+
+def retry_import_job(job: EmployeeImportJob) -> bool:
+    """ส่ง job ที่ล้มเหลว (และไฟล์ยังไม่ถูกลบ) กลับเข้าคิว worker จะทำต่อจาก checkpoint (last_row) เดิม"""
+    updated = EmployeeImportJob.objects.filter(
+        pk=job.pk, status=EmployeeImportJob.STATUS_FAILED
+    ).exclude(file="").update(status=EmployeeImportJob.STATUS_PENDING, error_message="", finished_at=None)
+    if updated:
+        job.refresh_from_db()
+    return bool(updated)
+
+
+def purge_import_jobs(retention_days: int | None = None) -> int:
+    """
+    ลบไฟล์ของ job ที่ล้มเหลว หรือค้าง (ไม่มี worker ทำต่อ) เกิน retention_days วัน คืนจำนวนไฟล์ที่ลบ
+    job ยังอยู่ให้ดูผล แต่ลองใหม่ไม่ได้แล้ว (job ที่เสร็จลบไฟล์ไปตั้งแต่ตอนจบ)
+    """
+    if retention_days is None:
+        retention_days = EMPLOYEE_IMPORT_RETENTION_DAYS
+    now = timezone.now()
+    cutoff = now - timedelta(days=retention_days)
+    purged = 0
+    with transaction.atomic():
+        # job ที่กำลังทำ chunk อยู่ถูก lock ไว้ → ข้าม
+        expired = (
+            EmployeeImportJob.objects.select_for_update(skip_locked=True)
+            .exclude(file="")
+            .filter(
+                Q(status=EmployeeImportJob.STATUS_FAILED, finished_at__lt=cutoff)
+                | Q(
+                    Q(heartbeat_at__isnull=True) | Q(heartbeat_at__lt=cutoff),
+                    status__in=[EmployeeImportJob.STATUS_PENDING, EmployeeImportJob.STATUS_RUNNING],
+                    created_at__lt=cutoff,
+                )
+            )
+        )
+        for job in expired:
+            _delete_import_file(job)
+            if job.status != EmployeeImportJob.STATUS_FAILED:
+                job.status = EmployeeImportJob.STATUS_FAILED
+                job.error_message = f"ไม่มี worker ทำต่อภายใน {retention_days} วัน ลบไฟล์แล้ว"
+                job.finished_at = now
+            job.save(update_fields=["file", "status", "error_message", "finished_at"])
+            purged += 1
+    return purged
@@ -0,0 +1,325 @@
+"""
+ส่งออกคำขอลา (CSV / Excel) สำหรับ HR
+
+- ดึงข้อมูลด้วย values_list + iterator ทีละ chunk ไม่สร้าง model instance ทีละแถว
+- CSV บน PostgreSQL ใช้ COPY (SELECT ...) TO STDOUT ผ่าน copy_expert ทีละ chunk (แบ่งด้วย keyset) ฐานข้อมูลอื่นใช้ ORM
+- Excel เขียนด้วย openpyxl โหมด write-only ลง SpooledTemporaryFile (หน่วยความจำคงที่ ไม่ขึ้นกับจำนวนแถว)
+- ถ้าจำนวนแถวเกิน LEAVE_EXPORT_SYNC_MAX_ROWS ให้สร้าง LeaveExportJob แล้วให้ worker (`run_export_jobs`) สร้างไฟล์แทน
+  ไฟล์อยู่ใน private storage ชื่อสุ่ม ดาวน์โหลดผ่าน hr_export_job_download (HR เท่านั้น)
+  ไฟล์เก่ากว่า LEAVE_EXPORT_RETENTION_DAYS ถูกลบพร้อม job (purge_export_jobs)
+"""
+import csv
+import io
+import tempfile
+import uuid
+from datetime import timedelta
+
+import openpyxl
+from django.conf import settings
+from django.core.files import File
+from django.db import connections, transaction
+from django.db.models import Case, CharField, F, Func, Q, Value, When
+from django.db.models.functions import Coalesce, Concat, NullIf, Replace, Trim
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import LeaveExportJob, LeaveRequest
+
+EXPORT_HEADERS = [
+    "Created at",
+    "Employee code",
+    "Employee name",
+    "Department",
+    "Leave type",
+    "Start date",
+    "End date",
+    "Half day",
+    "Status",
+    "Reason",
+]
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FILTER_PARAMS = ("status", "department", "leave_type", "employee", "date_from", "date_to")
+
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# จำนวนแถวต่อหนึ่งคำสั่ง COPY แต่ละ chunk อยู่ในหน่วยความจำทั้งก้อนก่อนส่งออกไปใน response
+# (ประมาณ 150 ไบต์ต่อแถว → ราว 1 MB ต่อ chunk)
+LEAVE_EXPORT_COPY_CHUNK_SIZE = getattr(settings, "LEAVE_EXPORT_COPY_CHUNK_SIZE", 5000)
+# ส่งออก Excel เกินจำนวนแถวนี้จะทำเป็นงานเบื้องหลังแทนการสร้างในคำขอ HTTP
+LEAVE_EXPORT_SYNC_MAX_ROWS = getattr(settings, "LEAVE_EXPORT_SYNC_MAX_ROWS", 20000)
+# ไฟล์ชั่วคราวอยู่ในหน่วยความจำจนถึงขนาดนี้ (ไบต์) แล้วจึงย้ายลงดิสก์
+LEAVE_EXPORT_SPOOL_BYTES = getattr(settings, "LEAVE_EXPORT_SPOOL_BYTES", 5 * 1024 * 1024)
+# job ที่สถานะ RUNNING นานเกินนี้ ถือว่า worker ตาย ให้ worker อื่นรับไปทำใหม่
+LEAVE_EXPORT_STALE_SECONDS = getattr(settings, "LEAVE_EXPORT_STALE_SECONDS", 900)
+# ไฟล์ / job ที่เสร็จ (หรือล้มเหลว) นานเกินกี่วันจะถูกลบโดย `run_export_jobs`
+LEAVE_EXPORT_RETENTION_DAYS = getattr(settings, "LEAVE_EXPORT_RETENTION_DAYS", 7)
+
+
+def filter_leaves(params):
+    """คำขอลาตามตัวกรองของหน้า HR dashboard (params = request.GET หรือ dict ที่เก็บไว้ใน job)"""
+    qs = (
+        LeaveRequest.objects.select_related(
+            "employee__user",
+            "employee__department",
+            "leave_type",
+        )
+        .order_by("-created_at", "-id")
+    )
+
+    status = params.get("status") or ""
+    department_id = params.get("department") or ""
+    leave_type_id = params.get("leave_type") or ""
+    employee_id = params.get("employee") or ""
+    date_from = params.get("date_from") or ""
+    date_to = params.get("date_to") or ""
+
+    if status:
+        qs = qs.filter(status=status)
+    if department_id:
+        qs = qs.filter(employee__department_id=department_id)
+    if leave_type_id:
+        qs = qs.filter(leave_type_id=leave_type_id)
+    if employee_id:
+        qs = qs.filter(employee_id=employee_id)
+    if date_from:
+        qs = qs.filter(start_date__gte=parse_date(date_from))
+    if date_to:
+        qs = qs.filter(end_date__lte=parse_date(date_to))
+
+    return qs
+
+
+def export_params(params) -> dict:
+    """เก็บเฉพาะตัวกรองที่ใช้จริง สำหรับบันทึกลง LeaveExportJob"""
+    return {key: params.get(key) for key in EXPORT_FILTER_PARAMS if params.get(key)}
+
+
+def iter_leave_export_rows(qs):
+    """
+    ดึงเฉพาะคอลัมน์ที่ใช้ด้วย values_list + iterator ทีละ chunk (ไม่สร้าง model instance ทีละแถว)
+    คืนแถวตามลำดับ EXPORT_HEADERS
+    """
+    status_labels = dict(LeaveRequest.STATUS_CHOICES)
+    rows = qs.values_list(
+        "created_at",
+        "employee__employee_code",
+        "employee__user__first_name",
+        "employee__user__last_name",
+        "employee__user__username",
+        "employee__department__name",
+        "leave_type__name",
+        "start_date",
+        "end_date",
+        "half_day",
+        "status",
+        "reason",
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    for (
+        created_at, code, first_name, last_name, username, department,
+        leave_type, start_date, end_date, half_day, status, reason,
+    ) in rows:
+        yield [
+            created_at.strftime("%Y-%m-%d %H:%M"),
+            code,
+            f"{first_name} {last_name}".strip() or username,
+            department or "",
+            leave_type,
+            start_date,
+            end_date,
+            "Yes" if half_day else "No",
+            status_labels.get(status, status),
+            reason,
+        ]
+
+
+class _Echo:
+    """file-like object สำหรับ csv.writer ที่คืนค่าบรรทัดแทนการเขียนลง buffer"""
+
+    def write(self, value):
+        return value
+
+
+def _csv_writer():
+    # จบบรรทัดด้วย \n เหมือนผลของ COPY ... (FORMAT csv) ทั้งสองทางได้ไฟล์เดียวกัน
+    return csv.writer(_Echo(), lineterminator="\n")
+
+
+def _iter_leaves_csv_orm(qs):
+    writer = _csv_writer()
+    yield writer.writerow(EXPORT_HEADERS)
+    for row in iter_leave_export_rows(qs):
+        row[-1] = row[-1].replace("\n", " ")
+        yield writer.writerow(row)
+
+
+class _ToChar(Func):
+    function = "TO_CHAR"
+    output_field = CharField()
+
+
+def _copy_export_values(qs):
+    """
+    คอลัมน์เดียวกับ iter_leave_export_rows แต่จัดรูปแบบใน SQL ทั้งหมด
+    (เวลาเป็น UTC ตาม session ของ Django เหมือนฝั่ง ORM)
+    """
+    status_labels = Case(
+        *[When(status=value, then=Value(label)) for value, label in LeaveRequest.STATUS_CHOICES],
+        default=F("status"),
+        output_field=CharField(),
+    )
+    full_name = Coalesce(
+        NullIf(
+            Trim(Concat("employee__user__first_name", Value(" "), "employee__user__last_name")),
+            Value(""),
+        ),
+        "employee__user__username",
+        output_field=CharField(),
+    )
+    return qs.values_list(
+        _ToChar("created_at", Value("YYYY-MM-DD HH24:MI")),
+        "employee__employee_code",
+        full_name,
+        Coalesce("employee__department__name", Value(""), output_field=CharField()),
+        "leave_type__name",
+        _ToChar("start_date", Value("YYYY-MM-DD")),
+        _ToChar("end_date", Value("YYYY-MM-DD")),
+        Case(When(half_day=True, then=Value("Yes")), default=Value("No"), output_field=CharField()),
+        status_labels,
+        Replace("reason", Value("\n"), Value(" "), output_field=CharField()),
+    )
+
+
+def copy_export_supported(qs) -> bool:
+    """ใช้ COPY ได้เมื่อเป็น PostgreSQL ผ่าน psycopg2 (มี copy_expert)"""
+    if connections[qs.db].vendor != "postgresql":
+        return False
+    from django.db.backends.postgresql.psycopg_any import is_psycopg3
+
+    return not is_psycopg3
+
+
+def _copy_chunk(qs) -> bytes:
+    connection = connections[qs.db]
+    sql, params = _copy_export_values(qs).query.sql_with_params()
+    with connection.cursor() as cursor:
+        raw = cursor.cursor
+        select = raw.mogrify(sql, params).decode()
+        buffer = io.BytesIO()
+        raw.copy_expert(f"COPY ({select}) TO STDOUT WITH (FORMAT csv)", buffer)
+    return buffer.getvalue()
+
+
+def _iter_leaves_csv_copy(qs, chunk_size):
+    """
+    แบ่งผลลัพธ์เป็นช่วงตาม keyset (created_at, id) ลดหลั่นเหมือนลำดับของ filter_leaves
+    หาขอบของแต่ละช่วงด้วย query เล็ก ๆ แล้ว COPY ทั้งช่วงในคำสั่งเดียว
+    """
+    writer = _csv_writer()
+    yield writer.writerow(EXPORT_HEADERS)
+
+    remaining = qs
+    while True:
+        bound = next(iter(remaining.values_list("created_at", "id")[chunk_size - 1:chunk_size]), None)
+        if bound is None:
+            yield _copy_chunk(remaining)
+            return
+        created_at, pk = bound
+        yield _copy_chunk(
+            remaining.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gte=pk))
+        )
+        # ขอบล่างของช่วงก่อนหน้าไม่ต้องสะสม ใช้เฉพาะขอบล่าสุดกับ queryset ตั้งต้น
+        remaining = qs.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+
+def iter_leaves_csv(qs, chunk_size: int | None = None):
+    """CSV ของคำขอลาเป็นชิ้น ๆ สำหรับ StreamingHttpResponse"""
+    if copy_export_supported(qs):
+        return _iter_leaves_csv_copy(qs, chunk_size or LEAVE_EXPORT_COPY_CHUNK_SIZE)
+    return _iter_leaves_csv_orm(qs)
+
+
+def write_leaves_xlsx(qs, fileobj) -> int:
+    """เขียนคำขอลาเป็น .xlsx ลง fileobj ด้วย workbook แบบ write-only คืนจำนวนแถวข้อมูล"""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Leave Requests")
+    ws.append(EXPORT_HEADERS)
+
+    count = 0
+    for row in iter_leave_export_rows(qs):
+        row[5] = row[5].isoformat()
+        row[6] = row[6].isoformat()
+        ws.append(row)
+        count += 1
+
+    wb.save(fileobj)
+    return count
+
+
+def spooled_leaves_xlsx(qs):
+    """สร้างไฟล์ .xlsx ลง SpooledTemporaryFile แล้วกรอกลับไปต้นไฟล์ ผู้เรียกต้องปิดไฟล์เอง"""
+    tmp = tempfile.SpooledTemporaryFile(max_size=LEAVE_EXPORT_SPOOL_BYTES)
+    write_leaves_xlsx(qs, tmp)
+    tmp.seek(0)
+    return tmp
+
+
+def claim_export_job() -> LeaveExportJob | None:
+    """หยิบ job ถัดไปมาทำ (lock ด้วย skip_locked เพื่อให้รันหลาย worker พร้อมกันได้)"""
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=LEAVE_EXPORT_STALE_SECONDS)
+    with transaction.atomic():
+        job = (
+            LeaveExportJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=LeaveExportJob.STATUS_PENDING)
+                | Q(status=LeaveExportJob.STATUS_RUNNING, started_at__lt=stale_before)
+            )
+            .order_by("created_at")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = LeaveExportJob.STATUS_RUNNING
+        job.started_at = now
+        job.save(update_fields=["status", "started_at"])
+    return job
+
+
+def run_export_job(job: LeaveExportJob):
+    """สร้างไฟล์ Excel ตามตัวกรองของ job แล้วบันทึกลง job.file"""
+    try:
+        qs = filter_leaves(job.params)
+        with tempfile.SpooledTemporaryFile(max_size=LEAVE_EXPORT_SPOOL_BYTES) as tmp:
+            job.row_count = write_leaves_xlsx(qs, tmp)
+            tmp.seek(0)
+            # ชื่อสุ่ม เดาจากเวลา / เลข job ไม่ได้ (ชื่อที่ผู้ใช้เห็นคือ job.filename)
+            job.file.save(f"{uuid.uuid4().hex}.xlsx", File(tmp), save=False)
+    except Exception as exc:
+        job.status = LeaveExportJob.STATUS_FAILED
+        job.error_message = f"{type(exc).__name__}: {exc}"
+        job.finished_at = timezone.now()
+        job.save(update_fields=["status", "error_message", "finished_at"])
+        raise
+
+    job.status = LeaveExportJob.STATUS_DONE
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "file", "row_count", "finished_at"])
+
+
+def purge_export_jobs(retention_days: int | None = None) -> int:
+    """ลบ job ที่จบไปแล้วเกิน retention_days วันพร้อมไฟล์ คืนจำนวน job ที่ลบ"""
+    if retention_days is None:
+        retention_days = LEAVE_EXPORT_RETENTION_DAYS
+    expired = list(
+        LeaveExportJob.objects.filter(
+            status__in=[LeaveExportJob.STATUS_DONE, LeaveExportJob.STATUS_FAILED],
+            finished_at__lt=timezone.now() - timedelta(days=retention_days),
+        )
+    )
+    for job in expired:
+        if job.file:
+            job.file.delete(save=False)
+    LeaveExportJob.objects.filter(pk__in=[job.pk for job in expired]).delete()
+    return len(expired)
@@ -0,0 +1,131 @@
+"""
+สายบังคับบัญชาแบบ closure table (OrgClosure)
+
+- เก็บทุกคู่ (หัวหน้าทุกระดับ, ลูกน้อง) พร้อม depth จึงหาลูกน้องทั้งสายได้ด้วย join เดียว ไม่ต้อง query ซ้ำทีละชั้น
+- node คือ User (EmployeeProfile.manager ชี้ไปที่ User) ทุกคนมีแถว depth 0 ของตัวเอง
+- save() / delete() ของ EmployeeProfile อัปเดตผ่าน signals ส่วน bulk_create ตอนนำเข้าพนักงานเรียก
+  set_manager() ทีละแถวใน transaction ของ chunk เอง
+- rebuild_org_closure() สร้างใหม่ทั้งตาราง ใช้แก้ข้อมูลที่คลาด (คำสั่ง `rebuild_org_closure`)
+"""
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .models import EmployeeProfile, LeaveRequest, OrgClosure
+
+ORG_CYCLE_MESSAGE = "ไม่สามารถตั้งหัวหน้าเป็นตัวเองหรือลูกน้องในสายงานของตัวเองได้"
+
+
+def _depth_filter(prefix: str, manager, max_depth: int | None) -> dict:
+    # เงื่อนไขทั้งหมดอยู่ใน filter() เดียว → join OrgClosure ครั้งเดียว
+    lookup = {f"{prefix}__ancestor": manager, f"{prefix}__depth__gte": 1}
+    if max_depth is not None:
+        lookup[f"{prefix}__depth__lte"] = max_depth
+    return lookup
+
+
+def subordinate_profiles(manager, max_depth: int | None = 1):
+    """EmployeeProfile ของลูกน้องไม่เกิน max_depth ระดับ (None = ทั้งสายงาน)"""
+    return EmployeeProfile.objects.filter(**_depth_filter("user__org_ancestors", manager, max_depth))
+
+
+def subordinate_leaves(manager, max_depth: int | None = 1):
+    """LeaveRequest ของลูกน้องไม่เกิน max_depth ระดับ (None = ทั้งสายงาน)"""
+    return LeaveRequest.objects.filter(
+        **_depth_filter("employee__user__org_ancestors", manager, max_depth)
+    )
+
+
+def manages(manager, profile: EmployeeProfile, max_depth: int | None = None) -> bool:
+    """manager เป็นหัวหน้า (ระดับใดก็ได้ถ้า max_depth=None) ของ profile หรือไม่"""
+    lookup = {"ancestor": manager, "descendant_id": profile.user_id, "depth__gte": 1}
+    if max_depth is not None:
+        lookup["depth__lte"] = max_depth
+    return OrgClosure.objects.filter(**lookup).exists()
+
+
+def would_create_cycle(user_id: int, manager_id: int | None) -> bool:
+    """ตั้ง manager_id เป็นหัวหน้าของ user_id แล้วจะวนกลับหาตัวเองหรือไม่"""
+    if manager_id is None:
+        return False
+    if manager_id == user_id:
+        return True
+    return OrgClosure.objects.filter(ancestor_id=user_id, descendant_id=manager_id).exists()
+
+
+def ensure_org_nodes(user_ids):
+    """แถว depth 0 ของ user เหล่านี้ (ที่มีอยู่แล้วข้ามไป)"""
+    OrgClosure.objects.bulk_create(
+        [OrgClosure(ancestor_id=pk, descendant_id=pk, depth=0) for pk in user_ids],
+        ignore_conflicts=True,
+    )
+
+
+def detach_subtree(user_id: int):
+    """ตัด user_id และลูกน้องทั้งสายออกจากหัวหน้าเดิมทุกระดับ (แถวภายในสายงานเดิมยังอยู่)"""
+    subtree = OrgClosure.objects.filter(ancestor_id=user_id).values("descendant_id")
+    OrgClosure.objects.filter(descendant_id__in=subtree).exclude(ancestor_id__in=subtree).delete()
+
+
+def remove_profile_node(user_id: int):
+    """โปรไฟล์ถูกลบ: ตัดออกจากหัวหน้าเดิม ลูกน้องยังอยู่ใต้ user นี้ ถ้าไม่มีลูกน้องก็ลบแถว depth 0 ด้วย"""
+    detach_subtree(user_id)
+    if not EmployeeProfile.objects.filter(manager_id=user_id).exists():
+        OrgClosure.objects.filter(ancestor_id=user_id, descendant_id=user_id).delete()
+
+
+def set_manager(user_id: int, manager_id: int | None):
+    """ย้าย user_id (พร้อมลูกน้องทั้งสาย) ไปอยู่ใต้ manager_id (None = ไม่มีหัวหน้า)"""
+    with transaction.atomic():
+        # lock โปรไฟล์ทั้งสองฝั่งก่อนตรวจ กันสองคนย้ายสายงานไขว้กันพร้อมกันแล้วเกิดวง
+        # (อีกฝั่งต้องรอ commit แล้วจึงเห็น OrgClosure ใหม่ตอนตรวจ)
+        list(
+            EmployeeProfile.objects.select_for_update()
+            .filter(user_id__in={user_id, manager_id} - {None})
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+        if would_create_cycle(user_id, manager_id):
+            raise ValidationError(ORG_CYCLE_MESSAGE)
+
+        ensure_org_nodes({user_id, manager_id} - {None})
+        detach_subtree(user_id)
+        if manager_id is None:
+            return
+        above = list(
+            OrgClosure.objects.filter(descendant_id=manager_id).values_list("ancestor_id", "depth")
+        )
+        below = list(
+            OrgClosure.objects.filter(ancestor_id=user_id).values_list("descendant_id", "depth")
+        )
+        OrgClosure.objects.bulk_create(
+            [
+                OrgClosure(ancestor_id=ancestor, descendant_id=descendant, depth=up + down + 1)
+                for ancestor, up in above
+                for descendant, down in below
+            ],
+            batch_size=1000,
+        )
+
+
+def rebuild_org_closure() -> int:
+    """สร้าง OrgClosure ใหม่ทั้งตารางจาก EmployeeProfile.manager คืนจำนวนแถว"""
+    managers = dict(
+        EmployeeProfile.objects.values_list("user_id", "manager_id")
+    )
+    nodes = set(managers) | {pk for pk in managers.values() if pk is not None}
+
+    rows = []
+    for node in nodes:
+        rows.append(OrgClosure(ancestor_id=node, descendant_id=node, depth=0))
+        seen = {node}
+        ancestor, depth = managers.get(node), 1
+        # ข้อมูลเก่าอาจวนกันเอง (ก่อนมีการตรวจ) ตัดที่จุดที่วนกลับ
+        while ancestor is not None and ancestor not in seen:
+            rows.append(OrgClosure(ancestor_id=ancestor, descendant_id=node, depth=depth))
+            seen.add(ancestor)
+            ancestor, depth = managers.get(ancestor), depth + 1
+
+    with transaction.atomic():
+        OrgClosure.objects.all().delete()
+        OrgClosure.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from leave_app.models import LeaveRequest
+from leave_app.services import recalculate_leave_days
+
+
+class Command(BaseCommand):
+    help = "คำนวณและบันทึกจำนวนวันลา (รวม + แยกตามปี) ให้ LeaveRequest ที่ยังไม่มีค่า"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="คำนวณใหม่ทุกใบ ไม่ใช่เฉพาะใบที่ยังไม่เคยคำนวณ",
+        )
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        qs = LeaveRequest.objects.all()
+        if not options["all"]:
+            qs = qs.filter(total_days__isnull=True)
+
+        updated = recalculate_leave_days(qs, chunk_size=options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(f"อัปเดตวันลา {updated} รายการ"))
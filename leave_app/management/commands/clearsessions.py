@@ -0,0 +1,12 @@
+from django.contrib.sessions.management.commands.clearsessions import Command as ClearSessionsCommand
+
+from leave_app.services import prune_user_sessions
+
+
+class Command(ClearSessionsCommand):
+    help = ClearSessionsCommand.help + " และลบแถว UserSession ของ session ที่ไม่มีแล้ว"
+
+    def handle(self, **options):
+        super().handle(**options)
+        pruned = prune_user_sessions()
+        self.stdout.write(f"ลบ UserSession ที่หมดอายุ {pruned} รายการ")
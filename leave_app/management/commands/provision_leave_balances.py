@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from leave_app.services import provision_leave_balances
+
+
+class Command(BaseCommand):
+    help = "สร้าง LeaveBalance ที่ยังขาดให้พนักงานทุกคน ทุกประเภทการลา สำหรับปีที่กำหนด"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--year", type=int, default=None, help="ค่าเริ่มต้นคือปีปัจจุบัน")
+
+    def handle(self, *args, **options):
+        year = options["year"] or timezone.now().year
+        created = provision_leave_balances(year)
+        self.stdout.write(self.style.SUCCESS(f"สร้างโควต้าวันลาปี {year} เพิ่ม {created} รายการ"))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from leave_app.rollups import rebuild_leave_rollups
+
+
+class Command(BaseCommand):
+    help = "สร้างตารางสรุป LeaveStatsRollup ใหม่จาก LeaveRequest (ใช้เมื่อยอดคลาด เช่น หลัง loaddata หรือแก้ DB ตรง ๆ)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--year",
+            type=int,
+            action="append",
+            dest="years",
+            help="สร้างใหม่เฉพาะปีนี้ (ใส่ซ้ำได้) ไม่ใส่คือทุกปี",
+        )
+
+    def handle(self, *args, **options):
+        created = rebuild_leave_rollups(options["years"])
+        self.stdout.write(self.style.SUCCESS(f"สร้าง rollup {created} แถว"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from leave_app.hierarchy import rebuild_org_closure
+
+
+class Command(BaseCommand):
+    help = "สร้างสายบังคับบัญชา (OrgClosure) ใหม่ทั้งตารางจาก EmployeeProfile.manager"
+
+    def handle(self, *args, **options):
+        created = rebuild_org_closure()
+        self.stdout.write(self.style.SUCCESS(f"สร้าง OrgClosure {created} แถว"))
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from leave_app.exports import claim_export_job, purge_export_jobs, run_export_job
+
+
+class Command(BaseCommand):
+    help = "สร้างไฟล์ Excel ของงานส่งออกคำขอลา (LeaveExportJob) ที่รออยู่ และลบไฟล์ที่เก่าเกินระยะเก็บ"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="รันต่อเนื่อง (ใช้เป็น worker) แทนการทำ job ที่ค้างแล้วจบ",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="วินาทีที่รอเมื่อไม่มี job (ใช้กับ --loop)",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_export_job()
+            if job is None:
+                purged = purge_export_jobs()
+                if purged:
+                    self.stdout.write(f"ลบไฟล์ export ที่หมดอายุ {purged} รายการ")
+                if not options["loop"]:
+                    return
+                time.sleep(options["interval"])
+                continue
+
+            self.stdout.write(f"เริ่ม export #{job.pk}")
+            try:
+                run_export_job(job)
+            except Exception as exc:
+                self.stderr.write(f"export #{job.pk} ล้มเหลว: {exc}")
+            else:
+                self.stdout.write(self.style.SUCCESS(f"export #{job.pk} เสร็จ {job.row_count} แถว"))
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from leave_app.employee_import import claim_import_job, purge_import_jobs, run_import_job
+
+
+class Command(BaseCommand):
+    help = "ประมวลผลงานนำเข้าพนักงาน (EmployeeImportJob) ที่รออยู่ หรือทำต่อจาก job ที่ค้าง และลบไฟล์ที่เก่าเกินระยะเก็บ"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=None)
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="รันต่อเนื่อง (ใช้เป็น worker) แทนการทำ job ที่ค้างแล้วจบ",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="วินาทีที่รอเมื่อไม่มี job (ใช้กับ --loop)",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_import_job()
+            if job is None:
+                purged = purge_import_jobs()
+                if purged:
+                    self.stdout.write(f"ลบไฟล์นำเข้าที่หมดอายุ {purged} รายการ")
+                if not options["loop"]:
+                    return
+                time.sleep(options["interval"])
+                continue
+
+            self.stdout.write(f"เริ่ม import #{job.pk} ต่อจากแถว {job.last_row}")
+            try:
+                run_import_job(job, chunk_size=options["chunk_size"])
+            except Exception as exc:
+                self.stderr.write(f"import #{job.pk} ล้มเหลว: {exc}")
+            else:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"import #{job.pk} เสร็จ {job.processed} แถว (สร้างใหม่ {job.created_count})"
+                    )
+                )
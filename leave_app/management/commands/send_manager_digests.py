@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from leave_app.services import LEAVE_APPROVAL_SLA_HOURS, send_manager_digests
+
+
+class Command(BaseCommand):
+    help = "ส่งอีเมลสรุปคำขอลาที่รออนุมัติให้หัวหน้า คนละ 1 ฉบับ พร้อมเตือนคำขอที่เกินกำหนด (ใช้กับ cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sla-hours",
+            type=int,
+            default=LEAVE_APPROVAL_SLA_HOURS,
+            help="คำขอที่รอนานกว่านี้ (ชั่วโมง) จะถูกเตือนว่าเกินกำหนด",
+        )
+
+    def handle(self, *args, **options):
+        queued = send_manager_digests(sla_hours=options["sla_hours"])
+        self.stdout.write(self.style.SUCCESS(f"เข้าคิวอีเมลสรุป {queued} ฉบับ"))
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from leave_app.services import send_outbox_batch
+
+
+class Command(BaseCommand):
+    help = "ส่งอีเมลที่ค้างอยู่ใน EmailOutbox เป็นชุด ผ่าน SMTP connection เดียวต่อชุด"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="รันต่อเนื่อง (ใช้เป็น worker) แทนการส่งรอบเดียวแล้วจบ",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="วินาทีที่รอเมื่อไม่มีอีเมลค้าง (ใช้กับ --loop)",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            total_sent = total_failed = 0
+            while True:
+                sent, failed = send_outbox_batch(options["batch_size"])
+                total_sent += sent
+                total_failed += failed
+                if sent + failed < options["batch_size"]:
+                    break
+
+            if total_sent or total_failed or not options["loop"]:
+                self.stdout.write(
+                    f"ส่งสำเร็จ {total_sent} ฉบับ, ล้มเหลว {total_failed} ฉบับ"
+                )
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
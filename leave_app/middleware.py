@@ -0,0 +1,27 @@
+from django.conf import settings
+
+from .services import track_user_session
+
+
+class UserSessionMiddleware:
+    """
+    ตามเก็บ session key ที่เปลี่ยนระหว่าง request (cycle_key / update_session_auth_hash) ลง UserSession
+    เขียน DB เฉพาะ request ที่ key เปลี่ยน ต้องวางหลัง AuthenticationMiddleware
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        old_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        response = self.get_response(request)
+
+        session_key = request.session.session_key
+        if (
+            session_key
+            and session_key != old_key
+            and session_key != getattr(request, "_tracked_session_key", None)
+            and request.user.is_authenticated
+        ):
+            track_user_session(request.user, session_key, old_key)
+        return response
@@ -0,0 +1,31 @@
+# Generated by Django 6.0 on 2026-10-17 06:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leave_app', '0005_dataversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leaverequest',
+            name='total_days',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.CreateModel(
+            name='LeaveDayAllocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveIntegerField()),
+                ('days', models.DecimalField(decimal_places=2, default=0, max_digits=5)),
+                ('leave_request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allocations', to='leave_app.leaverequest')),
+            ],
+            options={
+                'unique_together': {('leave_request', 'year')},
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 6.0 on 2026-10-17 08:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def map_existing_sessions(apps, schema_editor):
+    # ครั้งเดียวตอน migrate: จับคู่ session ที่ยังไม่หมดอายุกับ user เดิม
+    Session = apps.get_model("sessions", "Session")
+    UserSession = apps.get_model("leave_app", "UserSession")
+    store = SessionStore()
+
+    batch = []
+    sessions = Session.objects.filter(expire_date__gte=timezone.now()).iterator(chunk_size=1000)
+    for session in sessions:
+        user_id = store.decode(session.session_data).get("_auth_user_id")
+        if user_id and str(user_id).isdigit():
+            batch.append(UserSession(session_key=session.session_key, user_id=int(user_id)))
+        if len(batch) >= 1000:
+            UserSession.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    UserSession.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leave_app', '0008_employeeimportjob'),
+        ('sessions', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_key', models.CharField(max_length=40, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='login_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(map_existing_sessions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 6.0 on 2026-10-17 15:10
+
+from django.conf import settings
+from django.db import migrations
+
+# (ชื่อ index, model, คอลัมน์) สำหรับ istartswith ของ search_employees
+# Django แปลง istartswith เป็น UPPER(col::text) LIKE UPPER(...) จึงต้องเป็น index แบบ expression + text_pattern_ops
+SEARCH_INDEXES = [
+    ("leave_emp_code_prefix_idx", "leave_app.EmployeeProfile", "employee_code"),
+    ("leave_user_username_prefix_idx", settings.AUTH_USER_MODEL, "username"),
+    ("leave_user_first_name_prefix_idx", settings.AUTH_USER_MODEL, "first_name"),
+    ("leave_user_last_name_prefix_idx", settings.AUTH_USER_MODEL, "last_name"),
+]
+
+
+def create_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    quote = schema_editor.quote_name
+    for name, model_label, column in SEARCH_INDEXES:
+        table = apps.get_model(model_label)._meta.db_table
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {quote(name)} "
+            f"ON {quote(table)} (UPPER({quote(column)}::text) text_pattern_ops)"
+        )
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for name, _, _ in SEARCH_INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {schema_editor.quote_name(name)}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leave_app', '0010_leaveexportjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 6.0 on 2026-10-17 15:40
+
+from django.db import migrations, models
+
+SEARCH_INDEX_NAME = "leave_emp_search_trgm_idx"
+
+
+def employee_search_text(*parts) -> str:
+    # สำเนาของ services.employee_search_text ณ ตอนสร้าง migration นี้ (ห้าม import โค้ดของแอปที่อาจเปลี่ยนภายหลัง)
+    return " ".join(str(p).strip() for p in parts if p).lower()
+
+
+def fill_search_text(apps, schema_editor):
+    EmployeeProfile = apps.get_model("leave_app", "EmployeeProfile")
+
+    batch = []
+    profiles = EmployeeProfile.objects.select_related("user").iterator(chunk_size=1000)
+    for profile in profiles:
+        user = profile.user
+        profile.search_text = employee_search_text(
+            profile.employee_code, user.username, user.first_name, user.last_name
+        )
+        batch.append(profile)
+        if len(batch) >= 1000:
+            EmployeeProfile.objects.bulk_update(batch, ["search_text"])
+            batch = []
+    EmployeeProfile.objects.bulk_update(batch, ["search_text"])
+
+
+def create_search_index(apps, schema_editor):
+    # GIN trigram ใช้กับ LIKE '%...%' ได้ (เฉพาะ PostgreSQL ฐานข้อมูลอื่นค้นแบบ LIKE ธรรมดา)
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema_editor.quote_name(SEARCH_INDEX_NAME)} "
+        "ON leave_app_employeeprofile USING gin (search_text gin_trgm_ops)"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(f"DROP INDEX IF EXISTS {schema_editor.quote_name(SEARCH_INDEX_NAME)}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leave_app', '0011_employee_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='employeeprofile',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
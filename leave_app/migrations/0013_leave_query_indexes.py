@@ -0,0 +1,46 @@
+# Generated by Django 6.0 on 2026-10-17 16:05
+
+from django.conf import settings
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leave_app', '0012_employeeprofile_search_text'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # index ประกอบที่ขึ้นต้นด้วย employee ด้านล่างใช้แทน index เดี่ยวของ FK ได้
+        migrations.AlterField(
+            model_name='leaverequest',
+            name='employee',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='leave_app.employeeprofile'),
+        ),
+        migrations.AddIndex(
+            model_name='leavebalance',
+            index=models.Index(fields=['employee', 'year'], name='leave_bal_emp_year_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='leaverequest',
+            index=models.Index(fields=['employee', 'status', 'start_date', 'end_date'], name='leave_emp_status_dates_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='leaverequest',
+            index=models.Index(fields=['-created_at', '-id'], name='leave_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='leaverequest',
+            index=models.Index(fields=['status', 'start_date'], name='leave_status_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='leaverequest',
+            index=models.Index(fields=['start_date'], name='leave_start_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='leaverequest',
+            index=models.Index(condition=models.Q(('status', 'APPROVED')), fields=['start_date', 'end_date'], name='leave_approved_dates_idx'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 6.0 on 2026-10-17 16:40
+
+from django.db import migrations
+
+CONSTRAINT_NAME = "leave_no_overlap"
+
+
+def find_overlaps(connection, limit=20):
+    """คู่ (id, id) ของคำขอ pending / approved ของพนักงานคนเดียวที่ช่วงวันซ้อนกัน"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT a.id, b.id FROM leave_app_leaverequest a "
+            "JOIN leave_app_leaverequest b ON b.employee_id = a.employee_id AND b.id > a.id "
+            "AND b.start_date <= a.end_date AND b.end_date >= a.start_date "
+            "WHERE a.status IN ('PENDING', 'APPROVED') AND b.status IN ('PENDING', 'APPROVED') "
+            "ORDER BY a.id, b.id LIMIT %s",
+            [limit],
+        )
+        return cursor.fetchall()
+
+
+def add_overlap_constraint(apps, schema_editor):
+    # ห้ามคำขอลา pending / approved ของพนักงานคนเดียวที่ช่วงวันซ้อนกัน (เฉพาะ PostgreSQL)
+    # ถ้ามีข้อมูลซ้อนกันอยู่แล้ว หยุด migrate พร้อมรายการคู่ที่ชนกัน ให้ยกเลิก / ปฏิเสธใบที่ซ้ำก่อน
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    overlaps = find_overlaps(schema_editor.connection)
+    if overlaps:
+        pairs = ", ".join(f"#{a} กับ #{b}" for a, b in overlaps)
+        raise RuntimeError(
+            "สร้าง constraint leave_no_overlap ไม่ได้ เพราะมีคำขอลา pending / approved ที่ช่วงวันซ้อนกันอยู่แล้ว "
+            f"(แสดงไม่เกิน 20 คู่: {pairs}) ยกเลิกหรือปฏิเสธใบที่ซ้ำ แล้วรัน migrate ใหม่"
+        )
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    schema_editor.execute(
+        f"ALTER TABLE leave_app_leaverequest ADD CONSTRAINT {schema_editor.quote_name(CONSTRAINT_NAME)} "
+        "EXCLUDE USING gist (employee_id WITH =, daterange(start_date, end_date, '[]') WITH &&) "
+        "WHERE (status IN ('PENDING', 'APPROVED'))"
+    )
+
+
+def drop_overlap_constraint(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(
+        f"ALTER TABLE leave_app_leaverequest DROP CONSTRAINT IF EXISTS {schema_editor.quote_name(CONSTRAINT_NAME)}"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leave_app', '0013_leave_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_overlap_constraint, drop_overlap_constraint),
+    ]
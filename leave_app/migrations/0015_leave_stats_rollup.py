@@ -0,0 +1,64 @@
+# Generated by Django 6.0 on 2026-10-17 17:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+
+
+def build_rollups(apps, schema_editor):
+    # ยอดเริ่มต้นจากคำขอที่มีอยู่ (หลังจากนี้ signals / services อัปเดตทีละรายการ)
+    LeaveRequest = apps.get_model("leave_app", "LeaveRequest")
+    LeaveStatsRollup = apps.get_model("leave_app", "LeaveStatsRollup")
+
+    rows = (
+        LeaveRequest.objects.annotate(
+            rollup_year=ExtractYear("start_date"),
+            rollup_month=ExtractMonth("start_date"),
+        )
+        .values("rollup_year", "rollup_month", "employee__department_id", "leave_type_id", "status")
+        .annotate(request_count=Count("id"), total_days=Sum("total_days"))
+        .order_by()
+    )
+    LeaveStatsRollup.objects.bulk_create(
+        [
+            LeaveStatsRollup(
+                year=row["rollup_year"],
+                month=row["rollup_month"],
+                department_id=row["employee__department_id"],
+                leave_type_id=row["leave_type_id"],
+                status=row["status"],
+                request_count=row["request_count"],
+                total_days=row["total_days"] or 0,
+            )
+            for row in rows
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leave_app', '0014_leave_no_overlap'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaveStatsRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('month', models.PositiveSmallIntegerField()),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('APPROVED', 'Approved'), ('REJECTED', 'Rejected'), ('CANCELLED', 'Cancelled')], max_length=20)),
+                ('request_count', models.IntegerField(default=0)),
+                ('total_days', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('department', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='leave_app.department')),
+                ('leave_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='leave_app.leavetype')),
+            ],
+            options={
+                'unique_together': {('year', 'month', 'department', 'leave_type', 'status')},
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 6.0 on 2026-10-17 18:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_closure(apps, schema_editor):
+    # สร้างจาก manager ที่มีอยู่ (หลังจากนี้ signals ดูแลทีละการเปลี่ยน) เหมือน hierarchy.rebuild_org_closure
+    EmployeeProfile = apps.get_model("leave_app", "EmployeeProfile")
+    OrgClosure = apps.get_model("leave_app", "OrgClosure")
+
+    managers = dict(EmployeeProfile.objects.values_list("user_id", "manager_id"))
+    rows = []
+    for node in set(managers) | {pk for pk in managers.values() if pk is not None}:
+        rows.append(OrgClosure(ancestor_id=node, descendant_id=node, depth=0))
+        seen = {node}
+        ancestor, depth = managers.get(node), 1
+        while ancestor is not None and ancestor not in seen:
+            rows.append(OrgClosure(ancestor_id=ancestor, descendant_id=node, depth=depth))
+            seen.add(ancestor)
+            ancestor, depth = managers.get(ancestor), depth + 1
+    OrgClosure.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leave_app', '0015_leave_stats_rollup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrgClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='org_descendants', to=settings.AUTH_USER_MODEL)),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='org_ancestors', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ancestor', 'depth', 'descendant'], name='org_ancestor_depth_idx')],
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(build_closure, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 6.0 on 2026-10-17 19:40
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_null_department_rows(apps, schema_editor):
+    # แถวที่แผนกเป็น NULL ซ้ำกันได้ก่อนมี constraint นี้ (ลบแผนก) รวมให้เหลือแถวเดียวต่อคีย์
+    LeaveStatsRollup = apps.get_model("leave_app", "LeaveStatsRollup")
+    duplicates = (
+        LeaveStatsRollup.objects.filter(department__isnull=True)
+        .values("year", "month", "leave_type_id", "status")
+        .annotate(
+            rows=Count("id"),
+            keep=Min("id"),
+            request_count_sum=Sum("request_count"),
+            total_days_sum=Sum("total_days"),
+        )
+        .filter(rows__gt=1)
+        .order_by()
+    )
+    for row in duplicates:
+        same_key = LeaveStatsRollup.objects.filter(
+            department__isnull=True,
+            year=row["year"],
+            month=row["month"],
+            leave_type_id=row["leave_type_id"],
+            status=row["status"],
+        )
+        same_key.exclude(pk=row["keep"]).delete()
+        same_key.filter(pk=row["keep"]).update(
+            request_count=row["request_count_sum"], total_days=row["total_days_sum"]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leave_app', '0017_org_closure'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_null_department_rows, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='leavestatsrollup',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='leavestatsrollup',
+            constraint=models.UniqueConstraint(fields=('year', 'month', 'department', 'leave_type', 'status'), name='leave_rollup_unique', nulls_distinct=False),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 6.0 on 2026-10-17 20:30
+
+import os
+import shutil
+
+from django.conf import settings
+from django.db import migrations, models
+
+import leave_app.storage
+
+
+def move_export_files(apps, schema_editor):
+    # ไฟล์ export เดิมอยู่ใต้ MEDIA_ROOT (เปิดได้ทาง /media/) ย้ายไปที่ PRIVATE_MEDIA_ROOT ชื่อเดิม
+    LeaveExportJob = apps.get_model("leave_app", "LeaveExportJob")
+    for name in LeaveExportJob.objects.exclude(file="").values_list("file", flat=True):
+        source = os.path.join(settings.MEDIA_ROOT, name)
+        if not os.path.exists(source):
+            continue
+        target = os.path.join(settings.PRIVATE_MEDIA_ROOT, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(source, target)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leave_app', '0020_private_import_files'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='leaveexportjob',
+            name='file',
+            field=models.FileField(blank=True, storage=leave_app.storage.PrivateStorage(), upload_to='leave_exports/'),
+        ),
+        migrations.RunPython(move_export_files, migrations.RunPython.noop),
+    ]
@@ -2,7 +2,11 @@ import os
 import uuid
 from django.utils import timezone
 from django.conf import settings
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+
+from .storage import private_storage
+
 
 class Department(models.Model):
     name = models.CharField(max_length=100)
@@ -24,10 +28,25 @@ class EmployeeProfile(models.Model):
         related_name="subordinates",
     )
     join_date = models.DateField(null=True, blank=True)
+    # รหัส + username + ชื่อ + นามสกุล ตัวพิมพ์เล็ก ใช้ค้นหาในหน้ารายชื่อพนักงาน (อัปเดตผ่าน signals)
+    search_text = models.TextField(blank=True, default="", editable=False)
 
     def __str__(self):
         return f"{self.employee_code} - {self.user.get_full_name() or self.user.username}"
 
+    def clean(self):
+        # ฟอร์มและหน้า admin แจ้ง error ที่ช่องหัวหน้าแทนการล้มตอน save
+        from .hierarchy import ORG_CYCLE_MESSAGE, would_create_cycle
+
+        if self.user_id and would_create_cycle(self.user_id, self.manager_id):
+            raise ValidationError({"manager": ORG_CYCLE_MESSAGE})
+
+    def save(self, *args, **kwargs):
+        # signals ย้ายสายงานใน OrgClosure ด้วย hierarchy.set_manager ใน transaction เดียวกัน
+        # ถ้าตั้งหัวหน้าแล้ววน (ValidationError) แถวนี้จะถูก rollback ไปด้วย
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
 
 class LeaveType(models.Model):
     name = models.CharField(max_length=50)
@@ -51,6 +70,10 @@ class LeaveBalance(models.Model):
 
     class Meta:
         unique_together = ("employee", "leave_type", "year")
+        indexes = [
+            # โควต้าของพนักงานหนึ่งคนในปีหนึ่ง (dashboard พนักงาน / หน้าจัดการโควต้า)
+            models.Index(fields=["employee", "year"], name="leave_bal_emp_year_idx"),
+        ]
 
     @property
     def remaining(self):
@@ -68,6 +91,16 @@ class Holiday(models.Model):
     def __str__(self):
         return f"{self.date} - {self.name}"
 
+
+class DataVersion(models.Model):
+    """ตัวนับเวอร์ชันของข้อมูล ใช้บอก worker อื่น ๆ ว่า cache ในหน่วยความจำหมดอายุแล้ว"""
+
+    key = models.CharField(max_length=50, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.key} v{self.version}"
+
 def leave_attachment_upload_to(instance, filename):
     _, ext = os.path.splitext(filename)
     ext = ext.lower()
@@ -99,7 +132,8 @@ class LeaveRequest(models.Model):
         (STATUS_CANCELLED, "Cancelled"),
     ]
 
-    employee = models.ForeignKey(EmployeeProfile, on_delete=models.CASCADE)
+    # index ของ FK ซ้ำกับ leave_emp_status_dates_idx ที่ขึ้นต้นด้วย employee อยู่แล้ว
+    employee = models.ForeignKey(EmployeeProfile, on_delete=models.CASCADE, db_index=False)
     leave_type = models.ForeignKey(LeaveType, on_delete=models.PROTECT)
     start_date = models.DateField()
     end_date = models.DateField()
@@ -121,12 +155,273 @@ class LeaveRequest(models.Model):
         related_name="approved_leaves",
     )
     approve_comment = models.TextField(blank=True)
+    # จำนวนวันลาที่คำนวณไว้ตอนยื่น (None = ยังไม่ได้คำนวณ)
+    total_days = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     cancelled_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # ทุก query ที่กรองด้วยพนักงาน: ตรวจวันลาซ้อน (validate_leave_request / bulk_decide_leave_requests)
+            # คำขอ pending ของลูกน้อง รายการของพนักงานหนึ่งคน (แถวต่อคนมีไม่มาก เรียงหลังดึงได้)
+            models.Index(
+                fields=["employee", "status", "start_date", "end_date"],
+                name="leave_emp_status_dates_idx",
+            ),
+            # รายการทั้งหมดของ HR (keyset บน created_at, id)
+            models.Index(fields=["-created_at", "-id"], name="leave_created_idx"),
+            # KPI ตามสถานะในช่วงวันที่ / ตาราง upcoming ของ CEO
+            models.Index(fields=["status", "start_date"], name="leave_status_start_idx"),
+            # start_date__year ของ dashboard (Django แปลงเป็นช่วง BETWEEN)
+            models.Index(fields=["start_date"], name="leave_start_date_idx"),
+            # เฉพาะคำขอที่อนุมัติแล้ว ตามช่วงวันที่ (ใครลาอยู่บ้างในช่วงนี้)
+            models.Index(
+                fields=["start_date", "end_date"],
+                name="leave_approved_dates_idx",
+                condition=models.Q(status="APPROVED"),
+            ),
+        ]
+
+
+class LeaveDayAllocation(models.Model):
+    """จำนวนวันลาของคำขอหนึ่งใบ แยกตามปี (คำขอข้ามปีจะมีหลายแถว)"""
+
+    leave_request = models.ForeignKey(
+        LeaveRequest,
+        on_delete=models.CASCADE,
+        related_name="allocations",
+    )
+    year = models.PositiveIntegerField()
+    days = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ("leave_request", "year")
+
+    def __str__(self):
+        return f"{self.leave_request_id} - {self.year}: {self.days}"
+
+
+class EmailOutbox(models.Model):
+    """อีเมลที่รอส่ง เขียนใน transaction เดียวกับการเปลี่ยนสถานะ แล้วให้ worker ส่งทีหลัง"""
+
+    STATUS_PENDING = "PENDING"
+    STATUS_SENT = "SENT"
+    STATUS_DEAD = "DEAD"
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "Pending"),
+        (STATUS_SENT, "Sent"),
+        (STATUS_DEAD, "Dead"),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True)
+    to = models.JSONField(default=list)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"]),
+        ]
+
+    def __str__(self):
+        return f"[{self.status}] {self.subject}"
+
+
+class EmployeeImportJob(models.Model):
+    """งานนำเข้าพนักงานจากไฟล์ Excel ที่ให้ worker (`run_import_jobs`) ประมวลผลเบื้องหลัง"""
+
+    STATUS_PENDING = "PENDING"
+    STATUS_RUNNING = "RUNNING"
+    STATUS_DONE = "DONE"
+    STATUS_FAILED = "FAILED"
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    # มีคอลัมน์รหัสผ่าน → เก็บนอก MEDIA_ROOT และลบเมื่อ job เสร็จ (employee_import)
+    file = models.FileField(upload_to="employee_imports/", storage=private_storage, blank=True)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="employee_import_jobs",
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+
+    total_rows = models.PositiveIntegerField(null=True, blank=True)
+    # checkpoint: เลขแถวสุดท้ายในไฟล์ที่ commit แล้ว (แถวหัวตาราง = 1)
+    last_row = models.PositiveIntegerField(default=1)
+    processed = models.PositiveIntegerField(default=0)
+    created_count = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    error_message = models.TextField(blank=True)
+
+    # ใช้คำนวณความเร็ว / ETA ของรอบที่กำลังรัน และตรวจว่า worker ตายกลางทาง
+    run_started_at = models.DateTimeField(null=True, blank=True)
+    run_start_row = models.PositiveIntegerField(default=1)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    @property
+    def rows_done(self):
+        return self.last_row - 1
+
+    @property
+    def rows_per_second(self):
+        if not self.run_started_at or self.status != self.STATUS_RUNNING:
+            return None
+        elapsed = (timezone.now() - self.run_started_at).total_seconds()
+        rows = self.last_row - self.run_start_row
+        if elapsed <= 0 or rows <= 0:
+            return None
+        return rows / elapsed
+
+    @property
+    def eta_seconds(self):
+        rate = self.rows_per_second
+        if not rate or self.total_rows is None:
+            return None
+        return max(self.total_rows - self.rows_done, 0) / rate
+
+    def __str__(self):
+        return f"[{self.status}] import #{self.pk} ({self.rows_done}/{self.total_rows or '?'})"
+
+
+class UserSession(models.Model):
+    """จับคู่ user กับ session key (อัปเดตตอน login / logout / เปลี่ยน key ผ่าน UserSessionMiddleware) ใช้ลบ session ของ user คนเดียวโดยไม่ต้องไล่ decode ทุก session"""
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="login_sessions",
+    )
+    session_key = models.CharField(max_length=40, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.user_id} - {self.session_key}"
+
+
+class LeaveExportJob(models.Model):
+    """งานส่งออกคำขอลาเป็น Excel ที่มีจำนวนแถวเกินกว่าจะสร้างในคำขอ HTTP ให้ worker (`run_export_jobs`) สร้างไฟล์เบื้องหลัง"""
+
+    STATUS_PENDING = "PENDING"
+    STATUS_RUNNING = "RUNNING"
+    STATUS_DONE = "DONE"
+    STATUS_FAILED = "FAILED"
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="leave_export_jobs",
+    )
+    # ตัวกรองจากหน้า HR dashboard (status / department / leave_type / employee / date_from / date_to)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    # ข้อมูลคำขอลาทั้งองค์กร → เก็บนอก MEDIA_ROOT ดาวน์โหลดได้ทาง hr_export_job_download เท่านั้น
+    file = models.FileField(upload_to="leave_exports/", storage=private_storage, blank=True)
+    row_count = models.PositiveIntegerField(null=True, blank=True)
+    error_message = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    @property
+    def filename(self):
+        # ชื่อไฟล์ที่เก็บจริงเป็นชื่อสุ่ม ชื่อนี้ใช้ตอนดาวน์โหลด
+        return f"leave_requests_{self.created_at:%Y%m%d_%H%M%S}_{self.pk}.xlsx" if self.file else ""
+
+    def __str__(self):
+        return f"[{self.status}] export #{self.pk} ({self.row_count or '?'} rows)"
+
+
+class LeaveStatsRollup(models.Model):
+    """
+    จำนวนคำขอลาและวันลารวม แยกตาม (ปีและเดือนของวันเริ่ม, แผนก, ประเภท, สถานะ)
+    อัปเดตทีละรายการตอนคำขอถูกสร้าง / เปลี่ยนสถานะ (leave_app.rollups) สร้างใหม่ทั้งปีได้ด้วย `rebuild_leave_rollups`
+    """
+
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    department = models.ForeignKey(
+        Department, on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    leave_type = models.ForeignKey(LeaveType, on_delete=models.CASCADE, related_name="+")
+    status = models.CharField(max_length=20, choices=LeaveRequest.STATUS_CHOICES)
+    request_count = models.IntegerField(default=0)
+    total_days = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            # แถวที่ไม่มีแผนก (NULL) ก็ห้ามซ้ำ
+            models.UniqueConstraint(
+                fields=["year", "month", "department", "leave_type", "status"],
+                name="leave_rollup_unique",
+                nulls_distinct=False,
+            ),
+        ]
+
+    def __str__(self):
+        return (
+            f"{self.year}-{self.month:02d} dept={self.department_id} type={self.leave_type_id} "
+            f"{self.status}: {self.request_count} ({self.total_days} days)"
+        )
+
+
+class OrgClosure(models.Model):
+    """
+    closure table ของสายบังคับบัญชา (EmployeeProfile.manager) ทุกคู่ (หัวหน้าทุกระดับ, ลูกน้อง)
+    depth 0 = ตัวเอง, 1 = ลูกน้องโดยตรง, 2 = ลูกน้องของลูกน้อง ...
+    ดูแลผ่าน leave_app.hierarchy (signals เรียกเมื่อ manager เปลี่ยน) สร้างใหม่ได้ด้วย `rebuild_org_closure`
+    """
+
+    ancestor = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="org_descendants"
+    )
+    descendant = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="org_ancestors"
+    )
+    depth = models.PositiveSmallIntegerField()
+
+    class Meta:
+        unique_together = ("ancestor", "descendant")
+        indexes = [
+            # ลูกน้องทุกระดับ / ไม่เกิน n ระดับของหัวหน้าหนึ่งคน
+            models.Index(fields=["ancestor", "depth", "descendant"], name="org_ancestor_depth_idx"),
+        ]
 
     def __str__(self):
-        return f"[{self.status}] {self.employee} {self.start_date} - {self.end_date}"
+        return f"{self.ancestor_id} -> {self.descendant_id} ({self.depth})"
@@ -0,0 +1,128 @@
+"""
+แบ่งหน้าแบบ keyset (cursor) เรียงจากใหม่ไปเก่าตาม (field, id)
+
+ไม่ใช้ OFFSET จึงใช้เวลาเท่ากันไม่ว่าจะอยู่หน้าไหนหรือตารางใหญ่แค่ไหน
+cursor คือค่าของแถวสุดท้าย/แรกของหน้าปัจจุบัน ส่งผ่าน query string เป็น ?after=... / ?before=...
+หลายรายการในหน้าเดียวกันใช้ prefix แยก cursor ของแต่ละรายการ (เช่น ?pending_after=...)
+"""
+import base64
+from dataclasses import dataclass
+from datetime import datetime
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+PAGE_SIZE_CHOICES = (25, 50, 100, 200)
+DEFAULT_PAGE_SIZE = 50
+# นับจำนวนแถวสูงสุดเท่านี้ เกินกว่านั้นแสดงเป็น "1,000+"
+COUNT_CAP = 1000
+
+
+def get_page_size(params, default: int = DEFAULT_PAGE_SIZE) -> int:
+    try:
+        size = int(params.get("page_size") or default)
+    except (TypeError, ValueError):
+        return default
+    return size if size in PAGE_SIZE_CHOICES else default
+
+
+def encode_cursor(value: datetime, pk: int) -> str:
+    raw = f"{value.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str):
+    """คืน (datetime, pk) หรือ None ถ้า cursor ไม่ถูกต้อง"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        value, pk = raw.rsplit("|", 1)
+        value, pk = datetime.fromisoformat(value), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    # encode_cursor ใส่ timezone เสมอ ค่าที่ไม่มีคือ cursor ที่ถูกแก้มา
+    if settings.USE_TZ and timezone.is_naive(value):
+        return None
+    return value, pk
+
+
+def capped_count(qs, cap: int = COUNT_CAP) -> tuple[int, bool]:
+    """นับแถวได้ไม่เกิน cap (COUNT บน subquery ที่ LIMIT ไว้) คืน (จำนวน, เกิน cap หรือไม่)"""
+    count = qs.order_by().values("pk")[:cap + 1].count()
+    return min(count, cap), count > cap
+
+
+@dataclass
+class KeysetPage:
+    items: list
+    page_size: int
+    next_cursor: str | None
+    prev_cursor: str | None
+    prefix: str = ""
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.prev_cursor is not None
+
+    def url_params(self, params, **extra) -> str:
+        """query string ของหน้าอื่น โดยคงตัวกรองเดิมไว้ (ตัด after / before เดิมของรายการนี้ออก)"""
+        own = (f"{self.prefix}after", f"{self.prefix}before")
+        kept = [
+            (key, value)
+            for key in params
+            if key not in own
+            for value in params.getlist(key)
+            if value
+        ]
+        return urlencode(kept + [(f"{self.prefix}{k}", v) for k, v in extra.items() if v])
+
+    def next_query(self, params) -> str:
+        return self.url_params(params, after=self.next_cursor)
+
+    def previous_query(self, params) -> str:
+        return self.url_params(params, before=self.prev_cursor)
+
+
+def keyset_paginate(
+    qs, params, field: str = "created_at", page_size: int | None = None, prefix: str = ""
+) -> KeysetPage:
+    """
+    หน้าหนึ่งของ qs เรียงตาม (-field, -id)
+    params: request.GET (อ่าน <prefix>after / <prefix>before / page_size)
+    """
+    page_size = page_size or get_page_size(params)
+    after = decode_cursor(params.get(f"{prefix}after"))
+    before = decode_cursor(params.get(f"{prefix}before")) if after is None else None
+
+    if before is not None:
+        value, pk = before
+        rows = list(
+            qs.filter(Q(**{f"{field}__gt": value}) | Q(**{field: value, "id__gt": pk}))
+            .order_by(field, "id")[:page_size + 1]
+        )
+        has_more = len(rows) > page_size
+        items = rows[:page_size][::-1]
+        has_prev, has_next = has_more, True
+    else:
+        if after is not None:
+            value, pk = after
+            qs = qs.filter(Q(**{f"{field}__lt": value}) | Q(**{field: value, "id__lt": pk}))
+        rows = list(qs.order_by(f"-{field}", "-id")[:page_size + 1])
+        items = rows[:page_size]
+        has_next, has_prev = len(rows) > page_size, after is not None
+
+    next_cursor = prev_cursor = None
+    if items and has_next:
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, field), last.pk)
+    if items and has_prev:
+        first = items[0]
+        prev_cursor = encode_cursor(getattr(first, field), first.pk)
+    return KeysetPage(items, page_size, next_cursor, prev_cursor, prefix)
@@ -0,0 +1,61 @@
+"""
+ตรวจบทบาท (group) ของผู้ใช้โดยไม่ query ซ้ำ
+
+- โหลดชื่อ group ของผู้ใช้ครั้งเดียวต่อ request แล้วจำไว้บน request.user (RoleMiddleware)
+- เก็บใน cache ต่อผู้ใช้ด้วย request ถัดไปจึงไม่ต้อง query เลย
+  ลบ cache เมื่อสมาชิก group เปลี่ยน / group ถูกแก้ชื่อหรือลบ (signals.py)
+- cache แบบ LocMem ลบได้เฉพาะใน process ที่เกิดการเปลี่ยน process อื่นยังเห็นสิทธิ์เก่าได้จนหมดอายุ
+  จึงเก็บแค่ไม่กี่วินาที ถ้าทุก process ใช้ cache ชุดเดียวกัน (CACHE_DIR / Redis) การลบมีผลทันทีจึงเก็บได้นาน
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+ROLE_HR = "HR"
+ROLE_MANAGER = "MANAGER"
+ROLE_CEO = "CEO"
+
+
+
+def role_cache_timeout() -> int:
+    """ROLE_CACHE_TIMEOUT จาก settings (อ่านทุกครั้ง override_settings จึงมีผล)"""
+    local = settings.CACHES["default"]["BACKEND"].endswith(".LocMemCache")
+    return getattr(settings, "ROLE_CACHE_TIMEOUT", 5 if local else 300)
+
+
+def _cache_key(user_id) -> str:
+    return f"user_groups:{user_id}"
+
+
+def user_group_names(user) -> frozenset[str]:
+    """ชื่อ group ทั้งหมดของ user (0 query ถ้าอยู่ใน cache, 1 query ถ้าไม่อยู่)"""
+    if not user.is_authenticated:
+        return frozenset()
+    names = getattr(user, "_group_names", None)
+    if names is None:
+        names = cache.get(_cache_key(user.pk))
+        if names is None:
+            names = frozenset(user.groups.values_list("name", flat=True))
+            cache.set(_cache_key(user.pk), names, role_cache_timeout())
+        user._group_names = names
+    return names
+
+
+def has_role(user, group_name: str) -> bool:
+    return group_name in user_group_names(user)
+
+
+def forget_user_roles(user_ids):
+    """ล้าง cache บทบาทของผู้ใช้เหล่านี้ (เรียกเมื่อ group membership เปลี่ยน)"""
+    cache.delete_many([_cache_key(pk) for pk in user_ids])
+
+
+class RoleMiddleware:
+    """แนบ request.roles (ชื่อ group ของผู้ใช้) ที่โหลดครั้งเดียวเมื่อถูกใช้ครั้งแรก"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.roles = SimpleLazyObject(lambda: user_group_names(request.user))
+        return self.get_response(request)
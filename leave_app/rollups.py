@@ -0,0 +1,179 @@
+"""
+ดูแลตารางสรุป LeaveStatsRollup ให้ตรงกับ LeaveRequest
+
+- คำขอหนึ่งใบนับ 1 คำขอ + total_days ของมัน ในแถว (ปี, เดือนของ start_date, แผนกของพนักงาน, ประเภท, สถานะ)
+- save() / delete() ของ LeaveRequest อัปเดตผ่าน signals ส่วนทางที่ใช้ update() / bulk_update
+  (เปลี่ยนสถานะ, บันทึกวันลา, คำนวณใหม่) เรียกฟังก์ชันในไฟล์นี้เอง
+- ถ้าข้อมูลคลาด (เช่น แก้ DB ตรง ๆ) ใช้คำสั่ง `rebuild_leave_rollups` สร้างใหม่จาก LeaveRequest
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Coalesce, ExtractMonth, ExtractYear
+
+from .models import EmployeeProfile, LeaveRequest, LeaveStatsRollup
+
+ZERO = Decimal("0")
+
+
+def _department_id(leave: LeaveRequest):
+    if LeaveRequest.employee.is_cached(leave):
+        return leave.employee.department_id
+    return (
+        EmployeeProfile.objects.filter(pk=leave.employee_id)
+        .values_list("department_id", flat=True)
+        .first()
+    )
+
+
+def rollup_key(leave: LeaveRequest, status: str | None = None, department_id=None) -> tuple:
+    """(year, month, department_id, leave_type_id, status) ของคำขอ"""
+    if department_id is None:
+        department_id = _department_id(leave)
+    return (
+        leave.start_date.year,
+        leave.start_date.month,
+        department_id,
+        leave.leave_type_id,
+        status or leave.status,
+    )
+
+
+class RollupDeltas:
+    """สะสมการเปลี่ยนแปลงหลายรายการ แล้วเขียนครั้งเดียวต่อแถวของ rollup"""
+
+    def __init__(self):
+        self.changes: dict[tuple, list] = defaultdict(lambda: [0, ZERO])
+
+    def add(self, key: tuple, count: int = 0, days=ZERO):
+        change = self.changes[key]
+        change[0] += count
+        change[1] += days or ZERO
+
+    def apply(self):
+        for key, (count, days) in self.changes.items():
+            if count or days:
+                _bump(key, count, days)
+        self.changes.clear()
+
+
+def _bump(key: tuple, count: int, days: Decimal):
+    year, month, department_id, leave_type_id, status = key
+    lookup = {
+        "year": year,
+        "month": month,
+        "department_id": department_id,
+        "leave_type_id": leave_type_id,
+        "status": status,
+    }
+    for _ in range(2):
+        # คีย์ไม่ซ้ำตาม leave_rollup_unique (รวมแถวที่แผนกเป็น NULL)
+        pk = LeaveStatsRollup.objects.filter(**lookup).values_list("pk", flat=True).first()
+        if pk is not None:
+            LeaveStatsRollup.objects.filter(pk=pk).update(
+                request_count=F("request_count") + count,
+                total_days=F("total_days") + days,
+            )
+            return
+        try:
+            with transaction.atomic():
+                LeaveStatsRollup.objects.create(**lookup, request_count=count, total_days=days)
+            return
+        except IntegrityError:
+            # อีก transaction สร้างแถวนี้ไปก่อน → วนกลับไปอัปเดตแทน
+            continue
+
+
+def record_leave(leave: LeaveRequest, sign: int = 1):
+    """นับ (sign=1) หรือถอน (sign=-1) คำขอหนึ่งใบตามค่าปัจจุบันของมัน"""
+    deltas = RollupDeltas()
+    deltas.add(rollup_key(leave), sign, sign * (leave.total_days or ZERO))
+    deltas.apply()
+
+
+def record_status_change(leaves, old_status: str, new_status: str):
+    """ย้ายคำขอจากแถวสถานะเดิมไปแถวสถานะใหม่ (approve / reject / bulk)"""
+    deltas = RollupDeltas()
+    for leave in leaves:
+        days = leave.total_days or ZERO
+        department_id = _department_id(leave)
+        deltas.add(rollup_key(leave, old_status, department_id), -1, -days)
+        deltas.add(rollup_key(leave, new_status, department_id), 1, days)
+    deltas.apply()
+
+
+def record_days_change(changes):
+    """changes: [(leave, วันลาเดิม)] หลังบันทึก total_days ใหม่ (store_leave_days / recalculate_leave_days)"""
+    deltas = RollupDeltas()
+    for leave, old_days in changes:
+        diff = (leave.total_days or ZERO) - (old_days or ZERO)
+        if diff:
+            deltas.add(rollup_key(leave), 0, diff)
+    deltas.apply()
+
+
+def _grouped_requests(queryset):
+    return (
+        queryset.annotate(
+            rollup_year=ExtractYear("start_date"),
+            rollup_month=ExtractMonth("start_date"),
+        )
+        .values("rollup_year", "rollup_month", "employee__department_id", "leave_type_id", "status")
+        .annotate(
+            request_count=Count("id"),
+            total_days=Coalesce(Sum("total_days"), ZERO),
+        )
+        .order_by()
+    )
+
+
+def move_employee_rollups(employee_id: int, old_department_id, new_department_id):
+    """พนักงานย้ายแผนก → ย้ายยอดของคำขอทั้งหมดของเขาไปแผนกใหม่ (query เดียวต่อการย้าย)"""
+    deltas = RollupDeltas()
+    for row in _grouped_requests(LeaveRequest.objects.filter(employee_id=employee_id)):
+        base = (row["rollup_year"], row["rollup_month"])
+        tail = (row["leave_type_id"], row["status"])
+        deltas.add((*base, old_department_id, *tail), -row["request_count"], -row["total_days"])
+        deltas.add((*base, new_department_id, *tail), row["request_count"], row["total_days"])
+    deltas.apply()
+
+
+def merge_department_rollups(department_id: int):
+    """แผนกถูกลบ → ย้ายยอดของแผนกนี้ไปแถวที่ไม่มีแผนก (พนักงานของแผนกถูกตั้ง department = NULL ตาม FK)"""
+    rows = LeaveStatsRollup.objects.filter(department_id=department_id)
+    deltas = RollupDeltas()
+    for row in rows.values("year", "month", "leave_type_id", "status", "request_count", "total_days"):
+        key = (row["year"], row["month"], None, row["leave_type_id"], row["status"])
+        deltas.add(key, row["request_count"], row["total_days"])
+    rows.delete()
+    deltas.apply()
+
+
+def rebuild_leave_rollups(years=None) -> int:
+    """ลบแล้วสร้าง rollup ใหม่จาก LeaveRequest (years=None คือทุกปี) คืนจำนวนแถวที่สร้าง"""
+    requests = LeaveRequest.objects.all()
+    rollups = LeaveStatsRollup.objects.all()
+    if years:
+        requests = requests.filter(start_date__year__in=years)
+        rollups = rollups.filter(year__in=years)
+
+    with transaction.atomic():
+        rollups.delete()
+        created = LeaveStatsRollup.objects.bulk_create(
+            [
+                LeaveStatsRollup(
+                    year=row["rollup_year"],
+                    month=row["rollup_month"],
+                    department_id=row["employee__department_id"],
+                    leave_type_id=row["leave_type_id"],
+                    status=row["status"],
+                    request_count=row["request_count"],
+                    total_days=row["total_days"],
+                )
+                for row in _grouped_requests(requests)
+            ],
+            batch_size=1000,
+        )
+    return len(created)
@@ -1,25 +1,134 @@
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from itertools import groupby, islice
+
+from django.contrib.sessions.models import Session
 from django.core.exceptions import ValidationError
 from django.utils import timezone
-from datetime import timedelta
-from django.core.mail import send_mail
+from datetime import date, timedelta
+from django.core.mail import EmailMessage, get_connection
 from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F
 from decimal import Decimal
 
 
-from .models import LeaveRequest, LeaveBalance, Holiday, LeaveType, EmployeeProfile
+from .rollups import record_days_change, record_status_change
+from .models import (
+    DataVersion,
+    EmailOutbox,
+    EmployeeProfile,
+    Holiday,
+    LeaveBalance,
+    LeaveDayAllocation,
+    LeaveRequest,
+    LeaveType,
+    UserSession,
+)
+
+logger = logging.getLogger(__name__)
+
+HOLIDAY_VERSION_KEY = "holiday"
+# เปลี่ยนทุกครั้งที่ข้อมูลที่ CEO dashboard แสดงเปลี่ยน (คำขอลา / วันหยุด / พนักงาน / แผนก)
+DASHBOARD_VERSION_KEY = "dashboard"
+
+# ตรวจ version stamp ใน DB ไม่เกินทุก ๆ กี่วินาที (ให้ worker อื่นรู้ว่าวันหยุดเปลี่ยน)
+HOLIDAY_INDEX_CHECK_INTERVAL = getattr(settings, "HOLIDAY_INDEX_CHECK_INTERVAL", 60)
+
+LEAVE_OVERLAP_MESSAGE = "Leave request overlaps with existing leave."
+HALF_DAY_SAME_DATE_MESSAGE = "ถ้าลาครึ่งวันต้องเป็นวันเดียวกันทั้งวันเริ่มและสิ้นสุด"
+# exclusion constraint (btree_gist) บน PostgreSQL จาก migration 0014
+LEAVE_OVERLAP_CONSTRAINT = "leave_no_overlap"
+
+# จำนวนผลลัพธ์สูงสุดของช่องค้นหาพนักงาน (autocomplete)
+EMPLOYEE_AUTOCOMPLETE_LIMIT = getattr(settings, "EMPLOYEE_AUTOCOMPLETE_LIMIT", 20)
+# ฟิลด์ที่ค้นหาแบบขึ้นต้นด้วย (แต่ละฟิลด์มี index UPPER(...) text_pattern_ops บน PostgreSQL)
+EMPLOYEE_SEARCH_FIELDS = (
+    "employee_code",
+    "user__username",
+    "user__first_name",
+    "user__last_name",
+)
+
+_holiday_index_lock = threading.Lock()
+_holiday_index = {
+    "ordinals": [],      # ordinal ของ Holiday ที่ตรงกับวันจันทร์-ศุกร์ เรียงจากน้อยไปมาก
+    "version": None,     # version ที่โหลดมา (None = ยังไม่เคยโหลด / ถูก invalidate)
+    "checked_at": 0.0,   # เวลาล่าสุดที่เทียบ version กับ DB
+}
+
+
+def bump_data_version(key: str):
+    """เพิ่ม version ของข้อมูลชุด key ใน DB (ใช้ตอนข้อมูลเปลี่ยน)"""
+    updated = DataVersion.objects.filter(key=key).update(version=F("version") + 1)
+    if not updated:
+        _, created = DataVersion.objects.get_or_create(key=key, defaults={"version": 1})
+        if not created:
+            DataVersion.objects.filter(key=key).update(version=F("version") + 1)
+
+
+def get_data_version(key: str) -> int:
+    return (
+        DataVersion.objects.filter(key=key)
+        .values_list("version", flat=True)
+        .first()
+    ) or 0
+
+
+def invalidate_holiday_index():
+    """ล้าง index วันหยุดของ process นี้ ครั้งถัดไปจะโหลดจาก DB ใหม่"""
+    with _holiday_index_lock:
+        _holiday_index["version"] = None
+        _holiday_index["checked_at"] = 0.0
+
+
+def _get_holiday_ordinals() -> list[int]:
+    """
+    คืน list ของ ordinal วันหยุด (เฉพาะวันทำงาน) ที่เรียงแล้ว
+    - โหลดจาก DB ครั้งเดียวต่อ process
+    - เทียบ version stamp กับ DB ไม่เกินทุก HOLIDAY_INDEX_CHECK_INTERVAL วินาที
+    """
+    now = time.monotonic()
+    if (
+        _holiday_index["version"] is not None
+        and now - _holiday_index["checked_at"] < HOLIDAY_INDEX_CHECK_INTERVAL
+    ):
+        return _holiday_index["ordinals"]
+
+    with _holiday_index_lock:
+        version = get_data_version(HOLIDAY_VERSION_KEY)
+        if _holiday_index["version"] != version:
+            dates = Holiday.objects.order_by("date").values_list("date", flat=True)
+            _holiday_index["ordinals"] = [d.toordinal() for d in dates if d.weekday() < 5]
+            _holiday_index["version"] = version
+        _holiday_index["checked_at"] = now
+        return _holiday_index["ordinals"]
+
+
+def _weekdays_before(ordinal: int) -> int:
+    """จำนวนวันจันทร์-ศุกร์ ตั้งแต่ 0001-01-01 (วันจันทร์) จนถึงก่อนวัน ordinal"""
+    weeks, rest = divmod(ordinal - 1, 7)
+    return weeks * 5 + min(rest, 5)
+
+
+def _count_working_days(start_date, end_date, holiday_ordinals: list[int]) -> int:
+    """นับวันทำงานแบบรวมหัวท้าย ด้วยสูตร ไม่วนทีละวัน"""
+    if end_date < start_date:
+        return 0
+    start, end = start_date.toordinal(), end_date.toordinal()
+    weekdays = _weekdays_before(end + 1) - _weekdays_before(start)
+    holidays = bisect_right(holiday_ordinals, end) - bisect_left(holiday_ordinals, start)
+    return weekdays - holidays
+
 
 def calculate_working_days(start_date, end_date, half_day=False):
     """คำนวณวันทำงานระหว่างช่วงวันที่ (ตัดเสาร์อาทิตย์ + Holiday)"""
     if half_day:
         return Decimal("0.5")
 
-    days = Decimal("0")
-    current = start_date
-    while current <= end_date:
-        if current.weekday() < 5 and not Holiday.objects.filter(date=current).exists():
-            days += Decimal("1")
-        current += timedelta(days=1)
-    return days
+    return Decimal(_count_working_days(start_date, end_date, _get_holiday_ordinals()))
 
 def calculate_working_days_by_year(start_date, end_date, half_day=False):
     """
@@ -30,64 +139,96 @@ def calculate_working_days_by_year(start_date, end_date, half_day=False):
     """
     if half_day:
         if start_date != end_date:
-            raise ValidationError("ถ้าลาครึ่งวันต้องเป็นวันเดียวกันทั้งวันเริ่มและสิ้นสุด")
+            raise ValidationError(HALF_DAY_SAME_DATE_MESSAGE)
         return {start_date.year: Decimal("0.5")}
 
+    holiday_ordinals = _get_holiday_ordinals()
     days_by_year: dict[int, Decimal] = {}
-    current = start_date
-    while current <= end_date:
-        if current.weekday() < 5 and not Holiday.objects.filter(date=current).exists():
-            year = current.year
-            if year not in days_by_year:
-                days_by_year[year] = Decimal("0")
-            days_by_year[year] += Decimal("1")
-        current += timedelta(days=1)
+    for year in range(start_date.year, end_date.year + 1):
+        days = _count_working_days(
+            max(start_date, date(year, 1, 1)),
+            min(end_date, date(year, 12, 31)),
+            holiday_ordinals,
+        )
+        if days:
+            days_by_year[year] = Decimal(days)
     return days_by_year
 
 
-def validate_leave_request(employee_profile, leave_type, start_date, end_date, half_day=False, instance: LeaveRequest | None = None):
-    # 1) เช็กช่วงวันที่
+_overlap_constraint_exists: dict[str, bool] = {}
+
+
+def overlap_enforced_by_db(using: str = "default") -> bool:
+    """
+    ฐานข้อมูลมี constraint leave_no_overlap (migration 0014 บน PostgreSQL) กันคำขอลาซ้อนกันหรือไม่
+    ตรวจจาก catalog จริงครั้งเดียวต่อ connection alias ไม่ใช่แค่ดูชนิดฐานข้อมูล
+    """
+    if using not in _overlap_constraint_exists:
+        connection = connections[using]
+        exists = False
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT 1 FROM pg_constraint WHERE conname = %s AND conrelid = %s::regclass",
+                    [LEAVE_OVERLAP_CONSTRAINT, LeaveRequest._meta.db_table],
+                )
+                exists = cursor.fetchone() is not None
+        _overlap_constraint_exists[using] = exists
+    return _overlap_constraint_exists[using]
+
+
+def _is_overlap_violation(exc: IntegrityError) -> bool:
+    diag = getattr(exc.__cause__, "diag", None)
+    if getattr(diag, "constraint_name", None) == LEAVE_OVERLAP_CONSTRAINT:
+        return True
+    return LEAVE_OVERLAP_CONSTRAINT in str(exc)
+
+
+def save_leave_request(leave_request: LeaveRequest, **kwargs):
+    """
+    save() คำขอลา ถ้าชน constraint leave_no_overlap แปลงเป็น ValidationError ข้อความเดียวกับ validate_leave_request
+    save ใน savepoint เพื่อให้ transaction ของผู้เรียกใช้ต่อได้หลังชน constraint
+    """
+    try:
+        with transaction.atomic():
+            leave_request.save(**kwargs)
+    except IntegrityError as exc:
+        if _is_overlap_violation(exc):
+            raise ValidationError(LEAVE_OVERLAP_MESSAGE) from exc
+        raise
+
+
+def check_leave_rules(leave_type, start_date, end_date, half_day=False, today=None):
+    """เงื่อนไขของตัวคำขอเอง (ใช้ร่วมกันทั้ง validate_leave_request และ bulk_decide_leave_requests)"""
     if end_date < start_date:
         raise ValidationError("End date must be after start date.")
 
-    if start_date < timezone.now().date():
+    if start_date < (today or timezone.now().date()):
         raise ValidationError("Cannot request leave in the past.")
 
-    # 2) ประเภทนี้รองรับครึ่งวันไหม
     if half_day and not leave_type.allow_half_day:
         raise ValidationError("ประเภทการลานี้ไม่สามารถลาครึ่งวันได้")
 
-    # 3) เช็กซ้อนช่วงลาเดิม (pending / approved)
-    overlap_qs = LeaveRequest.objects.filter(
-        employee=employee_profile,
-        status__in=[LeaveRequest.STATUS_PENDING, LeaveRequest.STATUS_APPROVED],
-        start_date__lte=end_date,
-        end_date__gte=start_date,
-    )
+    if half_day and start_date != end_date:
+        raise ValidationError(HALF_DAY_SAME_DATE_MESSAGE)
 
-    # 👇 ถ้ามี instance (เช่น ตอน approve ใบนี้เอง) ให้ตัดตัวมันออกจาก query
-    if instance is not None:
-        overlap_qs = overlap_qs.exclude(pk=instance.pk)
 
-    if overlap_qs.exists():
-        raise ValidationError("Leave request overlaps with existing leave.")
+def check_no_overlap(start_date, end_date, active_leaves, exclude_pk=None):
+    """active_leaves: คำขอ pending / approved ของพนักงานคนเดียวกัน (queryset หรือ list)"""
+    for other in active_leaves:
+        if (
+            other.pk != exclude_pk
+            and other.start_date <= end_date
+            and other.end_date >= start_date
+        ):
+            raise ValidationError(LEAVE_OVERLAP_MESSAGE)
 
-    # 4) คำนวณจำนวนวันลา (แยกตามปี)
-    days_by_year = calculate_working_days_by_year(start_date, end_date, half_day)
 
-    # 5) ถ้าเป็นลาแบบไม่จ่ายเงิน (UNPAID) ไม่ต้องเช็กโควต้า
-    if not leave_type.is_paid:
-        return sum(days_by_year.values())
-
-    # 6) เช็กโควต้าต่อปี
+def check_leave_balance(leave_type, days_by_year: dict[int, Decimal], get_balance):
+    """get_balance(year) คืน LeaveBalance หรือ None"""
     for year, days in days_by_year.items():
-        try:
-            balance = LeaveBalance.objects.get(
-                employee=employee_profile,
-                leave_type=leave_type,
-                year=year,
-            )
-        except LeaveBalance.DoesNotExist:
+        balance = get_balance(year)
+        if balance is None:
             raise ValidationError(
                 f"No leave balance for {leave_type.name} in year {year}."
             )
@@ -98,13 +239,150 @@ def validate_leave_request(employee_profile, leave_type, start_date, end_date, h
                 f"(remaining {balance.remaining}, requested {days})"
             )
 
+
+def validate_leave_request(employee_profile, leave_type, start_date, end_date, half_day=False, instance: LeaveRequest | None = None, check_balance: bool = True):
+    # 1) เช็กช่วงวันที่ / ครึ่งวัน
+    check_leave_rules(leave_type, start_date, end_date, half_day)
+
+    # 2) เช็กซ้อนช่วงลาเดิม (pending / approved)
+    #    บน PostgreSQL ให้ exclusion constraint ตรวจตอน INSERT แทน (ดู save_leave_request)
+    if not overlap_enforced_by_db():
+        overlap_qs = LeaveRequest.objects.filter(
+            employee=employee_profile,
+            status__in=[LeaveRequest.STATUS_PENDING, LeaveRequest.STATUS_APPROVED],
+            start_date__lte=end_date,
+            end_date__gte=start_date,
+        )
+
+        # 👇 ถ้ามี instance (เช่น ตอน approve ใบนี้เอง) ให้ตัดตัวมันออกจาก query
+        if instance is not None:
+            overlap_qs = overlap_qs.exclude(pk=instance.pk)
+
+        check_no_overlap(start_date, end_date, overlap_qs.only("id", "start_date", "end_date")[:1])
+
+    # 3) คำนวณจำนวนวันลา (แยกตามปี)
+    days_by_year = calculate_working_days_by_year(start_date, end_date, half_day)
+
+    # 4) ถ้าเป็นลาแบบไม่จ่ายเงิน (UNPAID) ไม่ต้องเช็กโควต้า
+    #    (ตอน approve ไม่ต้องเช็กที่นี่ เพราะ deduct_leave_balance เช็กพร้อมหักใน UPDATE เดียว)
+    if not leave_type.is_paid or not check_balance:
+        return sum(days_by_year.values())
+
+    # 5) เช็กโควต้าต่อปี
+    check_leave_balance(
+        leave_type,
+        days_by_year,
+        lambda year: LeaveBalance.objects.filter(
+            employee=employee_profile, leave_type=leave_type, year=year
+        ).first(),
+    )
+
     return sum(days_by_year.values())
 
 
+def _half_day_split(leave_request: LeaveRequest) -> dict[int, Decimal]:
+    # ใบลาครึ่งวันที่บันทึกแล้วนับ 0.5 วันในปีของวันเริ่มเสมอ (เหมือน calculate_working_days)
+    return {leave_request.start_date.year: Decimal("0.5")}
+
+
+def store_leave_days(leave_request: LeaveRequest, days_by_year: dict[int, Decimal] | None = None):
+    """
+    บันทึกจำนวนวันลา (รวม + แยกตามปี) ลงใน LeaveRequest / LeaveDayAllocation
+    เรียกครั้งเดียวตอนยื่นคำขอ ที่เหลืออ่านค่าที่เก็บไว้
+    """
+    if days_by_year is None:
+        if leave_request.half_day:
+            days_by_year = _half_day_split(leave_request)
+        else:
+            days_by_year = calculate_working_days_by_year(
+                leave_request.start_date,
+                leave_request.end_date,
+            )
+
+    with transaction.atomic():
+        old_days = leave_request.total_days
+        leave_request.total_days = sum(days_by_year.values(), Decimal("0"))
+        LeaveRequest.objects.filter(pk=leave_request.pk).update(
+            total_days=leave_request.total_days
+        )
+        record_days_change([(leave_request, old_days)])
+        bump_data_version(DASHBOARD_VERSION_KEY)
+        leave_request.allocations.all().delete()
+        LeaveDayAllocation.objects.bulk_create(
+            [
+                LeaveDayAllocation(leave_request=leave_request, year=year, days=days)
+                for year, days in days_by_year.items()
+            ]
+        )
+
+
+def recalculate_leave_days(queryset, chunk_size: int = 500) -> int:
+    """
+    คำนวณวันลาใหม่ให้ทุกใบใน queryset (ใช้ตอน backfill และตอนวันหยุดเปลี่ยน)
+    ทำทีละ chunk: bulk_update total_days แล้วสร้าง allocation ใหม่ทั้งชุด
+    """
+    # total_days เดิม + คีย์ของ rollup ใช้คำนวณส่วนต่างวันลาใน LeaveStatsRollup
+    leaves = (
+        queryset.select_related("employee")
+        .only(
+            "id", "start_date", "end_date", "half_day", "total_days", "status",
+            "leave_type_id", "employee__department",
+        )
+        .order_by("pk")
+    )
+    updated = 0
+    chunk: list[LeaveRequest] = []
+
+    def flush():
+        allocations = []
+        old_days = [leave.total_days for leave in chunk]
+        for leave in chunk:
+            if leave.half_day:
+                days_by_year = _half_day_split(leave)
+            else:
+                days_by_year = calculate_working_days_by_year(leave.start_date, leave.end_date)
+            leave.total_days = sum(days_by_year.values(), Decimal("0"))
+            allocations.extend(
+                LeaveDayAllocation(leave_request=leave, year=year, days=days)
+                for year, days in days_by_year.items()
+            )
+        with transaction.atomic():
+            LeaveRequest.objects.bulk_update(chunk, ["total_days"])
+            LeaveDayAllocation.objects.filter(leave_request__in=chunk).delete()
+            LeaveDayAllocation.objects.bulk_create(allocations)
+            record_days_change(zip(chunk, old_days))
+            bump_data_version(DASHBOARD_VERSION_KEY)
+
+    for leave in leaves.iterator(chunk_size=chunk_size):
+        chunk.append(leave)
+        if len(chunk) >= chunk_size:
+            flush()
+            updated += len(chunk)
+            chunk = []
+    if chunk:
+        flush()
+        updated += len(chunk)
+
+    return updated
+
+
+def get_leave_days_by_year(leave_request: LeaveRequest) -> dict[int, Decimal]:
+    """อ่านวันลาแยกตามปีที่บันทึกไว้ ถ้ายังไม่เคยคำนวณจะคำนวณสด"""
+    if leave_request.total_days is not None:
+        return {a.year: a.days for a in leave_request.allocations.all()}
+    return calculate_working_days_by_year(
+        leave_request.start_date,
+        leave_request.end_date,
+        leave_request.half_day,
+    )
+
+
 def get_leave_days_for_request(leave_request: LeaveRequest) -> float:
     """
     คำนวณจำนวนวันลาสำหรับ leave_request ที่มีอยู่ (ใช้ตอน approve)
     """
+    if leave_request.total_days is not None:
+        return leave_request.total_days
     return calculate_working_days(
         leave_request.start_date,
         leave_request.end_date,
@@ -112,11 +390,59 @@ def get_leave_days_for_request(leave_request: LeaveRequest) -> float:
     )
 
 
+def deduct_leave_balance(employee_profile, leave_type, year: int, days: Decimal):
+    """
+    หักโควต้าแบบมีเงื่อนไขใน UPDATE เดียว:
+    UPDATE ... SET used = used + days WHERE allocated - used >= days
+    ไม่มีช่วงอ่าน-แล้ว-เขียน จึงไม่เกิด lost update เวลาอนุมัติพร้อมกัน
+    """
+    updated = LeaveBalance.objects.filter(
+        employee=employee_profile,
+        leave_type=leave_type,
+        year=year,
+        allocated__gte=F("used") + days,
+    ).update(used=F("used") + days)
+
+    if not updated:
+        exists = LeaveBalance.objects.filter(
+            employee=employee_profile,
+            leave_type=leave_type,
+            year=year,
+        ).exists()
+        if not exists:
+            raise ValidationError("ไม่พบ LeaveBalance สำหรับคำขอนี้")
+        raise ValidationError("โควต้าวันลาไม่เพียงพอ")
+
+
+def _set_leave_status(leave_request: LeaveRequest, status: str, approver, comment: str, error: str):
+    """
+    เปลี่ยนสถานะจาก Pending ด้วย UPDATE แบบมีเงื่อนไข
+    ถ้ามีอีกคน/อีกแท็บเปลี่ยนไปก่อนแล้ว จะอัปเดตไม่ได้และ raise ValidationError
+    คืนเวลาที่อัปเดต (ยังไม่แก้ค่าใน leave_request จนกว่าทั้ง transaction จะผ่าน)
+    """
+    now = timezone.now()
+    updated = LeaveRequest.objects.filter(
+        pk=leave_request.pk,
+        status=LeaveRequest.STATUS_PENDING,
+    ).update(
+        status=status,
+        approver=approver,
+        approve_comment=comment,
+        updated_at=now,
+    )
+    if not updated:
+        raise ValidationError(error)
+    record_status_change([leave_request], LeaveRequest.STATUS_PENDING, status)
+    bump_data_version(DASHBOARD_VERSION_KEY)
+    return now
+
+
 def approve_leave_request(leave_request: LeaveRequest, approver, comment: str = ""):
+    error = "อนุมัติได้เฉพาะคำขอที่อยู่ในสถานะ Pending เท่านั้น"
     if leave_request.status != LeaveRequest.STATUS_PENDING:
-        raise ValidationError("อนุมัติได้เฉพาะคำขอที่อยู่ในสถานะ Pending เท่านั้น")
+        raise ValidationError(error)
 
-    # validate อีกครั้ง กันกรณีโควต้า/ข้อมูลมีการเปลี่ยนระหว่างรออนุมัติ
+    # validate อีกครั้ง กันกรณีข้อมูลมีการเปลี่ยนระหว่างรออนุมัติ (โควต้าเช็กตอนหักด้านล่าง)
     validate_leave_request(
         leave_request.employee,
         leave_request.leave_type,
@@ -124,86 +450,371 @@ def approve_leave_request(leave_request: LeaveRequest, approver, comment: str =
         leave_request.end_date,
         leave_request.half_day,
         instance=leave_request,
+        check_balance=False,
     )
 
-    # คำนวณวันลาต่อปี (ใช้ฟังก์ชันใหม่)
-    days_by_year = calculate_working_days_by_year(
-        leave_request.start_date,
-        leave_request.end_date,
-        leave_request.half_day,
-    )
-
-    # ลาแบบไม่จ่ายเงิน → ไม่ยุ่งกับ LeaveBalance
-    if leave_request.leave_type.is_paid:
-        for year, days in days_by_year.items():
-            try:
-                balance = LeaveBalance.objects.get(
-                    employee=leave_request.employee,
-                    leave_type=leave_request.leave_type,
-                    year=year,
-                )
-            except LeaveBalance.DoesNotExist:
-                raise ValidationError("ไม่พบ LeaveBalance สำหรับคำขอนี้")
+    # วันลาต่อปี (ใช้ค่าที่บันทึกไว้ตอนยื่นคำขอ)
+    days_by_year = get_leave_days_by_year(leave_request)
 
-            if days > balance.remaining:
-                raise ValidationError("โควต้าวันลาไม่เพียงพอ")
-
-            balance.used += days
-            balance.save()
+    # เปลี่ยนสถานะ + หักโควต้าใน transaction เดียว ถ้าปีไหนไม่พอจะ rollback ทั้งหมด
+    with transaction.atomic():
+        updated_at = _set_leave_status(
+            leave_request, LeaveRequest.STATUS_APPROVED, approver, comment, error
+        )
 
-    # อัปเดตสถานะคำขอ
-    leave_request.status = LeaveRequest.STATUS_APPROVED
-    leave_request.approver = approver
-    leave_request.approve_comment = comment
-    leave_request.updated_at = timezone.now()
-    leave_request.save()
+        # ลาแบบไม่จ่ายเงิน → ไม่ยุ่งกับ LeaveBalance
+        if leave_request.leave_type.is_paid:
+            for year, days in days_by_year.items():
+                deduct_leave_balance(
+                    leave_request.employee, leave_request.leave_type, year, days
+                )
 
-    notify_leave_status_changed(leave_request)
+        leave_request.status = LeaveRequest.STATUS_APPROVED
+        leave_request.approver = approver
+        leave_request.approve_comment = comment
+        leave_request.updated_at = updated_at
+        notify_leave_status_changed(leave_request)
 
 
 def reject_leave_request(leave_request: LeaveRequest, approver, comment: str = ""):
     """
     ใช้ปฏิเสธคำขอลา (ไม่ยุ่งกับ balance)
     """
+    error = "ปฏิเสธได้เฉพาะคำขอที่อยู่ในสถานะ Pending เท่านั้น"
     if leave_request.status != LeaveRequest.STATUS_PENDING:
-        raise ValidationError("ปฏิเสธได้เฉพาะคำขอที่อยู่ในสถานะ Pending เท่านั้น")
+        raise ValidationError(error)
 
-    leave_request.status = LeaveRequest.STATUS_REJECTED
-    leave_request.approver = approver
-    leave_request.approve_comment = comment
-    leave_request.updated_at = timezone.now()
-    leave_request.save()
+    with transaction.atomic():
+        updated_at = _set_leave_status(
+            leave_request, LeaveRequest.STATUS_REJECTED, approver, comment, error
+        )
 
-    notify_leave_status_changed(leave_request)
-    
-def create_default_leave_balances(employee_profile: EmployeeProfile, year: int | None = None):
+        leave_request.status = LeaveRequest.STATUS_REJECTED
+        leave_request.approver = approver
+        leave_request.approve_comment = comment
+        leave_request.updated_at = updated_at
+        notify_leave_status_changed(leave_request)
+
+def _bulk_leave_error(leave: LeaveRequest, active_leaves, today) -> str | None:
+    """ตรวจเงื่อนไขเดียวกับ validate_leave_request (ยกเว้นโควต้า) ในหน่วยความจำ คืนข้อความ error หรือ None"""
+    if leave.status != LeaveRequest.STATUS_PENDING:
+        return "อนุมัติได้เฉพาะคำขอที่อยู่ในสถานะ Pending เท่านั้น"
+    try:
+        check_leave_rules(leave.leave_type, leave.start_date, leave.end_date, leave.half_day, today)
+        check_no_overlap(
+            leave.start_date, leave.end_date, active_leaves.get(leave.employee_id, []), leave.pk
+        )
+    except ValidationError as exc:
+        return exc.messages[0]
+    return None
+
+
+def bulk_decide_leave_requests(leave_ids, approver, action: str, comment: str = "") -> list[dict]:
+    """
+    อนุมัติ / ปฏิเสธหลายคำขอใน transaction เดียว
+    - lock คำขอและ LeaveBalance ที่เกี่ยวข้อง (โหลด balance ทั้งหมดใน query เดียว)
+    - ตรวจเงื่อนไขและโควต้าในหน่วยความจำ (หลายใบของคนเดียวกันหักจากยอดเดียวกันต่อเนื่อง)
+    - เขียนกลับด้วย bulk_update
+    คืน list ของ {"leave": ..., "ok": bool, "message": str} ตามลำดับคำขอ
+    """
+    if action not in ("approve", "reject"):
+        raise ValidationError("คำสั่งไม่ถูกต้อง")
+
+    leave_ids = list(leave_ids)
+    results: list[dict] = []
+    decided: list[LeaveRequest] = []
+
+    with transaction.atomic():
+        locked = (
+            LeaveRequest.objects.select_for_update(of=("self",))
+            .select_related("employee__user", "leave_type")
+            .prefetch_related("allocations")
+            .filter(pk__in=leave_ids)
+            .order_by("pk")
+        )
+        leaves_by_id = {leave.pk: leave for leave in locked}
+        leaves = [leaves_by_id[pk] for pk in leave_ids if pk in leaves_by_id]
+        now = timezone.now()
+
+        if action == "reject":
+            for leave in leaves:
+                if leave.status != LeaveRequest.STATUS_PENDING:
+                    results.append({"leave": leave, "ok": False,
+                                    "message": "ปฏิเสธได้เฉพาะคำขอที่อยู่ในสถานะ Pending เท่านั้น"})
+                    continue
+                decided.append(leave)
+                results.append({"leave": leave, "ok": True, "message": "ปฏิเสธคำขอลาเรียบร้อยแล้ว"})
+            new_status = LeaveRequest.STATUS_REJECTED
+        else:
+            today = now.date()
+            pending = [leave for leave in leaves if leave.status == LeaveRequest.STATUS_PENDING]
+
+            # คำขอ pending / approved ของพนักงานกลุ่มนี้ สำหรับเช็กช่วงซ้อนในหน่วยความจำ
+            active_leaves: dict[int, list[LeaveRequest]] = {}
+            if pending:
+                for other in LeaveRequest.objects.filter(
+                    employee_id__in={leave.employee_id for leave in pending},
+                    status__in=[LeaveRequest.STATUS_PENDING, LeaveRequest.STATUS_APPROVED],
+                    start_date__lte=max(leave.end_date for leave in pending),
+                    end_date__gte=min(leave.start_date for leave in pending),
+                ).only("id", "employee_id", "start_date", "end_date"):
+                    active_leaves.setdefault(other.employee_id, []).append(other)
+
+            days_by_leave = {}
+            for leave in pending:
+                if leave.total_days is not None:
+                    days_by_leave[leave.pk] = {a.year: a.days for a in leave.allocations.all()}
+                elif leave.half_day:
+                    days_by_leave[leave.pk] = _half_day_split(leave)
+                else:
+                    days_by_leave[leave.pk] = calculate_working_days_by_year(
+                        leave.start_date, leave.end_date
+                    )
+
+            # LeaveBalance ทั้งหมดที่เกี่ยวข้องใน query เดียว
+            balances = {
+                (b.employee_id, b.leave_type_id, b.year): b
+                for b in LeaveBalance.objects.select_for_update().filter(
+                    employee_id__in={leave.employee_id for leave in pending},
+                    leave_type_id__in={leave.leave_type_id for leave in pending},
+                    year__in={y for split in days_by_leave.values() for y in split},
+                ).order_by("pk")  # lock ตามลำดับเดียวกันทุก transaction กัน deadlock
+            }
+            touched_balances: dict[int, LeaveBalance] = {}
+
+            for leave in leaves:
+                error = _bulk_leave_error(leave, active_leaves, today)
+                days_by_year = days_by_leave.get(leave.pk, {})
+
+                if error is None and leave.leave_type.is_paid:
+                    try:
+                        check_leave_balance(
+                            leave.leave_type,
+                            days_by_year,
+                            lambda year: balances.get((leave.employee_id, leave.leave_type_id, year)),
+                        )
+                    except ValidationError as exc:
+                        error = exc.messages[0]
+
+                if error is not None:
+                    results.append({"leave": leave, "ok": False, "message": error})
+                    continue
+
+                if leave.leave_type.is_paid:
+                    for year, days in days_by_year.items():
+                        balance = balances[(leave.employee_id, leave.leave_type_id, year)]
+                        balance.used += days
+                        touched_balances[balance.pk] = balance
+
+                decided.append(leave)
+                results.append({"leave": leave, "ok": True, "message": "อนุมัติคำขอลาเรียบร้อยแล้ว"})
+
+            LeaveBalance.objects.bulk_update(touched_balances.values(), ["used"])
+            new_status = LeaveRequest.STATUS_APPROVED
+
+        for leave in decided:
+            leave.status = new_status
+            leave.approver = approver
+            leave.approve_comment = comment
+            leave.updated_at = now
+        LeaveRequest.objects.bulk_update(
+            decided, ["status", "approver", "approve_comment", "updated_at"]
+        )
+        record_status_change(decided, LeaveRequest.STATUS_PENDING, new_status)
+        if decided:
+            bump_data_version(DASHBOARD_VERSION_KEY)
+
+        for leave in decided:
+            notify_leave_status_changed(leave)
+
+    return results
+
+
+def provision_leave_balances(
+    year: int | None = None,
+    employee_ids=None,
+    leave_types=None,
+    chunk_size: int = 1000,
+) -> int:
+    """
+    สร้าง LeaveBalance ที่ยังขาดของ (พนักงาน, ประเภทการลา, ปี) แบบทั้งชุด
+    - employee_ids=None → พนักงานทุกคน, leave_types=None → ทุกประเภท
+    - ทำทีละ chunk ของพนักงาน: ดึงคู่ที่มีอยู่แล้ว 1 query แล้ว bulk_create ส่วนที่ขาด
+      ถ้าชนกับอีก process ที่สร้างซ้อนพร้อมกัน ทำ chunk นั้นใหม่ทีละแถวด้วย get_or_create
+    คืนจำนวนแถวที่ process นี้สร้างจริง
+    """
     if year is None:
         year = timezone.now().year
+    if leave_types is None:
+        leave_types = list(LeaveType.objects.all())
+    if not leave_types:
+        return 0
+    if employee_ids is None:
+        employee_ids = EmployeeProfile.objects.order_by("pk").values_list("pk", flat=True).iterator(
+            chunk_size=chunk_size
+        )
 
-    leave_types = LeaveType.objects.all()
-    for lt in leave_types:
-        LeaveBalance.objects.get_or_create(
-            employee=employee_profile,
-            leave_type=lt,
-            year=year,
-            defaults={
-                "allocated": lt.default_allocation,
-                "used": 0,
-            },
+    created = 0
+    it = iter(employee_ids)
+    while chunk := list(islice(it, chunk_size)):
+        existing = set(
+            LeaveBalance.objects.filter(
+                employee_id__in=chunk,
+                leave_type__in=leave_types,
+                year=year,
+            ).values_list("employee_id", "leave_type_id")
         )
-        
+        missing = [
+            LeaveBalance(
+                employee_id=employee_id,
+                leave_type=lt,
+                year=year,
+                allocated=lt.default_allocation,
+                used=0,
+            )
+            for employee_id in chunk
+            for lt in leave_types
+            if (employee_id, lt.pk) not in existing
+        ]
+        try:
+            with transaction.atomic():
+                LeaveBalance.objects.bulk_create(missing)
+            created += len(missing)
+        except IntegrityError:
+            # บางแถวถูกสร้างไปก่อนแล้ว (ignore_conflicts จะนับเกิน) นับเฉพาะแถวที่สร้างเองจริง
+            for balance in missing:
+                _, was_created = LeaveBalance.objects.get_or_create(
+                    employee_id=balance.employee_id,
+                    leave_type_id=balance.leave_type_id,
+                    year=year,
+                    defaults={"allocated": balance.allocated, "used": 0},
+                )
+                created += was_created
+    return created
+
+
+# ประเภทการลาใหม่สร้างโควต้าให้ทุกคนทันทีเฉพาะองค์กรที่พนักงานไม่เกินจำนวนนี้
+# มากกว่านี้ให้ HR กด "สร้างโควต้า" ในหน้าจัดการโควต้า หรือรัน `provision_leave_balances`
+LEAVE_TYPE_SYNC_PROVISION_MAX_EMPLOYEES = getattr(
+    settings, "LEAVE_TYPE_SYNC_PROVISION_MAX_EMPLOYEES", 2000
+)
+
+
+def provision_new_leave_type(leave_type: LeaveType) -> int | None:
+    """สร้างโควต้าปีปัจจุบันของประเภทการลาใหม่ให้ทุกคน คืน None ถ้าพนักงานมากเกินจะทำใน request"""
+    limit = LEAVE_TYPE_SYNC_PROVISION_MAX_EMPLOYEES
+    if EmployeeProfile.objects.order_by()[limit:limit + 1].exists():
+        logger.warning(
+            "ข้ามการสร้างโควต้าของ %s (พนักงานเกิน %s คน) ให้รัน provision_leave_balances",
+            leave_type.code,
+            limit,
+        )
+        return None
+    return provision_leave_balances(leave_types=[leave_type])
+
+
+def create_default_leave_balances(employee_profile: EmployeeProfile, year: int | None = None):
+    provision_leave_balances(year, employee_ids=[employee_profile.pk])
+
+
+# จำนวนครั้งที่ลองส่งก่อนย้ายไปเป็น DEAD และเวลารอเริ่มต้นก่อนลองใหม่ (เพิ่มเป็นเท่าตัวทุกครั้ง)
+EMAIL_OUTBOX_MAX_ATTEMPTS = getattr(settings, "EMAIL_OUTBOX_MAX_ATTEMPTS", 5)
+EMAIL_OUTBOX_RETRY_SECONDS = getattr(settings, "EMAIL_OUTBOX_RETRY_SECONDS", 60)
+
+# True = หัวหน้าได้รับอีเมลสรุปรอบละฉบับ (send_manager_digests) แทนอีเมลทุกครั้งที่มีคนยื่นลา
+# ปิดไว้เป็นค่าเริ่มต้น เปิดเมื่อตั้ง cron ของ send_manager_digests แล้วเท่านั้น
+MANAGER_DIGEST_ENABLED = getattr(settings, "MANAGER_DIGEST_ENABLED", False)
+# คำขอที่รออนุมัติเกินกี่ชั่วโมงถือว่าเกินกำหนด (ขึ้นหัวข้อเตือนใน digest)
+LEAVE_APPROVAL_SLA_HOURS = getattr(settings, "LEAVE_APPROVAL_SLA_HOURS", 48)
+
+
 def _send_leave_email(subject: str, message: str, to_emails: list[str]):
+    """
+    ไม่ส่ง SMTP ตรง ๆ ใน request แต่เขียนลง EmailOutbox
+    (อยู่ใน transaction เดียวกับการเปลี่ยนสถานะ ถ้า rollback อีเมลก็หายไปด้วย)
+    worker `send_outbox_emails` จะเป็นคนส่งจริง
+    """
     if not to_emails:
         return
-    send_mail(
-        subject,
-        message,
-        settings.DEFAULT_FROM_EMAIL,
-        to_emails,
-        fail_silently=True,  # กัน error ใน production
+    EmailOutbox.objects.create(
+        subject=subject[:255],
+        body=message,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=list(to_emails),
     )
 
 
+def send_outbox_batch(batch_size: int = 100) -> tuple[int, int]:
+    """
+    ส่งอีเมลที่ถึงกำหนดใน EmailOutbox หนึ่งชุด ผ่าน SMTP connection เดียว
+    - lock แถวด้วย skip_locked เพื่อให้รันหลาย worker พร้อมกันได้
+    - ส่งไม่สำเร็จ → รอแบบ exponential backoff แล้วลองใหม่
+    - ครบ EMAIL_OUTBOX_MAX_ATTEMPTS → สถานะ DEAD
+    คืน (จำนวนที่ส่งสำเร็จ, จำนวนที่ล้มเหลว)
+    """
+    sent = failed = 0
+    with transaction.atomic():
+        rows = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(
+                status=EmailOutbox.STATUS_PENDING,
+                next_attempt_at__lte=timezone.now(),
+            )
+            .order_by("next_attempt_at", "pk")[:batch_size]
+        )
+        if not rows:
+            return 0, 0
+
+        connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+        except Exception as exc:  # SMTP ล่มทั้งชุด → นับเป็นความพยายามของทุกแถว
+            for row in rows:
+                _mark_outbox_failed(row, exc)
+            EmailOutbox.objects.bulk_update(
+                rows, ["status", "attempts", "next_attempt_at", "last_error"]
+            )
+            return 0, len(rows)
+
+        try:
+            for row in rows:
+                message = EmailMessage(
+                    row.subject,
+                    row.body,
+                    row.from_email or settings.DEFAULT_FROM_EMAIL,
+                    row.to,
+                    connection=connection,
+                )
+                try:
+                    connection.send_messages([message])
+                except Exception as exc:
+                    _mark_outbox_failed(row, exc)
+                    failed += 1
+                else:
+                    row.status = EmailOutbox.STATUS_SENT
+                    row.attempts += 1
+                    row.sent_at = timezone.now()
+                    row.last_error = ""
+                    sent += 1
+        finally:
+            connection.close()
+
+        EmailOutbox.objects.bulk_update(
+            rows, ["status", "attempts", "next_attempt_at", "last_error", "sent_at"]
+        )
+    return sent, failed
+
+
+def _mark_outbox_failed(row: EmailOutbox, exc: Exception):
+    row.attempts += 1
+    row.last_error = f"{type(exc).__name__}: {exc}"
+    if row.attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+        row.status = EmailOutbox.STATUS_DEAD
+    else:
+        delay = EMAIL_OUTBOX_RETRY_SECONDS * (2 ** (row.attempts - 1))
+        row.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+
+
 def notify_leave_submitted(leave_request: LeaveRequest):
     emp = leave_request.employee
     user = emp.user
@@ -220,8 +831,8 @@ def notify_leave_submitted(leave_request: LeaveRequest):
         )
         _send_leave_email(subject, message, [user.email])
 
-    # แจ้งหัวหน้า (ถ้ามี email)
-    if manager and manager.email:
+    # แจ้งหัวหน้า (ถ้ามี email) — ถ้าเปิด digest หัวหน้าจะได้รับรวมในอีเมลสรุปแทน
+    if manager and manager.email and not MANAGER_DIGEST_ENABLED:
         subject = f"[Pending] คำขอลางานใหม่จาก {user.get_full_name() or user.username}"
         message = (
             f"มีคำขอลางานใหม่รออนุมัติ\n"
@@ -233,6 +844,63 @@ def notify_leave_submitted(leave_request: LeaveRequest):
         _send_leave_email(subject, message, [manager.email])
 
 
+def send_manager_digests(sla_hours: int | None = None) -> int:
+    """
+    สร้างอีเมลสรุปคำขอที่รออนุมัติ 1 ฉบับต่อหัวหน้า (ใช้กับ cron ผ่าน `send_manager_digests`)
+    - ดึงคำขอ Pending ทั้งหมดใน query เดียว เรียงตามหัวหน้า แล้วจัดกลุ่ม
+    - คำขอที่รอนานเกิน sla_hours ชั่วโมง แยกเป็นหัวข้อ "เกินกำหนด" เพื่อเตือนหัวหน้า
+    คืนจำนวนอีเมลที่เข้าคิว
+    """
+    if sla_hours is None:
+        sla_hours = LEAVE_APPROVAL_SLA_HOURS
+    overdue_before = timezone.now() - timedelta(hours=sla_hours)
+
+    pending = (
+        LeaveRequest.objects.filter(
+            status=LeaveRequest.STATUS_PENDING,
+            employee__manager__isnull=False,
+        )
+        .exclude(employee__manager__email="")
+        .select_related("employee__user", "employee__manager", "leave_type")
+        .order_by("employee__manager_id", "created_at")
+    )
+
+    def line(leave):
+        user = leave.employee.user
+        days = f" ({leave.total_days} วัน)" if leave.total_days is not None else ""
+        return (
+            f"- {leave.employee.employee_code} {user.get_full_name() or user.username}: "
+            f"{leave.leave_type.name} {leave.start_date} - {leave.end_date}{days} "
+            f"ยื่นเมื่อ {timezone.localtime(leave.created_at):%Y-%m-%d %H:%M}"
+        )
+
+    queued = 0
+    for _, group in groupby(pending, key=lambda leave: leave.employee.manager_id):
+        leaves = list(group)
+        manager = leaves[0].employee.manager
+        overdue = [leave for leave in leaves if leave.created_at < overdue_before]
+
+        subject = f"[Digest] คำขอลางานรออนุมัติ {len(leaves)} รายการ"
+        if overdue:
+            subject += f" (เกินกำหนด {len(overdue)})"
+
+        parts = [f"สวัสดี {manager.get_full_name() or manager.username}\n"]
+        if overdue:
+            parts.append(f"คำขอที่รอเกิน {sla_hours} ชั่วโมง:")
+            parts.extend(line(leave) for leave in overdue)
+            parts.append("")
+        # ใบที่อยู่ในหัวข้อเกินกำหนดแล้วไม่แสดงซ้ำ
+        others = [leave for leave in leaves if leave.created_at >= overdue_before]
+        if others:
+            parts.append("คำขออื่นที่รออนุมัติ:" if overdue else "คำขอที่รออนุมัติทั้งหมด:")
+            parts.extend(line(leave) for leave in others)
+
+        _send_leave_email(subject, "\n".join(parts) + "\n", [manager.email])
+        queued += 1
+
+    return queued
+
+
 def notify_leave_status_changed(leave_request: LeaveRequest):
     emp = leave_request.employee
     user = emp.user
@@ -250,6 +918,81 @@ def notify_leave_status_changed(leave_request: LeaveRequest):
     )
     _send_leave_email(subject, message, [user.email])
     
+def track_user_session(user, session_key: str, old_session_key: str | None = None):
+    """บันทึก session key ปัจจุบันของ user (และลบ key เดิมที่ถูกเปลี่ยนด้วย cycle_key)"""
+    if old_session_key and old_session_key != session_key:
+        UserSession.objects.filter(session_key=old_session_key).delete()
+    UserSession.objects.update_or_create(session_key=session_key, defaults={"user": user})
+
+
+def prune_user_sessions() -> int:
+    """ลบแถว UserSession ที่ session หมดอายุ / ถูกลบไปแล้ว (เรียกจาก `clearsessions`)"""
+    deleted, _ = UserSession.objects.exclude(
+        session_key__in=Session.objects.values("session_key")
+    ).delete()
+    return deleted
+
+
+def revoke_user_sessions(user) -> int:
+    """ลบทุก session ของ user นี้ ผ่านตาราง UserSession (ใช้ index ของ user ไม่ต้องสแกนทุก session)"""
+    keys = list(
+        UserSession.objects.filter(user=user).values_list("session_key", flat=True)
+    )
+    if not keys:
+        return 0
+    deleted, _ = Session.objects.filter(session_key__in=keys).delete()
+    UserSession.objects.filter(user=user).delete()
+    return deleted
+
+
+def employee_search_text(*parts) -> str:
+    """ข้อความสำหรับ EmployeeProfile.search_text (ตัวพิมพ์เล็ก คั่นด้วยช่องว่าง)"""
+    return " ".join(str(p).strip() for p in parts if p).lower()
+
+
+def search_employee_directory(queryset, term: str):
+    """
+    กรองพนักงานที่ รหัส / username / ชื่อ / นามสกุล มี term อยู่ (ค้นใน search_text คอลัมน์เดียว)
+    บน PostgreSQL ใช้ GIN trigram index ฐานข้อมูลอื่นเป็น LIKE ธรรมดา
+    """
+    term = " ".join((term or "").split()).lower()
+    if not term:
+        return queryset
+    return queryset.filter(search_text__contains=term)
+
+
+def search_employees(
+    term: str, limit: int | None = None, active_only: bool = False, queryset=None
+):
+    """
+    ค้นหาพนักงานที่รหัส / username / ชื่อ / นามสกุล ขึ้นต้นด้วย term ได้ไม่เกิน limit คน
+    ค้นทีละฟิลด์ (แต่ละ query ใช้ index ของฟิลด์นั้นแล้ว LIMIT) แทน OR ข้ามตารางที่ต้องสแกนทั้ง join
+    queryset: จำกัดขอบเขตการค้น (เช่น เฉพาะลูกน้องในสายงาน)
+    """
+    term = (term or "").strip()
+    if not term:
+        return []
+    limit = limit or EMPLOYEE_AUTOCOMPLETE_LIMIT
+
+    base = (EmployeeProfile.objects.all() if queryset is None else queryset).order_by()
+    if active_only:
+        base = base.filter(user__is_active=True)
+
+    ids: set[int] = set()
+    for field in EMPLOYEE_SEARCH_FIELDS:
+        ids.update(
+            base.filter(**{f"{field}__istartswith": term}).values_list("id", flat=True)[:limit]
+        )
+        if len(ids) >= limit:
+            break
+
+    return list(
+        EmployeeProfile.objects.select_related("user")
+        .filter(id__in=ids)
+        .order_by("employee_code")[:limit]
+    )
+
+
 def get_employee_leave_balances(employee_profile, year=None):
     if year is None:
         year = timezone.now().year
@@ -0,0 +1,256 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .hierarchy import detach_subtree, remove_profile_node, set_manager
+from .models import Department, EmployeeProfile, Holiday, LeaveRequest, LeaveType, UserSession
+from .roles import forget_user_roles
+from .rollups import (
+    RollupDeltas,
+    merge_department_rollups,
+    move_employee_rollups,
+    record_leave,
+    rollup_key,
+)
+from .services import (
+    DASHBOARD_VERSION_KEY,
+    HOLIDAY_VERSION_KEY,
+    bump_data_version,
+    employee_search_text,
+    invalidate_holiday_index,
+    provision_new_leave_type,
+    recalculate_leave_days,
+    track_user_session,
+)
+
+
+@receiver(post_save, sender=LeaveRequest)
+@receiver(post_delete, sender=LeaveRequest)
+@receiver(post_save, sender=Holiday)
+@receiver(post_delete, sender=Holiday)
+@receiver(post_save, sender=EmployeeProfile)
+@receiver(post_delete, sender=EmployeeProfile)
+@receiver(post_save, sender=Department)
+@receiver(post_delete, sender=Department)
+def dashboard_data_changed(sender, raw=False, **kwargs):
+    # cache ของ CEO dashboard ผูกกับ version นี้ (ทางที่ใช้ update() / bulk_create bump เองใน services)
+    if not raw:
+        bump_data_version(DASHBOARD_VERSION_KEY)
+
+
+@receiver(pre_save, sender=Holiday)
+def holiday_remember_old_date(sender, instance, **kwargs):
+    # เก็บวันที่เดิมไว้ ถ้ามีการแก้วันที่ต้องคำนวณใบลาของวันเดิมใหม่ด้วย
+    instance._old_date = None
+    if instance.pk:
+        instance._old_date = (
+            Holiday.objects.filter(pk=instance.pk).values_list("date", flat=True).first()
+        )
+
+
+@receiver(post_save, sender=Holiday)
+@receiver(post_delete, sender=Holiday)
+def holiday_changed(sender, instance, **kwargs):
+    # process นี้ล้าง index ทันที ส่วน worker อื่นจะเห็นจาก version ใน DB
+    bump_data_version(HOLIDAY_VERSION_KEY)
+    invalidate_holiday_index()
+    transaction.on_commit(invalidate_holiday_index)
+
+    # คำนวณวันลาที่บันทึกไว้ใหม่ เฉพาะใบที่ครอบวันหยุดนี้ (ทั้งวันเดิมและวันใหม่)
+    affected = Q()
+    for day in {instance.date, getattr(instance, "_old_date", None)} - {None}:
+        affected |= Q(start_date__lte=day, end_date__gte=day)
+    if affected:
+        recalculate_leave_days(
+            LeaveRequest.objects.filter(affected, total_days__isnull=False)
+        )
+
+
+def _stored_rollup(pk):
+    """(คีย์ rollup, วันลา) ตามค่าที่อยู่ใน DB ตอนนี้ (instance ในมืออาจเก่ากว่า)"""
+    row = (
+        LeaveRequest.objects.filter(pk=pk)
+        .values("start_date", "leave_type_id", "status", "total_days", "employee__department_id")
+        .first()
+    )
+    if row is None:
+        return None
+    key = (
+        row["start_date"].year,
+        row["start_date"].month,
+        row["employee__department_id"],
+        row["leave_type_id"],
+        row["status"],
+    )
+    return key, row["total_days"] or 0
+
+
+# ฟิลด์ที่กำหนดแถวของ LeaveStatsRollup (update_fields อาจส่งมาเป็นชื่อ field หรือ attname)
+_ROLLUP_FIELDS = {
+    "start_date",
+    "status",
+    "total_days",
+    "leave_type",
+    "leave_type_id",
+    "employee",
+    "employee_id",
+}
+
+
+@receiver(pre_save, sender=LeaveRequest)
+def leave_request_remember_rollup(sender, instance, raw=False, update_fields=None, **kwargs):
+    # เก็บคีย์ของ LeaveStatsRollup ก่อนแก้ เพื่อย้ายยอดจากแถวเดิมไปแถวใหม่
+    # save(update_fields=...) ที่ไม่แตะฟิลด์เหล่านี้ไม่ต้อง query
+    instance._old_rollup = None
+    if raw or instance._state.adding:
+        return
+    if update_fields is not None and not _ROLLUP_FIELDS & set(update_fields):
+        return
+    instance._old_rollup = _stored_rollup(instance.pk)
+
+
+@receiver(post_save, sender=LeaveRequest)
+def leave_request_rollup(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        record_leave(instance)
+        return
+    old = getattr(instance, "_old_rollup", None)
+    if old is None:
+        return
+    old_key, old_days = old
+    new_key, new_days = rollup_key(instance), instance.total_days or 0
+    if (old_key, old_days) == (new_key, new_days):
+        return
+    deltas = RollupDeltas()
+    deltas.add(old_key, -1, -old_days)
+    deltas.add(new_key, 1, new_days)
+    deltas.apply()
+
+
+@receiver(pre_delete, sender=LeaveRequest)
+def leave_request_rollup_delete(sender, instance, **kwargs):
+    stored = _stored_rollup(instance.pk)
+    if stored is not None:
+        deltas = RollupDeltas()
+        deltas.add(stored[0], -1, -stored[1])
+        deltas.apply()
+
+
+@receiver(pre_delete, sender=Department)
+def department_rollup_delete(sender, instance, **kwargs):
+    # ไม่ปล่อยให้ FK ตั้ง department = NULL เอง (จะชนกับแถวที่ไม่มีแผนกอยู่แล้ว)
+    merge_department_rollups(instance.pk)
+
+
+@receiver(post_save, sender=LeaveType)
+def leave_type_created(sender, instance, created, raw=False, **kwargs):
+    # ประเภทการลาใหม่ → สร้างโควต้าปีปัจจุบันให้พนักงานทุกคนหลัง commit
+    # (ไม่ถือ transaction ของหน้า admin ไว้ระหว่าง bulk insert องค์กรใหญ่ข้ามไปให้ HR สร้างเอง)
+    if created and not raw:
+        transaction.on_commit(lambda: provision_new_leave_type(instance))
+
+
+@receiver(pre_save, sender=EmployeeProfile)
+def employee_profile_search_text(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    user = instance.user
+    instance.search_text = employee_search_text(
+        instance.employee_code, user.username, user.first_name, user.last_name
+    )
+    instance._old_department_id = instance._old_manager_id = None
+    if not instance._state.adding:
+        instance._old_department_id, instance._old_manager_id = (
+            EmployeeProfile.objects.filter(pk=instance.pk)
+            .values_list("department_id", "manager_id")
+            .first()
+        ) or (None, None)
+
+
+@receiver(post_save, sender=EmployeeProfile)
+def employee_profile_moved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    # ตั้ง / เปลี่ยนหัวหน้า → ย้ายทั้งสายงานใน OrgClosure (ถ้าวน set_manager raise แล้ว save ถูก rollback)
+    if created or getattr(instance, "_old_manager_id", None) != instance.manager_id:
+        set_manager(instance.user_id, instance.manager_id)
+    if created:
+        return
+    # ย้ายแผนก → ย้ายยอดใน LeaveStatsRollup ของคำขอเดิมทั้งหมดไปแผนกใหม่
+    old_department_id = getattr(instance, "_old_department_id", None)
+    if old_department_id != instance.department_id:
+        move_employee_rollups(instance.pk, old_department_id, instance.department_id)
+
+
+@receiver(post_delete, sender=EmployeeProfile)
+def employee_profile_deleted(sender, instance, **kwargs):
+    # ไม่มีโปรไฟล์ก็ไม่มีหัวหน้า ลูกน้องของ user นี้ยังอยู่ใต้เขาตามเดิม
+    remove_profile_node(instance.user_id)
+
+
+@receiver(pre_delete, sender=get_user_model())
+def user_deleted(sender, instance, **kwargs):
+    # ลูกน้องจะถูกตั้ง manager = NULL ด้วย update() (ไม่ผ่าน signal) จึงตัดทั้งสายออกจากหัวหน้าเบื้องบนก่อน
+    # แถวที่อ้างถึง user นี้เองถูกลบตาม FK (CASCADE)
+    detach_subtree(instance.pk)
+
+
+_USER_SEARCH_FIELDS = {"username", "first_name", "last_name"}
+
+
+@receiver(post_save, sender=get_user_model())
+def user_search_text(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    # save ที่ไม่ได้แตะชื่อ (เช่น last_login ตอน login) ไม่ต้องอัปเดต
+    if created or raw or (update_fields and not _USER_SEARCH_FIELDS & set(update_fields)):
+        return
+    # ชื่อ / สถานะ active ของพนักงานแสดงใน CEO dashboard
+    bump_data_version(DASHBOARD_VERSION_KEY)
+    for pk, code in EmployeeProfile.objects.filter(user=instance).values_list("pk", "employee_code"):
+        EmployeeProfile.objects.filter(pk=pk).update(
+            search_text=employee_search_text(
+                code, instance.username, instance.first_name, instance.last_name
+            )
+        )
+
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # ล้าง cache บทบาท (roles.py) ของผู้ใช้ที่สมาชิก group เปลี่ยน
+    if reverse:
+        # group.user_set.add/remove/clear → instance คือ Group
+        if action == "pre_clear":
+            forget_user_roles(instance.user_set.values_list("pk", flat=True))
+        elif action in ("post_add", "post_remove"):
+            forget_user_roles(pk_set)
+    elif action in ("post_add", "post_remove", "post_clear"):
+        forget_user_roles([instance.pk])
+
+
+@receiver(post_save, sender=Group)
+@receiver(pre_delete, sender=Group)
+def group_changed(sender, instance, raw=False, **kwargs):
+    # แก้ชื่อ / ลบ group → ผู้ใช้ทุกคนใน group ต้องโหลดบทบาทใหม่
+    if not raw and instance.pk:
+        forget_user_roles(instance.user_set.values_list("pk", flat=True))
+
+
+@receiver(user_logged_in)
+def remember_user_session(sender, request, user, **kwargs):
+    session_key = request.session.session_key
+    if session_key:
+        track_user_session(user, session_key)
+        # UserSessionMiddleware ไม่ต้องบันทึกซ้ำใน request เดียวกัน
+        request._tracked_session_key = session_key
+
+
+@receiver(user_logged_out)
+def forget_user_session(sender, request, user, **kwargs):
+    session_key = request.session.session_key
+    if session_key:
+        UserSession.objects.filter(session_key=session_key).delete()
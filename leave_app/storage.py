@@ -0,0 +1,29 @@
+"""
+ที่เก็บไฟล์ภายในที่ห้ามเปิดผ่าน URL ตรง ๆ (ไฟล์นำเข้าพนักงานที่มีคอลัมน์รหัสผ่าน, ไฟล์ export คำขอลา)
+
+- อยู่ใต้ PRIVATE_MEDIA_ROOT นอก MEDIA_ROOT จึงไม่ถูกเสิร์ฟโดย /media/
+- อ่านได้เฉพาะจากโค้ดฝั่งเซิร์ฟเวอร์ / view ที่ตรวจสิทธิ์แล้ว (เช่น hr_export_job_download)
+"""
+import os
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class PrivateStorage(FileSystemStorage):
+    # อ่าน settings ทุกครั้ง (override_settings ในเทสต์มีผล)
+    @property
+    def base_location(self):
+        return settings.PRIVATE_MEDIA_ROOT
+
+    @property
+    def location(self):
+        return os.path.abspath(self.base_location)
+
+    def url(self, name):
+        raise ValueError("ไฟล์ภายในไม่มี URL สาธารณะ ให้เปิดผ่าน view ที่ตรวจสิทธิ์")
+
+
+private_storage = PrivateStorage()
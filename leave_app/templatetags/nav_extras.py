@@ -1,10 +1,12 @@
 from django import template
 
+from leave_app.roles import has_role
+
 register = template.Library()
 
 @register.filter
 def has_group(user, group_name: str) -> bool:
-    return user.groups.filter(name=group_name).exists()
+    return has_role(user, group_name)
 
 @register.filter
 def add_class(field, css):
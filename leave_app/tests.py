@@ -1,3 +1,1906 @@
-from django.test import TestCase
+import base64
+import csv
+import importlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+from datetime import date, timedelta
+from decimal import Decimal
+from smtplib import SMTPException
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import openpyxl
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import employee_import
+from .caching import get_or_compute, versioned_cache_key
+from .employee_import import (
+    EmployeeImporter,
+    chunked,
+    claim_import_job,
+    retry_import_job,
+    run_import_job,
+)
+from .exports import (
+    _iter_leaves_csv_copy,
+    _iter_leaves_csv_orm,
+    copy_export_supported,
+    filter_leaves,
+    iter_leaves_csv,
+)
+from .hierarchy import (
+    ORG_CYCLE_MESSAGE,
+    manages,
+    rebuild_org_closure,
+    set_manager,
+    subordinate_profiles,
+)
+from .models import (
+    Department,
+    EmailOutbox,
+    EmployeeImportJob,
+    EmployeeProfile,
+    Holiday,
+    LeaveBalance,
+    LeaveExportJob,
+    LeaveRequest,
+    LeaveStatsRollup,
+    LeaveType,
+    OrgClosure,
+    UserSession,
+)
+from .pagination import decode_cursor, encode_cursor, keyset_paginate
+from .roles import ROLE_CEO, ROLE_HR, has_role, role_cache_timeout, user_group_names
+from .rollups import rebuild_leave_rollups
+from .services import (
+    DASHBOARD_VERSION_KEY,
+    EMAIL_OUTBOX_MAX_ATTEMPTS,
+    HOLIDAY_VERSION_KEY,
+    LEAVE_OVERLAP_MESSAGE,
+    _count_working_days,
+    _weekdays_before,
+    approve_leave_request,
+    bulk_decide_leave_requests,
+    bump_data_version,
+    calculate_working_days,
+    calculate_working_days_by_year,
+    invalidate_holiday_index,
+    notify_leave_submitted,
+    overlap_enforced_by_db,
+    provision_leave_balances,
+    reject_leave_request,
+    search_employee_directory,
+    search_employees,
+    send_manager_digests,
+    save_leave_request,
+    send_outbox_batch,
+    store_leave_days,
+    validate_leave_request,
+)
+from .views_ceo import _dashboard_stats
+
+User = get_user_model()
+
+
+def next_monday(weeks_ahead: int = 1):
+    today = timezone.now().date()
+    return today + timedelta(days=7 * weeks_ahead - today.weekday())
+
+
+def naive_working_days(start, end, holidays=()):
+    """นับทีละวันแบบตรงไปตรงมา ใช้เทียบกับสูตรใน services"""
+    count = 0
+    day = start
+    while day <= end:
+        if day.weekday() < 5 and day not in holidays:
+            count += 1
+        day += timedelta(days=1)
+    return count
+
+
+def org_closure_rows():
+    return sorted(OrgClosure.objects.values_list("ancestor_id", "descendant_id", "depth"))
+
+
+class WorkingDayTests(TestCase):
+    def setUp(self):
+        invalidate_holiday_index()
+        self.addCleanup(invalidate_holiday_index)
+
+    def test_formula_matches_naive_loop(self):
+        holidays = {date(2025, 12, 31), date(2026, 1, 1), date(2026, 1, 3), date(2026, 4, 13)}
+        ordinals = sorted(d.toordinal() for d in holidays if d.weekday() < 5)
+        base = date(2025, 12, 20)
+        for offset in range(0, 21):
+            start = base + timedelta(days=offset)
+            for length in (0, 1, 2, 4, 5, 6, 7, 13, 30, 120):
+                end = start + timedelta(days=length)
+                with self.subTest(start=start, end=end):
+                    self.assertEqual(
+                        _count_working_days(start, end, ordinals),
+                        naive_working_days(start, end, holidays),
+                    )
+        self.assertEqual(_count_working_days(date(2026, 1, 5), date(2026, 1, 2), ordinals), 0)
+
+    def test_weekdays_before_counts_monday_to_friday(self):
+        # 0001-01-01 เป็นวันจันทร์
+        self.assertEqual(_weekdays_before(1), 0)
+        self.assertEqual(_weekdays_before(6), 5)
+        self.assertEqual(_weekdays_before(8), 5)
+        self.assertEqual(_weekdays_before(9), 6)
+
+    def test_year_split_across_boundary(self):
+        Holiday.objects.create(date=date(2026, 1, 1), name="New Year")
+        split = calculate_working_days_by_year(date(2025, 12, 29), date(2026, 1, 9))
+        self.assertEqual(split, {2025: Decimal("3"), 2026: Decimal("6")})
+        self.assertEqual(
+            calculate_working_days(date(2025, 12, 29), date(2026, 1, 9)), Decimal("9")
+        )
+
+    def test_holiday_edit_reloads_index(self):
+        start, end = date(2026, 3, 2), date(2026, 3, 6)
+        self.assertEqual(calculate_working_days(start, end), Decimal("5"))
+        holiday = Holiday.objects.create(date=date(2026, 3, 4), name="h")
+        self.assertEqual(calculate_working_days(start, end), Decimal("4"))
+        holiday.date = date(2026, 3, 9)
+        holiday.save()
+        self.assertEqual(calculate_working_days(start, end), Decimal("5"))
+        holiday.delete()
+        self.assertEqual(calculate_working_days(date(2026, 3, 9), date(2026, 3, 9)), Decimal("1"))
+
+    def test_data_version_bump_clears_index_of_other_workers(self):
+        start = end = date(2026, 3, 4)
+        self.assertEqual(calculate_working_days(start, end), Decimal("1"))
+        # worker อื่นเพิ่มวันหยุด: process นี้ไม่ได้รับ signal เห็นแค่ version ใน DB
+        Holiday.objects.bulk_create([Holiday(date=start, name="elsewhere")])
+        self.assertEqual(calculate_working_days(start, end), Decimal("1"))
+        bump_data_version(HOLIDAY_VERSION_KEY)
+        with mock.patch("leave_app.services.HOLIDAY_INDEX_CHECK_INTERVAL", 0):
+            self.assertEqual(calculate_working_days(start, end), Decimal("0"))
+
+
+class StoredLeaveDaysTests(TestCase):
+    def setUp(self):
+        invalidate_holiday_index()
+        self.addCleanup(invalidate_holiday_index)
+        user = User.objects.create_user("employee", password="pw")
+        self.profile = EmployeeProfile.objects.create(user=user, employee_code="EMP0001")
+        self.leave_type = LeaveType.objects.create(name="Annual", code="AL", default_allocation=10)
+
+    def _leave(self, start, end, half_day=False, status=LeaveRequest.STATUS_PENDING):
+        leave = LeaveRequest.objects.create(
+            employee=self.profile,
+            leave_type=self.leave_type,
+            start_date=start,
+            end_date=end,
+            half_day=half_day,
+            reason="test",
+            status=status,
+        )
+        store_leave_days(leave)
+        return leave
+
+    def allocations(self, leave):
+        return dict(leave.allocations.values_list("year", "days"))
+
+    def test_store_splits_days_by_year(self):
+        leave = self._leave(date(2025, 12, 29), date(2026, 1, 2))
+        leave.refresh_from_db()
+        self.assertEqual(leave.total_days, Decimal("5"))
+        self.assertEqual(self.allocations(leave), {2025: Decimal("3"), 2026: Decimal("2")})
+
+        half = self._leave(date(2026, 2, 2), date(2026, 2, 2), half_day=True)
+        self.assertEqual(self.allocations(half), {2026: Decimal("0.5")})
+
+    def test_holiday_change_recalculates_only_covered_leaves(self):
+        inside = self._leave(date(2026, 3, 2), date(2026, 3, 6))
+        outside = self._leave(date(2026, 3, 9), date(2026, 3, 13))
+
+        holiday = Holiday.objects.create(date=date(2026, 3, 4), name="h")
+        inside.refresh_from_db()
+        outside.refresh_from_db()
+        self.assertEqual(inside.total_days, Decimal("4"))
+        self.assertEqual(outside.total_days, Decimal("5"))
+
+        # ย้ายวันหยุด → ใบของวันเดิมและวันใหม่ถูกคำนวณใหม่ทั้งคู่
+        holiday.date = date(2026, 3, 10)
+        holiday.save()
+        inside.refresh_from_db()
+        outside.refresh_from_db()
+        self.assertEqual(inside.total_days, Decimal("5"))
+        self.assertEqual(self.allocations(outside), {2026: Decimal("4")})
+
+    def test_ceo_dashboard_does_not_write(self):
+        leave = LeaveRequest.objects.create(
+            employee=self.profile,
+            leave_type=self.leave_type,
+            start_date=date(2026, 3, 2),
+            end_date=date(2026, 3, 3),
+            reason="legacy",
+            status=LeaveRequest.STATUS_APPROVED,
+        )
+        ceo = User.objects.create_superuser("ceo", password="pw")
+        self.client.force_login(ceo)
+        response = self.client.get(reverse("leave_app:ceo_dashboard"), {"year": 2026})
+        self.assertEqual(response.status_code, 200)
+        leave.refresh_from_db()
+        self.assertIsNone(leave.total_days)
+
+
+class CeoDashboardStatsTests(TestCase):
+    """สถิติ CEO dashboard คำนวณยอดรวมและ top 5 ใน SQL จำนวน query คงที่"""
+
+    def setUp(self):
+        self.leave_type = LeaveType.objects.create(name="Annual", code="AL", default_allocation=30)
+        self.departments = [
+            Department.objects.create(name=f"Dept {i}", code=f"D{i}") for i in range(7)
+        ]
+        self.employees = 0
+
+    def add_employee(self, days: int, department=None):
+        """พนักงานหนึ่งคนที่มีวันลาอนุมัติแล้ว days วันทำการในปี 2026"""
+        self.employees += 1
+        user = User.objects.create_user(f"emp{self.employees}", password="pw")
+        profile = EmployeeProfile.objects.create(
+            user=user, employee_code=f"EMP{self.employees:04d}", department=department
+        )
+        if days:
+            start = date(2026, 3, 2)  # วันจันทร์
+            leave = LeaveRequest.objects.create(
+                employee=profile,
+                leave_type=self.leave_type,
+                start_date=start,
+                end_date=start + timedelta(days=days - 1),
+                reason="test",
+                status=LeaveRequest.STATUS_APPROVED,
+            )
+            store_leave_days(leave)
+        return profile
+
+    def test_totals_and_top_five(self):
+        for i, days in enumerate([1, 5, 3, 2, 4, 5, 1]):
+            self.add_employee(days, self.departments[i])
+        self.add_employee(2)
+        self.add_employee(0)
+
+        stats = _dashboard_stats(2026)
+        self.assertEqual(stats["total_leave_days"], 23.0)
+        self.assertAlmostEqual(stats["avg_leave_days_per_employee"], 23 / 9)
+        self.assertEqual(
+            [(e["code"], e["days"]) for e in stats["top_employees"]],
+            [("EMP0002", 5.0), ("EMP0006", 5.0), ("EMP0005", 4.0), ("EMP0003", 3.0), ("EMP0004", 2.0)],
+        )
+        self.assertEqual(stats["top_employees"][0]["department"], "Dept 1")
+        self.assertEqual(
+            [(d["name"], d["days"]) for d in stats["top_departments"]],
+            [("Dept 1", 5.0), ("Dept 5", 5.0), ("Dept 4", 4.0), ("Dept 2", 3.0), ("Dept 3", 2.0)],
+        )
+
+    def test_no_dept_bucket(self):
+        self.add_employee(5)
+        self.add_employee(1, self.departments[0])
+        stats = _dashboard_stats(2026)
+        self.assertEqual(stats["top_departments"][0], {"name": "No Dept", "days": 5.0})
+        self.assertEqual(stats["top_employees"][0]["department"], "-")
+
+    def test_query_count_is_constant(self):
+        self.add_employee(2, self.departments[0])
+        # active count, rollup, ยอดรวม, top แผนก, top พนักงาน
+        with self.assertNumQueries(5):
+            _dashboard_stats(2026)
+
+        for i in range(30):
+            self.add_employee(1 + i % 5, self.departments[i % 7])
+        with self.assertNumQueries(5):
+            stats = _dashboard_stats(2026)
+        self.assertEqual(len(stats["top_employees"]), 5)
+        self.assertEqual(stats["total_leave_days"], 2 + sum(1 + i % 5 for i in range(30)))
+
+
+class LeaveStatsRollupTests(TestCase):
+    """LeaveStatsRollup ที่อัปเดตทีละรายการต้องตรงกับการสร้างใหม่จาก LeaveRequest"""
+
+    def setUp(self):
+        self.leave_type = LeaveType.objects.create(name="Annual", code="AL", default_allocation=30)
+        self.sales = Department.objects.create(name="Sales", code="S")
+        self.ops = Department.objects.create(name="Ops", code="O")
+        self.manager = User.objects.create_user("manager", password="pw")
+        self.profiles = []
+        for i, department in enumerate([self.sales, self.ops, None]):
+            user = User.objects.create_user(f"emp{i}", password="pw")
+            profile = EmployeeProfile.objects.create(
+                user=user, employee_code=f"EMP{i:04d}", department=department
+            )
+            for year in {next_monday().year, next_monday(6).year}:
+                LeaveBalance.objects.create(
+                    employee=profile, leave_type=self.leave_type, year=year, allocated=30
+                )
+            self.profiles.append(profile)
+
+    def _leave(self, profile, weeks_ahead, days=2):
+        start = next_monday(weeks_ahead)
+        leave = LeaveRequest.objects.create(
+            employee=profile,
+            leave_type=self.leave_type,
+            start_date=start,
+            end_date=start + timedelta(days=days - 1),
+            reason="test",
+        )
+        store_leave_days(leave)
+        leave.refresh_from_db()
+        return leave
+
+    def snapshot(self):
+        rows = LeaveStatsRollup.objects.exclude(request_count=0, total_days=0).values_list(
+            "year", "month", "department_id", "leave_type_id", "status", "request_count", "total_days"
+        )
+        return sorted(rows, key=lambda row: tuple(str(value) for value in row))
+
+    def test_incremental_matches_rebuild(self):
+        sales, ops, nobody = self.profiles
+        approved = self._leave(sales, 1)
+        rejected = self._leave(ops, 2)
+        moved = self._leave(nobody, 3)
+        deleted = self._leave(ops, 4)
+        # เดือนเดียวกัน ต่างแผนก → ชนกันเป็นแถวเดียวหลังลบแผนก
+        self._leave(ops, 5, days=3)
+        self._leave(nobody, 5)
+
+        approve_leave_request(approved, self.manager)
+        reject_leave_request(rejected, self.manager)
+
+        # ย้ายวันลา → ย้ายเดือน และคำนวณวันใหม่
+        moved.start_date = next_monday(8)
+        moved.end_date = moved.start_date + timedelta(days=4)
+        moved.save()
+        store_leave_days(moved)
+
+        # พนักงานย้ายแผนก / แผนกถูกลบ (ยอดไปรวมกับแถวที่ไม่มีแผนกอยู่แล้ว)
+        sales.department = self.ops
+        sales.save()
+        self.ops.delete()
+
+        deleted.delete()
+        approved.reason = "edited"
+        approved.save(update_fields=["reason"])
+
+        incremental = self.snapshot()
+        self.assertTrue(incremental)
+        self.assertEqual({row[2] for row in incremental}, {None})
+        rebuild_leave_rollups()
+        self.assertEqual(incremental, self.snapshot())
+
+    def leave_selects(self, ctx):
+        return [
+            q["sql"]
+            for q in ctx.captured_queries
+            if q["sql"].startswith("SELECT") and "leave_app_leaverequest" in q["sql"]
+        ]
+
+    def test_save_without_rollup_fields_skips_lookup(self):
+        leave = self._leave(self.profiles[0], 1)
+        leave.reason = "edited"
+        with CaptureQueriesContext(connection) as ctx:
+            leave.save(update_fields=["reason", "updated_at"])
+        self.assertEqual(self.leave_selects(ctx), [])
+
+        with CaptureQueriesContext(connection) as ctx:
+            leave.status = LeaveRequest.STATUS_CANCELLED
+            leave.save(update_fields=["status"])
+        self.assertEqual(len(self.leave_selects(ctx)), 1)
+        self.assertEqual(
+            LeaveStatsRollup.objects.get(status=LeaveRequest.STATUS_CANCELLED).request_count, 1
+        )
+
+    @skipUnless(
+        connection.features.supports_nulls_distinct_unique_constraints,
+        "ต้องใช้ฐานข้อมูลที่รองรับ NULLS NOT DISTINCT เช่น PostgreSQL 15+",
+    )
+    def test_null_department_rows_are_unique(self):
+        key = {
+            "year": 2026,
+            "month": 1,
+            "department": None,
+            "leave_type": self.leave_type,
+            "status": LeaveRequest.STATUS_PENDING,
+        }
+        LeaveStatsRollup.objects.create(**key, request_count=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            LeaveStatsRollup.objects.create(**key, request_count=1)
+
+
+class VersionedCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return {"calls": self.calls}
+
+    def test_miss_then_hit(self):
+        self.assertEqual(get_or_compute("stats", self.compute), {"calls": 1})
+        self.assertEqual(get_or_compute("stats", self.compute), {"calls": 1})
+        self.assertEqual(self.calls, 1)
+        self.assertIsNone(cache.get("stats:lock"))
+
+    def test_version_bump_changes_key(self):
+        key = versioned_cache_key("ceo_dashboard", DASHBOARD_VERSION_KEY, 2026)
+        self.assertEqual(get_or_compute(key, self.compute), {"calls": 1})
+        self.assertEqual(versioned_cache_key("ceo_dashboard", DASHBOARD_VERSION_KEY, 2026), key)
+
+        bump_data_version(DASHBOARD_VERSION_KEY)
+        new_key = versioned_cache_key("ceo_dashboard", DASHBOARD_VERSION_KEY, 2026)
+        self.assertNotEqual(new_key, key)
+        self.assertEqual(get_or_compute(new_key, self.compute), {"calls": 2})
+
+    def test_waits_for_lock_holder(self):
+        # อีก request ถือ lock อยู่ และเก็บผลลงไประหว่างที่เรารอ
+        cache.add("stats:lock", 1)
+
+        def finish_elsewhere(_):
+            cache.set("stats", {"calls": "other"})
+
+        with mock.patch("leave_app.caching.time.sleep", side_effect=finish_elsewhere) as sleep:
+            self.assertEqual(get_or_compute("stats", self.compute), {"calls": "other"})
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(self.calls, 0)
+
+    def test_computes_when_lock_holder_gives_up(self):
+        cache.add("stats:lock", 1)
+
+        def holder_failed(_):
+            cache.delete("stats:lock")
+
+        with mock.patch("leave_app.caching.time.sleep", side_effect=holder_failed):
+            self.assertEqual(get_or_compute("stats", self.compute), {"calls": 1})
+        self.assertEqual(self.calls, 1)
+
+
+class RoleCacheTests(TestCase):
+    """cache บทบาทต้องถูกล้างเมื่อสมาชิก group เปลี่ยนทุกทาง"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.hr = Group.objects.create(name=ROLE_HR)
+        self.users = [User.objects.create_user(f"user{i}", password="pw") for i in range(2)]
+
+    def roles(self, user):
+        # instance ใหม่ทุกครั้ง (ไม่ใช้ค่าที่จำไว้บน user._group_names)
+        return user_group_names(User.objects.get(pk=user.pk))
+
+    def assertCached(self, user, names):
+        self.assertEqual(cache.get(f"user_groups:{user.pk}"), frozenset(names))
+
+    def test_cached_after_first_load(self):
+        user = self.users[0]
+        self.assertEqual(self.roles(user), frozenset())
+        self.assertCached(user, [])
+        fresh = User.objects.get(pk=user.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(has_role(fresh, ROLE_HR))
+
+    def test_user_side_membership_changes(self):
+        user = self.users[0]
+        self.roles(user)
+        user.groups.add(self.hr)
+        self.assertEqual(self.roles(user), {ROLE_HR})
+
+        user.groups.remove(self.hr)
+        self.assertEqual(self.roles(user), frozenset())
+
+        user.groups.add(self.hr)
+        self.roles(user)
+        user.groups.clear()
+        self.assertEqual(self.roles(user), frozenset())
+
+    def test_group_side_membership_changes(self):
+        for user in self.users:
+            self.roles(user)
+        self.hr.user_set.add(*self.users)
+        self.assertEqual([self.roles(user) for user in self.users], [{ROLE_HR}] * 2)
+
+        self.hr.user_set.remove(self.users[0])
+        self.assertEqual([self.roles(user) for user in self.users], [frozenset(), {ROLE_HR}])
+
+        self.hr.user_set.clear()
+        self.assertEqual([self.roles(user) for user in self.users], [frozenset()] * 2)
+
+    def test_group_rename_and_delete(self):
+        user = self.users[0]
+        user.groups.add(self.hr)
+        self.assertEqual(self.roles(user), {ROLE_HR})
+
+        self.hr.name = ROLE_CEO
+        self.hr.save()
+        self.assertEqual(self.roles(user), {ROLE_CEO})
+
+        self.hr.delete()
+        self.assertEqual(self.roles(user), frozenset())
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_default_timeout_depends_on_cache_backend(self):
+        self.assertEqual(role_cache_timeout(), 5)
+        with override_settings(
+            CACHES={"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache"}}
+        ):
+            self.assertEqual(role_cache_timeout(), 300)
+        with override_settings(ROLE_CACHE_TIMEOUT=60):
+            self.assertEqual(role_cache_timeout(), 60)
+
+
+class OrgHierarchyTests(TestCase):
+    """OrgClosure ที่อัปเดตทีละการเปลี่ยนต้องตรงกับการสร้างใหม่จาก EmployeeProfile.manager"""
+
+    def setUp(self):
+        # ceo → a → b → c และ ceo → d
+        self.ceo = self.employee("ceo")
+        self.a = self.employee("a", self.ceo)
+        self.b = self.employee("b", self.a)
+        self.c = self.employee("c", self.b)
+        self.d = self.employee("d", self.ceo)
+
+    def employee(self, username, manager=None):
+        user = User.objects.create_user(username, password="pw")
+        EmployeeProfile.objects.create(
+            user=user, employee_code=username.upper(), manager=manager
+        )
+        return user
+
+    def profile(self, user):
+        return EmployeeProfile.objects.get(user=user)
+
+    def assertMatchesRebuild(self):
+        incremental = org_closure_rows()
+        rebuild_org_closure()
+        self.assertEqual(incremental, org_closure_rows())
+
+    def test_subtree_move(self):
+        profile = self.profile(self.a)
+        profile.manager = self.d
+        profile.save()
+
+        self.assertEqual(OrgClosure.objects.get(ancestor=self.d, descendant=self.c).depth, 3)
+        self.assertEqual(OrgClosure.objects.get(ancestor=self.ceo, descendant=self.c).depth, 4)
+        self.assertTrue(manages(self.d, self.profile(self.b)))
+        self.assertFalse(manages(self.d, self.profile(self.b), max_depth=1))
+        self.assertEqual(
+            set(subordinate_profiles(self.d, max_depth=None).values_list("employee_code", flat=True)),
+            {"A", "B", "C"},
+        )
+        self.assertMatchesRebuild()
+
+        # ตัดออกจากหัวหน้า ทั้งสายงานย้ายออกไปด้วย
+        profile.manager = None
+        profile.save()
+        self.assertFalse(manages(self.ceo, self.profile(self.c)))
+        self.assertTrue(manages(self.a, self.profile(self.c)))
+        self.assertMatchesRebuild()
+
+    def test_cycle_rejected(self):
+        before = org_closure_rows()
+        profile = self.profile(self.a)
+
+        profile.manager = self.c
+        with self.assertRaises(ValidationError) as ctx:
+            profile.full_clean()
+        self.assertIn("manager", ctx.exception.message_dict)
+
+        # save ตรง ๆ (shell / script) ล้มทั้ง save ไม่ทิ้งโปรไฟล์ที่วนไว้
+        with self.assertRaisesMessage(ValidationError, ORG_CYCLE_MESSAGE):
+            profile.save()
+        self.assertEqual(self.profile(self.a).manager_id, self.ceo.pk)
+        self.assertEqual(org_closure_rows(), before)
+
+        with self.assertRaises(ValidationError):
+            set_manager(self.a.pk, self.a.pk)
+
+    def test_edit_form_reports_cycle(self):
+        hr = User.objects.create_user("hr", password="pw")
+        hr.groups.add(Group.objects.create(name=ROLE_HR))
+        self.client.force_login(hr)
+        profile = self.profile(self.a)
+        response = self.client.post(
+            reverse("leave_app:hr_employee_edit", args=[profile.pk]),
+            {"employee_code": "A", "manager": self.c.pk, "is_active": "on"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(ORG_CYCLE_MESSAGE, response.context["form"].errors["manager"])
+        self.assertEqual(self.profile(self.a).manager_id, self.ceo.pk)
+
+    def test_user_delete_matches_rebuild(self):
+        self.a.delete()
+        # ลูกน้องโดยตรงถูกตั้ง manager = NULL ตาม FK สายงานใต้ b ยังอยู่ครบ
+        self.assertIsNone(self.profile(self.b).manager_id)
+        self.assertTrue(manages(self.b, self.profile(self.c)))
+        self.assertFalse(manages(self.ceo, self.profile(self.c)))
+        self.assertMatchesRebuild()
+
+        self.profile(self.d).delete()
+        self.assertMatchesRebuild()
+
+
+@skipUnless(
+    connection.features.has_select_for_update,
+    "ต้องใช้ฐานข้อมูลที่ lock แถวได้ (select_for_update) เช่น PostgreSQL",
+)
+class ConcurrentApprovalTests(TransactionTestCase):
+    """ยิงการอนุมัติพร้อมกันหลาย thread ใส่ LeaveBalance เดียว"""
+
+    THREADS = 8
+
+    def setUp(self):
+        self.manager = User.objects.create_user("manager", password="pw")
+        user = User.objects.create_user("employee", password="pw")
+        self.profile = EmployeeProfile.objects.create(
+            user=user, employee_code="EMP0001", manager=self.manager
+        )
+        self.leave_type = LeaveType.objects.create(
+            name="Annual", code="AL", default_allocation=Decimal("3")
+        )
+
+    def _balance(self, year):
+        return LeaveBalance.objects.get_or_create(
+            employee=self.profile,
+            leave_type=self.leave_type,
+            year=year,
+            defaults={"allocated": Decimal("3")},
+        )[0]
+
+    def _leave(self, start):
+        leave = LeaveRequest.objects.create(
+            employee=self.profile,
+            leave_type=self.leave_type,
+            start_date=start,
+            end_date=start,
+            reason="test",
+        )
+        store_leave_days(leave)
+        return leave
+
+    def _approve_in_parallel(self, leave_ids):
+        results = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(len(leave_ids))
+
+        def worker(pk):
+            try:
+                leave = LeaveRequest.objects.select_related(
+                    "employee", "leave_type"
+                ).get(pk=pk)
+                barrier.wait()
+                try:
+                    approve_leave_request(leave, approver=self.manager)
+                    outcome = "ok"
+                except ValidationError:
+                    outcome = "rejected"
+                with lock:
+                    results.append(outcome)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(pk,)) for pk in leave_ids]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_parallel_approvals_never_overdraw_balance(self):
+        # วันทำงาน THREADS วันติดกัน (จันทร์-ศุกร์) ทุกใบใช้โควต้าปีเดียวกัน
+        days = []
+        current = next_monday()
+        while len(days) < self.THREADS:
+            if current.weekday() < 5:
+                days.append(current)
+            current += timedelta(days=1)
+        days = [d for d in days if d.year == days[0].year]
+        balance = self._balance(days[0].year)
+        leaves = [self._leave(d) for d in days]
+
+        results = self._approve_in_parallel([leave.pk for leave in leaves])
+
+        balance.refresh_from_db()
+        approved = LeaveRequest.objects.filter(status=LeaveRequest.STATUS_APPROVED).count()
+        self.assertEqual(results.count("ok"), min(3, len(days)))
+        self.assertEqual(approved, results.count("ok"))
+        self.assertEqual(balance.used, Decimal(approved))
+        self.assertLessEqual(balance.used, balance.allocated)
+
+    def test_same_request_approved_in_parallel_deducts_once(self):
+        leave = self._leave(next_monday())
+        balance = self._balance(leave.start_date.year)
+
+        results = self._approve_in_parallel([leave.pk] * self.THREADS)
+
+        balance.refresh_from_db()
+        self.assertEqual(results.count("ok"), 1)
+        self.assertEqual(balance.used, Decimal("1"))
+
+
+class BulkDecisionTests(TestCase):
+    """อนุมัติหลายใบพร้อมกัน: ใบที่ผ่านถูกบันทึก ใบที่ไม่ผ่านได้ข้อความเดียวกับการอนุมัติทีละใบ"""
+
+    def setUp(self):
+        self.manager = User.objects.create_user("manager", password="pw")
+        self.manager.groups.add(Group.objects.create(name="MANAGER"))
+        self.leave_type = LeaveType.objects.create(
+            name="Annual", code="AL", default_allocation=Decimal("2")
+        )
+        self.alice = self._profile("alice", self.manager)
+        self.bob = self._profile("bob", self.manager)
+        self.monday = next_monday()
+
+    def _profile(self, username, manager):
+        user = User.objects.create_user(username, password="pw")
+        profile = EmployeeProfile.objects.create(
+            user=user, employee_code=username.upper(), manager=manager
+        )
+        this_year = timezone.now().date().year
+        for year in (this_year, this_year + 1):
+            LeaveBalance.objects.get_or_create(
+                employee=profile, leave_type=self.leave_type, year=year,
+                defaults={"allocated": Decimal("2")},
+            )
+        return profile
+
+    def _leave(self, profile, start, end=None, status=LeaveRequest.STATUS_PENDING):
+        leave = LeaveRequest.objects.create(
+            employee=profile,
+            leave_type=self.leave_type,
+            start_date=start,
+            end_date=end or start,
+            reason="test",
+            status=status,
+        )
+        store_leave_days(leave)
+        return leave
+
+    def test_partial_success(self):
+        ok = self._leave(self.alice, self.monday)
+        no_balance = self._leave(
+            self.alice, self.monday + timedelta(days=1), self.monday + timedelta(days=2)
+        )
+        overlap = self._leave(self.bob, self.monday)
+        self._leave(self.bob, self.monday)  # ใบ pending ที่ซ้อนอยู่แล้ว (ไม่ได้เลือก)
+        approved = self._leave(
+            self.alice, self.monday + timedelta(days=7), status=LeaveRequest.STATUS_APPROVED
+        )
+        past = self._leave(self.bob, self.monday + timedelta(days=14))
+        LeaveRequest.objects.filter(pk=past.pk).update(
+            start_date=timezone.now().date() - timedelta(days=7),
+            end_date=timezone.now().date() - timedelta(days=7),
+        )
+
+        results = bulk_decide_leave_requests(
+            [ok.pk, no_balance.pk, overlap.pk, approved.pk, past.pk], self.manager, "approve"
+        )
+
+        self.assertEqual([r["leave"].pk for r in results],
+                         [ok.pk, no_balance.pk, overlap.pk, approved.pk, past.pk])
+        self.assertEqual([r["ok"] for r in results], [True, False, False, False, False])
+        messages = [r["message"] for r in results]
+        self.assertIn("Not enough leave balance", messages[1])
+        self.assertEqual(messages[2], "Leave request overlaps with existing leave.")
+        self.assertIn("Pending", messages[3])
+        self.assertEqual(messages[4], "Cannot request leave in the past.")
+
+        self.assertEqual(
+            set(LeaveRequest.objects.filter(status=LeaveRequest.STATUS_APPROVED)
+                .values_list("pk", flat=True)),
+            {ok.pk, approved.pk},
+        )
+        balance = LeaveBalance.objects.get(
+            employee=self.alice, leave_type=self.leave_type, year=self.monday.year
+        )
+        self.assertEqual(balance.used, Decimal("1"))
+
+    def test_view_reports_ids_outside_scope(self):
+        stranger = self._profile("stranger", User.objects.create_user("other", password="pw"))
+        mine = self._leave(self.alice, self.monday)
+        theirs = self._leave(stranger, self.monday)
+        self.client.force_login(self.manager)
+
+        response = self.client.post(
+            reverse("leave_app:manager_leave_list"),
+            {"action": "approve", "leave_ids": [mine.pk, theirs.pk]},
+            follow=True,
+        )
+
+        texts = [str(m) for m in response.context["messages"]]
+        self.assertTrue(any(f"#{theirs.pk}" in t for t in texts))
+        mine.refresh_from_db()
+        theirs.refresh_from_db()
+        self.assertEqual(mine.status, LeaveRequest.STATUS_APPROVED)
+        self.assertEqual(theirs.status, LeaveRequest.STATUS_PENDING)
+
+
+class ProvisionLeaveBalanceTests(TestCase):
+    def setUp(self):
+        self.annual = LeaveType.objects.create(name="Annual", code="AL", default_allocation=Decimal("10"))
+        self.sick = LeaveType.objects.create(name="Sick", code="SL", default_allocation=Decimal("30"))
+        self.profiles = [
+            EmployeeProfile.objects.create(
+                user=User.objects.create_user(f"emp{i}", password="pw"), employee_code=f"E{i:03d}"
+            )
+            for i in range(5)
+        ]
+
+    def test_creates_only_missing_rows_across_chunks(self):
+        kept = LeaveBalance.objects.create(
+            employee=self.profiles[0], leave_type=self.annual, year=2030,
+            allocated=Decimal("3"), used=Decimal("1"),
+        )
+
+        self.assertEqual(provision_leave_balances(2030, chunk_size=2), 5 * 2 - 1)
+        self.assertEqual(provision_leave_balances(2030, chunk_size=2), 0)
+
+        kept.refresh_from_db()
+        self.assertEqual((kept.allocated, kept.used), (Decimal("3"), Decimal("1")))
+        sick = LeaveBalance.objects.get(employee=self.profiles[4], leave_type=self.sick, year=2030)
+        self.assertEqual((sick.allocated, sick.used), (Decimal("30"), Decimal("0")))
+
+    def test_concurrently_created_rows_are_not_counted(self):
+        # อีก process สร้างแถวเดียวกันไปหลังจากเช็กแถวที่มีอยู่แล้ว (การเช็กจึงไม่เห็นแถวนี้)
+        LeaveBalance.objects.create(
+            employee=self.profiles[0], leave_type=self.annual, year=2030,
+            allocated=Decimal("3"), used=0,
+        )
+        with mock.patch.object(LeaveBalance.objects, "filter", lambda *a, **kw: LeaveBalance.objects.none()):
+            created = provision_leave_balances(2030, employee_ids=[self.profiles[0].pk])
+
+        self.assertEqual(created, 1)
+        self.assertEqual(LeaveBalance.objects.filter(year=2030).count(), 2)
+        self.assertEqual(
+            LeaveBalance.objects.get(employee=self.profiles[0], leave_type=self.annual, year=2030).allocated,
+            Decimal("3"),
+        )
+
+    def test_limited_to_given_employees_and_types(self):
+        created = provision_leave_balances(
+            2030, employee_ids=[self.profiles[1].pk], leave_types=[self.sick]
+        )
+
+        self.assertEqual(created, 1)
+        self.assertEqual(
+            list(LeaveBalance.objects.filter(year=2030).values_list("employee_id", "leave_type_id")),
+            [(self.profiles[1].pk, self.sick.pk)],
+        )
+
+    def test_new_leave_type_is_provisioned_after_commit(self):
+        year = timezone.now().year
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            maternity = LeaveType.objects.create(name="Maternity", code="ML", default_allocation=90)
+            self.assertFalse(LeaveBalance.objects.filter(leave_type=maternity).exists())
+
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(
+            LeaveBalance.objects.filter(leave_type=maternity, year=year).count(), len(self.profiles)
+        )
+
+    @mock.patch("leave_app.services.LEAVE_TYPE_SYNC_PROVISION_MAX_EMPLOYEES", 3)
+    def test_large_org_is_left_to_hr(self):
+        with self.assertLogs("leave_app.services", "WARNING"):
+            with self.captureOnCommitCallbacks(execute=True):
+                maternity = LeaveType.objects.create(name="Maternity", code="ML", default_allocation=90)
+
+        self.assertFalse(LeaveBalance.objects.filter(leave_type=maternity).exists())
+
+
+class EmailOutboxTests(TestCase):
+    """อีเมลต้องถูกเขียนลง outbox ก่อน แล้วค่อยส่งผ่าน locmem backend ตอน drain"""
+
+    def setUp(self):
+        self.manager = User.objects.create_user("manager", password="pw")
+        user = User.objects.create_user("employee", email="employee@example.com", password="pw")
+        profile = EmployeeProfile.objects.create(
+            user=user, employee_code="EMP0001", manager=self.manager
+        )
+        leave_type = LeaveType.objects.create(name="Unpaid", code="UP", is_paid=False)
+        start = next_monday()
+        self.leave = LeaveRequest.objects.create(
+            employee=profile,
+            leave_type=leave_type,
+            start_date=start,
+            end_date=start,
+            reason="test",
+        )
+
+    def test_status_change_is_queued_then_sent_in_batch(self):
+        approve_leave_request(self.leave, approver=self.manager)
+
+        self.assertEqual(len(mail.outbox), 0)
+        row = EmailOutbox.objects.get()
+        self.assertEqual(row.to, ["employee@example.com"])
+
+        self.assertEqual(send_outbox_batch(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        row.refresh_from_db()
+        self.assertEqual(row.status, EmailOutbox.STATUS_SENT)
+        self.assertEqual(send_outbox_batch(), (0, 0))
+
+    def test_failed_send_backs_off_then_dead_letters(self):
+        approve_leave_request(self.leave, approver=self.manager)
+        row = EmailOutbox.objects.get()
+
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=SMTPException("boom"),
+        ):
+            for attempt in range(1, EMAIL_OUTBOX_MAX_ATTEMPTS + 1):
+                self.assertEqual(send_outbox_batch(), (0, 1))
+                row.refresh_from_db()
+                self.assertEqual(row.attempts, attempt)
+                self.assertIn("boom", row.last_error)
+                # ยังไม่ถึงเวลาลองใหม่ → รอบนี้ต้องไม่หยิบแถวเดิม
+                if row.status == EmailOutbox.STATUS_PENDING:
+                    self.assertEqual(send_outbox_batch(), (0, 0))
+                    EmailOutbox.objects.filter(pk=row.pk).update(next_attempt_at=timezone.now())
+
+        self.assertEqual(row.status, EmailOutbox.STATUS_DEAD)
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class ManagerDigestTests(TestCase):
+    """อีเมลสรุปคำขอรออนุมัติ 1 ฉบับต่อหัวหน้า"""
+
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            "manager", email="manager@example.com", password="pw"
+        )
+        no_email = User.objects.create_user("silent", password="pw")
+        self.leave_type = LeaveType.objects.create(name="Unpaid", code="UP", is_paid=False)
+        self.old = self._leave("emp1", self.manager, next_monday())
+        self.new = self._leave("emp2", self.manager, next_monday() + timedelta(days=1))
+        self._leave("emp3", no_email, next_monday())
+        LeaveRequest.objects.filter(pk=self.old.pk).update(
+            created_at=timezone.now() - timedelta(hours=72)
+        )
+
+    def _leave(self, username, manager, start):
+        user = User.objects.create_user(username, password="pw")
+        profile = EmployeeProfile.objects.create(
+            user=user, employee_code=username.upper(), manager=manager
+        )
+        return LeaveRequest.objects.create(
+            employee=profile, leave_type=self.leave_type,
+            start_date=start, end_date=start, reason="test",
+        )
+
+    def test_one_digest_per_manager_lists_each_request_once(self):
+        self.assertEqual(send_manager_digests(sla_hours=48), 1)
+
+        row = EmailOutbox.objects.get()
+        self.assertEqual(row.to, ["manager@example.com"])
+        self.assertIn("2 รายการ", row.subject)
+        self.assertIn("เกินกำหนด 1", row.subject)
+        self.assertEqual(row.body.count("EMP1 "), 1)
+        self.assertEqual(row.body.count("EMP2 "), 1)
+        self.assertLess(row.body.index("EMP1 "), row.body.index("คำขออื่นที่รออนุมัติ"))
+
+    def test_no_overdue_section_within_sla(self):
+        send_manager_digests(sla_hours=24 * 7)
+        body = EmailOutbox.objects.get().body
+        self.assertNotIn("เกินกำหนด", body)
+        self.assertIn("คำขอที่รออนุมัติทั้งหมด", body)
+
+    def test_per_submission_email_unless_digest_enabled(self):
+        notify_leave_submitted(self.new)
+        self.assertEqual(
+            list(EmailOutbox.objects.values_list("to", flat=True)), [["manager@example.com"]]
+        )
+
+        EmailOutbox.objects.all().delete()
+        with mock.patch("leave_app.services.MANAGER_DIGEST_ENABLED", True):
+            notify_leave_submitted(self.new)
+        self.assertFalse(EmailOutbox.objects.exists())
+
+
+class LeaveQueryIndexTests(TestCase):
+    """
+    ตรวจ EXPLAIN ของ query หลักใน services / views ว่าใช้ index ไม่ใช่ scan ทั้งตาราง
+    ข้อมูลทดสอบมีขนาดใกล้ของจริง (200 คน × 40 ใบ กระจาย 3 ปี) และ ANALYZE แล้ว
+    planner จึงเลือก index เพราะคุ้มจริง ไม่ได้ถูกบังคับ
+    """
+
+    TABLE = "leave_app_leaverequest"
+    EMPLOYEES = 200
+    LEAVES_EACH = 40
+
+    @classmethod
+    def setUpTestData(cls):
+        if connection.vendor not in ("postgresql", "sqlite"):
+            return
+        cls.leave_type = LeaveType.objects.create(name="Annual", code="AL", default_allocation=10)
+        users = User.objects.bulk_create(
+            [User(username=f"emp{i}") for i in range(cls.EMPLOYEES)]
+        )
+        cls.profiles = EmployeeProfile.objects.bulk_create(
+            [EmployeeProfile(user=user, employee_code=f"EMP{i:04d}") for i, user in enumerate(users)]
+        )
+        statuses = [s for s, _ in LeaveRequest.STATUS_CHOICES]
+        start = next_monday()
+        leaves = []
+        for i, profile in enumerate(cls.profiles):
+            for j in range(cls.LEAVES_EACH):
+                day = start + timedelta(days=j * 27 + i % 20)
+                leaves.append(
+                    LeaveRequest(
+                        employee=profile,
+                        leave_type=cls.leave_type,
+                        start_date=day,
+                        end_date=day + timedelta(days=j % 3),
+                        reason="seed",
+                        status=statuses[(i + j) % 4],
+                    )
+                )
+        LeaveRequest.objects.bulk_create(leaves, batch_size=1000)
+        LeaveBalance.objects.bulk_create(
+            [
+                LeaveBalance(employee=profile, leave_type=cls.leave_type, year=start.year + k, allocated=10)
+                for profile in cls.profiles
+                for k in range(3)
+            ]
+        )
+        cls.start = start
+        with connection.cursor() as cursor:
+            if connection.vendor == "sqlite":
+                cursor.execute("ANALYZE")
+            else:
+                cursor.execute(f"ANALYZE {cls.TABLE}, leave_app_leavebalance")
+
+    def setUp(self):
+        if connection.vendor not in ("postgresql", "sqlite"):
+            self.skipTest("ตรวจ plan ได้เฉพาะ PostgreSQL / SQLite")
+
+    def assertIndexScan(self, qs, table=TABLE, ordered_scan=False):
+        """
+        ordered_scan=False: ต้องค้นผ่านเงื่อนไขของ index (Index Cond / SEARCH)
+        ordered_scan=True: ยอมให้ไล่ index ตามลำดับแล้วหยุดที่ LIMIT (หน้ารายการที่ไม่มีตัวกรอง)
+        """
+        plan = qs.explain()
+        if connection.vendor == "postgresql":
+            self.assertNotIn(f"Seq Scan on {table}", plan, plan)
+            self.assertIn("Index", plan, plan)
+            if not ordered_scan:
+                self.assertIn("Index Cond", plan, plan)
+        else:
+            lines = [line for line in plan.splitlines() if f" {table} " in line]
+            self.assertTrue(lines, plan)
+            for line in lines:
+                self.assertIn("USING", line, plan)
+                if not ordered_scan:
+                    self.assertIn("SEARCH", line, plan)
+
+    def test_unindexed_filter_is_detected(self):
+        # กันไม่ให้ assertIndexScan ผ่านเพราะ ordering อย่างเดียว
+        with self.assertRaises(AssertionError):
+            self.assertIndexScan(LeaveRequest.objects.filter(reason="seed"))
+
+    def test_overlap_check_uses_index(self):
+        # validate_leave_request
+        self.assertIndexScan(
+            LeaveRequest.objects.filter(
+                employee=self.profiles[0],
+                status__in=[LeaveRequest.STATUS_PENDING, LeaveRequest.STATUS_APPROVED],
+                start_date__lte=self.start + timedelta(days=3),
+                end_date__gte=self.start,
+            )
+        )
+        # bulk_decide_leave_requests
+        self.assertIndexScan(
+            LeaveRequest.objects.filter(
+                employee_id__in=[p.pk for p in self.profiles[:3]],
+                status__in=[LeaveRequest.STATUS_PENDING, LeaveRequest.STATUS_APPROVED],
+                start_date__lte=self.start + timedelta(days=3),
+                end_date__gte=self.start,
+            )
+        )
+
+    def test_employee_leave_list_uses_index(self):
+        # dashboard / leave_request_list ของพนักงาน
+        self.assertIndexScan(LeaveRequest.objects.filter(employee=self.profiles[0])[:5])
+
+    def test_hr_dashboard_pages_use_index(self):
+        # hr_leave_dashboard: หน้าแรกและหน้าถัดไปของ keyset
+        qs = filter_leaves({})
+        self.assertIndexScan(qs[:51], ordered_scan=True)
+        last = qs[49]
+        self.assertIndexScan(
+            qs.filter(
+                Q(created_at__lt=last.created_at) | Q(created_at=last.created_at, id__lt=last.pk)
+            )[:51],
+            ordered_scan=True,
+        )
+
+    def test_ceo_upcoming_leaves_use_index(self):
+        # ตาราง upcoming 7 วันของ CEO dashboard
+        self.assertIndexScan(
+            LeaveRequest.objects.filter(
+                status=LeaveRequest.STATUS_APPROVED,
+                start_date__lte=self.start + timedelta(days=7),
+                end_date__gte=self.start,
+            ).order_by("start_date")
+        )
+
+    def test_manager_pending_queue_uses_index(self):
+        # manager_leave_list / send_manager_digests
+        self.assertIndexScan(
+            LeaveRequest.objects.filter(
+                status=LeaveRequest.STATUS_PENDING,
+                employee_id__in=[p.pk for p in self.profiles[:3]],
+            ).order_by("created_at")
+        )
+
+    def test_employee_balances_use_index(self):
+        self.assertIndexScan(
+            LeaveBalance.objects.filter(employee=self.profiles[0], year=self.start.year),
+            table="leave_app_leavebalance",
+        )
+
+
+# บทบาทที่ cache ไว้ต้องไม่หมดอายุระหว่าง setup ที่ใช้เวลานาน (นับ query ไม่ขึ้นกับเวลา)
+@override_settings(ROLE_CACHE_TIMEOUT=None)
+class ManagerInboxQueryTests(TestCase):
+    """จำนวน query ของกล่องงานหัวหน้าต้องคงที่ ไม่ขึ้นกับจำนวนลูกน้อง / ประวัติ"""
+
+    def setUp(self):
+        self.manager = User.objects.create_user("manager", password="pw")
+        self.manager.groups.add(Group.objects.create(name="MANAGER"))
+        self.leave_type = LeaveType.objects.create(name="Annual", code="AL", default_allocation=10)
+        self.reports = 0
+        self.client.force_login(self.manager)
+
+    def add_reports(self, count: int, leaves_each: int, manager=None):
+        statuses = [s for s, _ in LeaveRequest.STATUS_CHOICES]
+        start = next_monday()
+        leaves = []
+        for _ in range(count):
+            self.reports += 1
+            user = User.objects.create_user(f"report{self.reports}", password="pw")
+            profile = EmployeeProfile.objects.create(
+                user=user, employee_code=f"R{self.reports:04d}", manager=manager or self.manager
+            )
+            for j in range(leaves_each):
+                day = start + timedelta(days=j)
+                status = statuses[j % len(statuses)]
+                leaves.append(
+                    LeaveRequest(
+                        employee=profile,
+                        leave_type=self.leave_type,
+                        start_date=day,
+                        end_date=day,
+                        reason="seed",
+                        status=status,
+                        approver=None if status == LeaveRequest.STATUS_PENDING else self.manager,
+                    )
+                )
+        LeaveRequest.objects.bulk_create(leaves)
+
+    def count_queries(self, params=None):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("leave_app:manager_leave_list"), params or {})
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_query_count_is_constant(self):
+        self.add_reports(1, 4)
+        self.count_queries()  # โหลดบทบาทเข้า cache
+        small, _ = self.count_queries()
+
+        self.add_reports(15, 40)
+        large, response = self.count_queries()
+        self.assertEqual(small, large)
+
+        # ประวัติถูกแบ่งหน้า หน้าถัดไปก็ใช้จำนวน query เท่าเดิม
+        page = response.context["page"]
+        self.assertEqual(len(response.context["history_leaves"]), page.page_size)
+        self.assertTrue(page.has_next)
+        next_page, response = self.count_queries({"after": page.next_cursor})
+        self.assertEqual(small, next_page)
+        self.assertEqual(response.context["status_counts"]["pending"], 15 * 10 + 1)
+
+    def test_scope_all_query_count_is_constant(self):
+        self.add_reports(1, 4)
+        lead = User.objects.get(username="report1")
+        self.count_queries({"scope": "all"})  # โหลดบทบาทเข้า cache
+        small, _ = self.count_queries({"scope": "all"})
+
+        # ลูกน้องของลูกน้อง (ระดับ 2) จำนวนมาก: ไม่มี <select> ทั้งสายงาน และรายการรออนุมัติถูกแบ่งหน้า
+        self.add_reports(15, 40, manager=lead)
+        large, response = self.count_queries({"scope": "all"})
+        self.assertEqual(small, large)
+        self.assertNotIn("subordinates", response.context)
+        self.assertEqual(response.context["status_counts"]["pending"], 15 * 10 + 1)
+
+        pending_page = response.context["pending_page"]
+        self.assertEqual(len(response.context["pending_leaves"]), pending_page.page_size)
+        self.assertTrue(pending_page.has_next)
+        next_page, response = self.count_queries(
+            {"scope": "all", "pending_after": pending_page.next_cursor}
+        )
+        self.assertEqual(small, next_page)
+        # cursor ของรายการรออนุมัติไม่กระทบหน้าประวัติ
+        self.assertFalse(response.context["page"].has_previous)
+        self.assertTrue(response.context["pending_page"].has_previous)
+
+    def test_subordinate_autocomplete_is_scoped(self):
+        self.add_reports(1, 0)
+        lead = User.objects.get(username="report1")
+        self.add_reports(1, 0, manager=lead)
+        outsider = User.objects.create_user("routsider", password="pw")
+        EmployeeProfile.objects.create(user=outsider, employee_code="R9999")
+
+        url = reverse("leave_app:manager_subordinate_autocomplete")
+        direct = self.client.get(url, {"q": "R"}).json()["results"]
+        self.assertEqual([r["label"] for r in direct], ["R0001 - report1"])
+        everyone = self.client.get(url, {"q": "R", "scope": "all"}).json()["results"]
+        self.assertEqual([r["label"] for r in everyone], ["R0001 - report1", "R0002 - report2"])
+
+    def test_filter_by_subordinate(self):
+        self.add_reports(3, 8)
+        profile = EmployeeProfile.objects.get(employee_code="R0002")
+        _, response = self.count_queries({"employee": profile.pk})
+        self.assertEqual(
+            {leave.employee_id for leave in response.context["pending_leaves"]}, {profile.pk}
+        )
+        self.assertEqual(sum(response.context["status_counts"].values()), 8)
+
+
+class _FakePool:
+    """แทน ProcessPoolExecutor (map ใน process เดียว) นับจำนวน pool ที่ถูกเปิด"""
+
+    opened = 0
+
+    def __init__(self, max_workers):
+        _FakePool.opened += 1
+        self.closed = False
+
+    def map(self, fn, items, chunksize=1):
+        return map(fn, items)
+
+    def shutdown(self):
+        self.closed = True
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class EmployeeImportTests(TestCase):
+    def setUp(self):
+        LeaveType.objects.create(name="Annual", code="AL", default_allocation=Decimal("10"))
+
+    def rows(self, *rows):
+        # (username, password, employee_code, dept_code, manager_username) เริ่มที่แถว 2 เหมือนไฟล์จริง
+        return [(row_no, row) for row_no, row in enumerate(rows, start=2)]
+
+    def import_rows(self, rows, chunk_size=500):
+        with EmployeeImporter() as importer:
+            for chunk in chunked(rows, chunk_size):
+                importer.import_chunk(chunk)
+        return importer
+
+    @mock.patch.object(employee_import, "EMPLOYEE_IMPORT_HASH_WORKERS", 1)
+    def test_later_chunks_see_users_and_departments_from_earlier_chunks(self):
+        importer = self.import_rows(
+            self.rows(
+                ("boss", "pw", "B001", "IT", None),
+                ("alice", "pw", "A001", "IT", "boss"),
+                ("bob", "pw", None, "HR", "alice"),
+                ("boss", "pw", "B001", "IT", None),  # มีโปรไฟล์แล้ว → นับเป็นแถวที่ประมวลผล
+            ),
+            chunk_size=2,
+        )
+
+        self.assertEqual((importer.processed, importer.created, importer.errors), (4, 3, []))
+        bob = EmployeeProfile.objects.select_related("manager").get(user__username="bob")
+        self.assertEqual(bob.manager.username, "alice")
+        self.assertEqual(bob.employee_code, f"EMP{bob.user_id:04d}")
+        self.assertEqual(set(Department.objects.values_list("code", flat=True)), {"IT", "HR"})
+        self.assertEqual(LeaveBalance.objects.count(), 3)
+        self.assertTrue(User.objects.get(username="alice").check_password("pw"))
+
+    @mock.patch.object(employee_import, "EMPLOYEE_IMPORT_HASH_WORKERS", 1)
+    def test_import_links_managers_and_rejects_cycle(self):
+        # "boss" มี User อยู่แล้วแต่ยังไม่มีโปรไฟล์ และเป็นหัวหน้าของ "mid" อยู่แล้ว
+        boss = User.objects.create_user("boss", password="pw")
+        mid = User.objects.create_user("mid", password="pw")
+        EmployeeProfile.objects.create(user=mid, employee_code="M001", manager=boss)
+
+        importer = self.import_rows(
+            self.rows(
+                ("boss", "pw", "B001", None, "mid"),  # วน → นำเข้าโดยไม่มีหัวหน้า
+                ("alice", "pw", "A001", None, "mid"),
+                ("bob", "pw", "B002", None, "alice"),
+            ),
+            chunk_size=2,
+        )
+
+        self.assertEqual([row_no for row_no, _ in importer.errors], [2])
+        self.assertIsNone(EmployeeProfile.objects.get(user=boss).manager_id)
+        bob = User.objects.get(username="bob")
+        self.assertEqual(
+            OrgClosure.objects.get(ancestor=boss, descendant=bob).depth, 3
+        )
+        self.assertEqual(
+            set(subordinate_profiles(boss, max_depth=None).values_list("employee_code", flat=True)),
+            {"M001", "A001", "B002"},
+        )
+        before = org_closure_rows()
+        rebuild_org_closure()
+        self.assertEqual(before, org_closure_rows())
+
+    @mock.patch.object(employee_import, "EMPLOYEE_IMPORT_HASH_WORKERS", 1)
+    def test_rejected_rows_leave_no_users_behind(self):
+        existing = User.objects.create_user("existing", password="pw")
+        EmployeeProfile.objects.create(user=existing, employee_code="E001")
+        # User ใหม่ลำดับที่ 2 ของไฟล์ ("auto") จะได้รหัสเริ่มต้นที่ชนกับโปรไฟล์ที่มีอยู่
+        taken = User.objects.create_user("taken", password="pw")
+        EmployeeProfile.objects.create(user=taken, employee_code=f"EMP{taken.pk + 2:04d}")
+
+        importer = self.import_rows(
+            self.rows(
+                ("dup_code", "pw", "E001", None, None),
+                ("first", "pw", "N001", None, None),
+                ("first", "pw", "N002", None, None),
+                ("same_code", "pw", "N001", None, None),
+                ("auto", "pw", None, None, None),
+            )
+        )
+
+        self.assertEqual([row_no for row_no, _ in importer.errors], [2, 4, 5, 6])
+        self.assertEqual(importer.created, 1)
+        self.assertFalse(
+            User.objects.filter(username__in=["dup_code", "same_code", "auto"]).exists()
+        )
+        # รันซ้ำหลังแก้ไฟล์แล้วนำเข้าได้ ไม่ถูกข้ามเพราะมี User ค้าง
+        importer = self.import_rows(self.rows(("dup_code", "pw", "E002", None, None)))
+        self.assertEqual((importer.created, importer.errors), (1, []))
+
+    @mock.patch.object(employee_import, "EMPLOYEE_IMPORT_HASH_WORKERS", 1)
+    def test_unknown_manager_imports_without_manager(self):
+        importer = self.import_rows(self.rows(("alice", "pw", "A001", None, "ghost")))
+
+        self.assertEqual(importer.created, 1)
+        self.assertEqual(len(importer.errors), 1)
+        self.assertIn("ghost", importer.errors[0][1])
+        self.assertIsNone(EmployeeProfile.objects.get(user__username="alice").manager_id)
+
+    @mock.patch.object(employee_import, "EMPLOYEE_IMPORT_HASH_WORKERS", 4)
+    @mock.patch.object(employee_import, "ProcessPoolExecutor", _FakePool)
+    def test_one_hash_pool_per_import(self):
+        _FakePool.opened = 0
+        rows = [(f"user{i}", "pw", f"U{i:03d}", None, None) for i in range(40)]
+
+        self.import_rows(self.rows(*rows), chunk_size=20)
+
+        self.assertEqual(_FakePool.opened, 1)
+        self.assertEqual(EmployeeProfile.objects.count(), 40)
+
+
+class TempMediaMixin:
+    """ไฟล์ที่ job สร้างลงโฟลเดอร์ชั่วคราว ไม่ปนกับ MEDIA_ROOT / PRIVATE_MEDIA_ROOT จริง"""
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        self.private_media = os.path.join(media, "private")
+        override = override_settings(
+            MEDIA_ROOT=os.path.join(media, "public"), PRIVATE_MEDIA_ROOT=self.private_media
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+@mock.patch.object(employee_import, "EMPLOYEE_IMPORT_HASH_WORKERS", 1)
+class EmployeeImportJobTests(TempMediaMixin, TestCase):
+
+    def make_job(self, count):
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.append(["username", "password", "employee_code", "department", "manager"])
+        for i in range(count):
+            ws.append([f"user{i}", "pw", f"U{i:03d}", None, None])
+        buf = io.BytesIO()
+        wb.save(buf)
+        return EmployeeImportJob.objects.create(file=ContentFile(buf.getvalue(), name="import.xlsx"))
+
+    def test_claim_skips_live_jobs_and_takes_stale_ones(self):
+        job = self.make_job(1)
+        done = self.make_job(1)
+        EmployeeImportJob.objects.filter(pk=done.pk).update(status=EmployeeImportJob.STATUS_DONE)
+
+        self.assertEqual(claim_import_job(), job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, EmployeeImportJob.STATUS_RUNNING)
+        self.assertIsNone(claim_import_job())
+
+        stale = timezone.now() - timedelta(seconds=employee_import.EMPLOYEE_IMPORT_STALE_SECONDS + 1)
+        EmployeeImportJob.objects.filter(pk=job.pk).update(heartbeat_at=stale)
+        self.assertEqual(claim_import_job(), job)
+
+    def test_failed_job_resumes_from_checkpoint(self):
+        job = self.make_job(5)
+        real_import_chunk = EmployeeImporter.import_chunk
+        calls = []
+
+        def failing_second_chunk(importer, rows):
+            calls.append(rows)
+            if len(calls) == 2:
+                raise RuntimeError("worker crashed")
+            real_import_chunk(importer, rows)
+
+        with mock.patch.object(EmployeeImporter, "import_chunk", failing_second_chunk):
+            with self.assertRaises(RuntimeError):
+                run_import_job(claim_import_job(), chunk_size=2)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, EmployeeImportJob.STATUS_FAILED)
+        self.assertEqual((job.last_row, job.created_count), (3, 2))
+        self.assertEqual(EmployeeProfile.objects.count(), 2)
+        self.assertIsNone(claim_import_job())
+
+        self.assertTrue(retry_import_job(job))
+        self.assertFalse(retry_import_job(job))
+        run_import_job(claim_import_job(), chunk_size=2)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, EmployeeImportJob.STATUS_DONE)
+        self.assertEqual((job.run_start_row, job.last_row, job.created_count), (3, 6, 5))
+        self.assertEqual(EmployeeProfile.objects.count(), 5)
+
+    def test_upload_is_private_and_deleted_when_done(self):
+        job = self.make_job(2)
+        path = job.file.path
+        self.assertTrue(path.startswith(self.private_media), path)
+        self.assertTrue(os.path.exists(path))
+        with self.assertRaises(ValueError):
+            job.file.url
+
+        run_import_job(claim_import_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, EmployeeImportJob.STATUS_DONE)
+        self.assertFalse(job.file)
+        self.assertFalse(os.path.exists(path))
+
+    def test_purge_removes_files_of_failed_and_abandoned_jobs(self):
+        old = timezone.now() - timedelta(days=employee_import.EMPLOYEE_IMPORT_RETENTION_DAYS + 1)
+        failed, abandoned, recent_failed, pending = (self.make_job(1) for _ in range(4))
+        EmployeeImportJob.objects.filter(pk=failed.pk).update(
+            status=EmployeeImportJob.STATUS_FAILED, finished_at=old
+        )
+        EmployeeImportJob.objects.filter(pk=abandoned.pk).update(
+            status=EmployeeImportJob.STATUS_RUNNING, created_at=old, heartbeat_at=old
+        )
+        EmployeeImportJob.objects.filter(pk=recent_failed.pk).update(
+            status=EmployeeImportJob.STATUS_FAILED, finished_at=timezone.now()
+        )
+        paths = {job.pk: job.file.path for job in (failed, abandoned, recent_failed, pending)}
+
+        self.assertEqual(employee_import.purge_import_jobs(), 2)
+        for job in (failed, abandoned):
+            job.refresh_from_db()
+            self.assertEqual(job.status, EmployeeImportJob.STATUS_FAILED)
+            self.assertFalse(job.file)
+            self.assertFalse(os.path.exists(paths[job.pk]))
+            # ไม่มีไฟล์แล้วลองใหม่ไม่ได้
+            self.assertFalse(retry_import_job(job))
+        self.assertTrue(os.path.exists(paths[recent_failed.pk]))
+        self.assertTrue(os.path.exists(paths[pending.pk]))
+        self.assertEqual(employee_import.purge_import_jobs(), 0)
+
+    def test_worker_stops_when_job_was_taken_over(self):
+        job = self.make_job(5)
+        real_import_chunk = EmployeeImporter.import_chunk
+
+        def taken_over_after_first_chunk(importer, rows):
+            real_import_chunk(importer, rows)
+            # worker อื่นรับ job ไประหว่างนี้
+            EmployeeImportJob.objects.filter(pk=job.pk).update(
+                run_started_at=timezone.now() + timedelta(minutes=1)
+            )
+
+        with mock.patch.object(EmployeeImporter, "import_chunk", taken_over_after_first_chunk):
+            run_import_job(claim_import_job(), chunk_size=2)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, EmployeeImportJob.STATUS_RUNNING)
+        self.assertEqual(job.last_row, 3)
+        self.assertEqual(EmployeeProfile.objects.count(), 2)
+
+
+class UserSessionTrackingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="old-Passw0rd!")
+
+    def tracked_keys(self):
+        return set(UserSession.objects.filter(user=self.user).values_list("session_key", flat=True))
+
+    def test_login_and_logout(self):
+        self.client.login(username="alice", password="old-Passw0rd!")
+        self.assertEqual(self.tracked_keys(), {self.client.session.session_key})
+
+        self.client.post(reverse("logout"))
+        self.assertEqual(self.tracked_keys(), set())
+
+    def test_rotated_key_replaces_old_one(self):
+        self.client.login(username="alice", password="old-Passw0rd!")
+        old_key = self.client.session.session_key
+
+        # update_session_auth_hash → cycle_key
+        self.client.post(
+            reverse("password_change"),
+            {
+                "old_password": "old-Passw0rd!",
+                "new_password1": "new-Passw0rd!",
+                "new_password2": "new-Passw0rd!",
+            },
+        )
+
+        new_key = self.client.session.session_key
+        self.assertNotEqual(new_key, old_key)
+        self.assertEqual(self.tracked_keys(), {new_key})
+
+    def test_clearsessions_prunes_expired_rows(self):
+        self.client.login(username="alice", password="old-Passw0rd!")
+        live_key = self.client.session.session_key
+        expired = Session.objects.create(
+            session_key="expired", session_data="", expire_date=timezone.now() - timedelta(days=1)
+        )
+        UserSession.objects.create(user=self.user, session_key=expired.session_key)
+        UserSession.objects.create(user=self.user, session_key="already-gone")
+
+        call_command("clearsessions", stdout=io.StringIO())
+
+        self.assertEqual(self.tracked_keys(), {live_key})
+
+
+class ExportJobTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.hr = User.objects.create_user("hr", password="pw")
+        self.hr.groups.add(Group.objects.create(name="HR"))
+        user = User.objects.create_user("employee", password="pw")
+        profile = EmployeeProfile.objects.create(user=user, employee_code="EMP0001")
+        leave_type = LeaveType.objects.create(name="Annual", code="AL")
+        LeaveRequest.objects.create(
+            employee=profile, leave_type=leave_type,
+            start_date=next_monday(), end_date=next_monday(), reason="test",
+        )
+
+    def run_worker(self):
+        call_command("run_export_jobs", stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_worker_builds_file(self):
+        job = LeaveExportJob.objects.create(created_by=self.hr, params={})
+
+        self.run_worker()
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.row_count), (LeaveExportJob.STATUS_DONE, 1))
+        # อยู่นอก MEDIA_ROOT ไม่มี URL และชื่อไฟล์เดาจากเลข job / เวลาไม่ได้
+        self.assertTrue(job.file.path.startswith(self.private_media), job.file.path)
+        with self.assertRaises(ValueError):
+            job.file.url
+        self.assertRegex(os.path.basename(job.file.name), r"^[0-9a-f]{32}\.xlsx$")
+        self.assertTrue(job.filename.startswith("leave_requests_"))
+        with job.file.open("rb") as f:
+            rows = list(openpyxl.load_workbook(f, read_only=True).active.values)
+        self.assertEqual(rows[0][1], "Employee code")
+        self.assertEqual(rows[1][1], "EMP0001")
+
+    def test_download_is_hr_only(self):
+        job = LeaveExportJob.objects.create(created_by=self.hr, params={})
+        pending = LeaveExportJob.objects.create(created_by=self.hr, params={})
+        self.run_worker()
+        url = reverse("leave_app:hr_export_job_download", args=[job.pk])
+
+        self.client.login(username="employee", password="pw")
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.force_login(self.hr)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(job.filename, response["Content-Disposition"])
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"PK"))
+
+        LeaveExportJob.objects.filter(pk=pending.pk).update(status=LeaveExportJob.STATUS_PENDING)
+        pending_url = reverse("leave_app:hr_export_job_download", args=[pending.pk])
+        self.assertEqual(self.client.get(pending_url).status_code, 404)
+
+    def test_worker_purges_expired_files(self):
+        old = LeaveExportJob.objects.create(created_by=self.hr, params={})
+        recent = LeaveExportJob.objects.create(created_by=self.hr, params={})
+        self.run_worker()
+        old.refresh_from_db()
+        storage, name = old.file.storage, old.file.name
+        LeaveExportJob.objects.filter(pk=old.pk).update(finished_at=timezone.now() - timedelta(days=8))
+
+        self.run_worker()
+
+        self.assertFalse(LeaveExportJob.objects.filter(pk=old.pk).exists())
+        self.assertFalse(storage.exists(name))
+        recent.refresh_from_db()
+        self.assertTrue(recent.file.storage.exists(recent.file.name))
+
+
+class LeaveCsvExportTests(TestCase):
+    def setUp(self):
+        dept = Department.objects.create(code="IT", name="IT")
+        annual = LeaveType.objects.create(name="Annual", code="AL", allow_half_day=True)
+        named = User.objects.create_user("alice", first_name="Alice", last_name="A", password="pw")
+        unnamed = User.objects.create_user("bob", password="pw")
+        profiles = [
+            EmployeeProfile.objects.create(user=named, employee_code="E001", department=dept),
+            EmployeeProfile.objects.create(user=unnamed, employee_code="E002"),
+        ]
+        start = next_monday()
+        for i in range(5):
+            LeaveRequest.objects.create(
+                employee=profiles[i % 2], leave_type=annual,
+                start_date=start + timedelta(days=7 * i), end_date=start + timedelta(days=7 * i),
+                half_day=i == 3, reason=f"line {i}\nsecond line",
+            )
+        # created_at ซ้ำกันข้ามขอบ chunk ต้องตัดด้วย id ต่อ
+        LeaveRequest.objects.filter(reason__startswith="line 1").update(
+            created_at=LeaveRequest.objects.get(reason__startswith="line 2").created_at
+        )
+        self.qs = filter_leaves({})
+
+    def as_text(self, chunks):
+        return "".join(c.decode() if isinstance(c, bytes) else c for c in chunks)
+
+    def test_csv_rows(self):
+        text = self.as_text(iter_leaves_csv(self.qs))
+
+        self.assertNotIn("\r", text)
+        rows = list(csv.reader(io.StringIO(text)))
+        self.assertEqual(rows[0][1:3], ["Employee code", "Employee name"])
+        self.assertEqual(len(rows), 6)
+        by_reason = {row[-1]: row for row in rows[1:]}
+        self.assertEqual(by_reason["line 0 second line"][1:4], ["E001", "Alice A", "IT"])
+        self.assertEqual(by_reason["line 1 second line"][1:4], ["E002", "bob", ""])
+        self.assertEqual(by_reason["line 3 second line"][7], "Yes")
+
+    def test_copy_matches_orm(self):
+        if not copy_export_supported(self.qs):
+            self.skipTest("COPY ใช้ได้เฉพาะ PostgreSQL ผ่าน psycopg2")
+
+        orm = self.as_text(_iter_leaves_csv_orm(self.qs))
+        self.assertEqual(self.as_text(_iter_leaves_csv_copy(self.qs, chunk_size=2)), orm)
+        self.assertEqual(self.as_text(_iter_leaves_csv_copy(self.qs, chunk_size=100)), orm)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user("employee", password="pw")
+        profile = EmployeeProfile.objects.create(user=user, employee_code="E001")
+        leave_type = LeaveType.objects.create(name="Unpaid", code="UP", is_paid=False)
+        base = timezone.now() - timedelta(days=30)
+        for i in range(8):
+            leave = LeaveRequest.objects.create(
+                employee=profile, leave_type=leave_type,
+                start_date=next_monday(i + 1), end_date=next_monday(i + 1), reason=f"r{i}",
+            )
+            # เวลาซ้ำกันเป็นคู่ ลำดับภายในคู่ตัดสินด้วย id
+            LeaveRequest.objects.filter(pk=leave.pk).update(created_at=base + timedelta(hours=i // 2))
+        self.qs = LeaveRequest.objects.all()
+        self.expected = list(self.qs.order_by("-created_at", "-id").values_list("pk", flat=True))
+
+    def page(self, **params):
+        query = QueryDict(mutable=True)
+        query.update(params)
+        return keyset_paginate(self.qs, query, page_size=3)
+
+    def test_cursor_round_trip(self):
+        value = timezone.now()
+        self.assertEqual(decode_cursor(encode_cursor(value, 42)), (value, 42))
+
+    def test_tampered_cursor_is_ignored(self):
+        naive = base64.urlsafe_b64encode(b"2026-01-01T00:00:00|5").decode()
+        for token in ["", "!!!", "bm90LWEtY3Vyc29y", base64.urlsafe_b64encode(b"x|y").decode(), naive]:
+            self.assertIsNone(decode_cursor(token), token)
+
+        first = self.page(after="bm90LWEtY3Vyc29y")
+        self.assertEqual([leave.pk for leave in first.items], self.expected[:3])
+        self.assertFalse(first.has_previous)
+
+    def test_walk_forward_then_back(self):
+        pages = [self.page()]
+        while pages[-1].has_next:
+            pages.append(self.page(after=pages[-1].next_cursor))
+
+        self.assertEqual([[leave.pk for leave in p.items] for p in pages],
+                         [self.expected[0:3], self.expected[3:6], self.expected[6:8]])
+        self.assertFalse(pages[0].has_previous)
+
+        back = self.page(before=pages[2].prev_cursor)
+        self.assertEqual([leave.pk for leave in back.items], self.expected[3:6])
+        first = self.page(before=back.prev_cursor)
+        self.assertEqual([leave.pk for leave in first.items], self.expected[0:3])
+        self.assertFalse(first.has_previous)
+        self.assertTrue(first.has_next)
+
+    def test_links_keep_filters(self):
+        page = self.page()
+        params = QueryDict("status=PENDING&after=old&page_size=25")
+        self.assertEqual(
+            QueryDict(page.next_query(params)).dict(),
+            {"status": "PENDING", "page_size": "25", "after": page.next_cursor},
+        )
+
+
+class EmployeeSearchTests(TestCase):
+    def setUp(self):
+        self.profiles = {}
+        for code, username, first, last in [
+            ("E1001", "somchai", "Somchai", "Jaidee"),
+            ("E1002", "anong", "Anong", "Boonmee"),
+            ("X2001", "boon", "Prasit", "Srisuk"),
+            ("X2002", "e1", "Chai", "Boonsri"),
+        ]:
+            user = User.objects.create_user(username, first_name=first, last_name=last, password="pw")
+            self.profiles[username] = EmployeeProfile.objects.create(user=user, employee_code=code)
+
+    def usernames(self, term, **kwargs):
+        return [p.user.username for p in search_employees(term, **kwargs)]
+
+    def test_prefix_on_every_field_ignoring_case(self):
+        self.assertEqual(self.usernames("e100"), ["somchai", "anong"])
+        self.assertEqual(self.usernames("SOM"), ["somchai"])
+        self.assertEqual(self.usernames("prasit"), ["boon"])
+        self.assertEqual(self.usernames("boon"), ["anong", "boon", "e1"])
+        self.assertEqual(self.usernames("mee"), [])
+        self.assertEqual(self.usernames("  "), [])
+
+    def test_limit_counts_each_employee_once(self):
+        # "e1" ตรงทั้งรหัส E1001 / E1002 และ username e1
+        self.assertEqual(self.usernames("e1"), ["somchai", "anong", "e1"])
+        results = self.usernames("e1", limit=2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(set(results)), 2)
+
+    def test_active_only(self):
+        User.objects.filter(username="anong").update(is_active=False)
+        self.assertEqual(self.usernames("e100"), ["somchai", "anong"])
+        self.assertEqual(self.usernames("e100", active_only=True), ["somchai"])
+
+    def test_autocomplete_view(self):
+        hr = User.objects.create_user("hr", password="pw")
+        hr.groups.add(Group.objects.create(name="HR"))
+        self.client.force_login(hr)
+
+        response = self.client.get(reverse("leave_app:hr_employee_autocomplete"), {"q": "anong"})
+
+        self.assertEqual(
+            [r["id"] for r in response.json()["results"]], [self.profiles["anong"].pk]
+        )
+
+
+class EmployeeDirectorySearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            "somchai", first_name="Somchai", last_name="Jaidee", password="pw"
+        )
+        self.profile = EmployeeProfile.objects.create(user=self.user, employee_code="E1001")
+        other = User.objects.create_user("anong", first_name="Anong", password="pw")
+        EmployeeProfile.objects.create(user=other, employee_code="E1002")
+
+    def search(self, term):
+        return list(
+            search_employee_directory(EmployeeProfile.objects.order_by("employee_code"), term)
+            .values_list("employee_code", flat=True)
+        )
+
+    def test_substring_across_fields(self):
+        self.assertEqual(self.search("CHAI  jai"), ["E1001"])
+        self.assertEqual(self.search("e100"), ["E1001", "E1002"])
+        self.assertEqual(self.search("nong"), ["E1002"])
+        self.assertEqual(self.search(""), ["E1001", "E1002"])
+        self.assertEqual(self.search("nobody"), [])
+
+    def test_search_text_follows_profile_and_user_edits(self):
+        self.profile.employee_code = "HR-7"
+        self.profile.save()
+        self.assertEqual(self.search("hr-7"), ["HR-7"])
+
+        self.user.last_name = "Rakdee"
+        self.user.save()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.search_text, "hr-7 somchai somchai rakdee")
+        self.assertEqual(self.search("jaidee"), [])
+
+    def test_login_does_not_rewrite_search_text(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.user.save(update_fields=["last_login"])
+        self.assertFalse(any("search_text" in q["sql"] for q in ctx.captured_queries))
+
+
+class LeaveOverlapTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user("employee", password="pw")
+        self.profile = EmployeeProfile.objects.create(user=user, employee_code="E001")
+        self.leave_type = LeaveType.objects.create(name="Unpaid", code="UP", is_paid=False)
+        self.monday = next_monday()
+
+    def leave(self, start, end, status=LeaveRequest.STATUS_PENDING):
+        return LeaveRequest.objects.create(
+            employee=self.profile, leave_type=self.leave_type,
+            start_date=start, end_date=end, reason="test", status=status,
+        )
+
+    def validate(self, start, end):
+        return validate_leave_request(self.profile, self.leave_type, start, end)
+
+    def test_constraint_detected_from_catalog(self):
+        self.assertEqual(overlap_enforced_by_db(), connection.vendor == "postgresql")
+
+    def test_validation_checks_overlap_only_without_constraint(self):
+        if connection.vendor == "postgresql":
+            self.skipTest("บน PostgreSQL constraint ไม่ยอมให้สร้างข้อมูลซ้อนตั้งต้น")
+        self.leave(self.monday, self.monday + timedelta(days=2))
+        wednesday = self.monday + timedelta(days=2)
+
+        with mock.patch("leave_app.services.overlap_enforced_by_db", return_value=False):
+            with self.assertRaisesMessage(ValidationError, LEAVE_OVERLAP_MESSAGE):
+                self.validate(wednesday, wednesday)
+        with mock.patch("leave_app.services.overlap_enforced_by_db", return_value=True):
+            self.assertEqual(self.validate(wednesday, wednesday), Decimal("1"))
+
+    def test_save_turns_constraint_violation_into_validation_error(self):
+        leave = LeaveRequest(
+            employee=self.profile, leave_type=self.leave_type,
+            start_date=self.monday, end_date=self.monday, reason="test",
+        )
+        violation = IntegrityError('conflicting key value violates exclusion constraint "leave_no_overlap"')
+        with mock.patch.object(LeaveRequest, "save", side_effect=violation):
+            with self.assertRaisesMessage(ValidationError, LEAVE_OVERLAP_MESSAGE):
+                save_leave_request(leave)
+
+        with mock.patch.object(LeaveRequest, "save", side_effect=IntegrityError("other")):
+            with self.assertRaises(IntegrityError):
+                save_leave_request(leave)
+
+    @skipUnless(connection.vendor == "postgresql", "constraint มีเฉพาะ PostgreSQL")
+    def test_database_rejects_overlap(self):
+        self.leave(self.monday, self.monday + timedelta(days=2))
+        leave = LeaveRequest(
+            employee=self.profile, leave_type=self.leave_type,
+            start_date=self.monday + timedelta(days=1), end_date=self.monday + timedelta(days=1),
+            reason="test",
+        )
+        with self.assertRaisesMessage(ValidationError, LEAVE_OVERLAP_MESSAGE):
+            save_leave_request(leave)
+        # transaction ของผู้เรียกยังใช้ต่อได้
+        self.assertEqual(LeaveRequest.objects.count(), 1)
+
+    def test_migration_lists_existing_overlaps(self):
+        if connection.vendor == "postgresql":
+            self.skipTest("บน PostgreSQL constraint ไม่ยอมให้สร้างข้อมูลซ้อนตั้งต้น")
+        migration = importlib.import_module("leave_app.migrations.0014_leave_no_overlap")
+        first = self.leave(self.monday, self.monday + timedelta(days=2))
+        clash = self.leave(self.monday + timedelta(days=2), self.monday + timedelta(days=3))
+        self.leave(self.monday, self.monday, status=LeaveRequest.STATUS_REJECTED)
+        self.leave(self.monday + timedelta(days=7), self.monday + timedelta(days=7))
+
+        self.assertEqual(migration.find_overlaps(connection), [(first.pk, clash.pk)])
@@ -15,15 +15,21 @@ urlpatterns = [
     # Manager
     path("manager/leaves/", views.manager_leave_list, name="manager_leave_list"),
     path("manager/leaves/<int:pk>/", views.manager_leave_detail, name="manager_leave_detail"),
+    path("manager/subordinates/autocomplete/", views.manager_subordinate_autocomplete, name="manager_subordinate_autocomplete"),
 
     #  HR
     path("hr/leaves/", views.hr_leave_dashboard, name="hr_leave_dashboard"),
     path("hr/leaves/export/csv/", views.hr_export_leaves_csv, name="hr_export_leaves_csv"),
     path("hr/leaves/export/excel/", views.hr_export_leaves_excel, name="hr_export_leaves_excel"),
+    path("hr/leaves/export/jobs/<int:pk>/download/", views.hr_export_job_download, name="hr_export_job_download"),
 
     path("hr/employees/", views.hr_employee_list, name="hr_employee_list"),
+    path("hr/employees/autocomplete/", views.hr_employee_autocomplete, name="hr_employee_autocomplete"),
     path("hr/employees/new/", views.hr_employee_create, name="hr_employee_create"),
     path("hr/employees/import/", views.hr_employee_import, name="hr_employee_import"),
+    path("hr/employees/import/jobs/<int:pk>/", views.hr_employee_import_job, name="hr_employee_import_job"),
+    path("hr/employees/import/jobs/<int:pk>/retry/", views.hr_employee_import_job_retry, name="hr_employee_import_job_retry"),
+    path("hr/employees/import/jobs/<int:pk>/status/", views.hr_employee_import_job_status, name="hr_employee_import_job_status"),
     path("hr/employees/<int:pk>/", views.hr_employee_edit, name="hr_employee_edit"),
     path("hr/employees/<int:pk>/toggle-active/", views.hr_employee_toggle_active, name="hr_employee_toggle_active"),
 
@@ -11,6 +11,7 @@ from .views_employee import (
 from .views_manager import (
     manager_leave_list,
     manager_leave_detail,
+    manager_subordinate_autocomplete,
 )
 
 # รวม view ฝั่ง HR
@@ -21,9 +22,14 @@ from .views_hr import (
     hr_employee_edit,
     hr_employee_toggle_active,
     hr_employee_import,
+    hr_employee_import_job,
+    hr_employee_import_job_retry,
+    hr_employee_import_job_status,
     hr_leave_balance_manage,
+    hr_employee_autocomplete,
     hr_export_leaves_csv,
     hr_export_leaves_excel,
+    hr_export_job_download,
 )
 
 # รวม view ฝั่ง CEO
@@ -1,140 +1,159 @@
 import json
-from datetime import timedelta
+from collections import Counter
+from datetime import date, timedelta
 
 from django.contrib.auth.decorators import user_passes_test
-from django.db.models import Count
-from django.db.models.functions import TruncMonth
+from django.db.models import F, Q, Sum
 from django.shortcuts import render
 from django.utils import timezone
 
-from .models import EmployeeProfile, LeaveRequest
-from .services import calculate_working_days
+from .models import EmployeeProfile, LeaveDayAllocation, LeaveRequest, LeaveStatsRollup
+from .caching import get_or_compute, versioned_cache_key
+from .roles import ROLE_CEO, has_role
+from .services import DASHBOARD_VERSION_KEY
 
 
 def is_ceo(user):
-    return user.is_superuser or user.groups.filter(name="CEO").exists()
+    return user.is_superuser or has_role(user, ROLE_CEO)
 
 
-@user_passes_test(is_ceo)
-def ceo_dashboard(request):
-    year_param = request.GET.get("year")
-    try:
-        year = int(year_param) if year_param else timezone.now().year
-    except ValueError:
-        year = timezone.now().year
+def _chart_series(counts: Counter):
+    """(labels, counts) เรียงจากมากไปน้อย"""
+    items = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))
+    return [label for label, _ in items], [count for _, count in items]
 
+
+def _dashboard_stats(year: int) -> dict:
+    """KPI, top 5 และข้อมูลกราฟของปี year (ผลลัพธ์ถูก cache ตาม DASHBOARD_VERSION_KEY)"""
     # พนักงานที่ยัง Active
     total_employees = EmployeeProfile.objects.filter(
         user__is_active=True
     ).count()
 
-    # คำขอทุกสถานะในปีนั้น
-    qs_year = LeaveRequest.objects.filter(start_date__year=year)
-
-    total_requests = qs_year.count()
-    pending_count = qs_year.filter(status=LeaveRequest.STATUS_PENDING).count()
-    approved_count = qs_year.filter(status=LeaveRequest.STATUS_APPROVED).count()
-    rejected_count = qs_year.filter(status=LeaveRequest.STATUS_REJECTED).count()
-    cancelled_count = qs_year.filter(status=LeaveRequest.STATUS_CANCELLED).count()
+    # ---------- คำขอทุกสถานะในปีนั้น: อ่านจากตารางสรุป LeaveStatsRollup ----------
+    # แถวละ (เดือน, แผนก, ประเภท) รวมยอดแยกสถานะด้วย Sum(filter=...)
+    # จำนวนแถวไม่ขึ้นกับจำนวนคำขอ (rollup อัปเดตทุกครั้งที่คำขอเปลี่ยน ดู rollups.py)
+    stats = (
+        LeaveStatsRollup.objects.filter(year=year)
+        .values("month", "department__name", "leave_type__name")
+        .annotate(
+            total=Sum("request_count"),
+            pending=Sum("request_count", filter=Q(status=LeaveRequest.STATUS_PENDING)),
+            approved=Sum("request_count", filter=Q(status=LeaveRequest.STATUS_APPROVED)),
+            rejected=Sum("request_count", filter=Q(status=LeaveRequest.STATUS_REJECTED)),
+            cancelled=Sum("request_count", filter=Q(status=LeaveRequest.STATUS_CANCELLED)),
+        )
+        .order_by()
+    )
 
-    # ✅ ใช้เฉพาะใบที่ Approved สำหรับการนับ "วันลา"
-    approved_qs_year = (
-        qs_year.filter(status=LeaveRequest.STATUS_APPROVED)
-        .select_related("employee__user", "employee__department", "leave_type")
+    kpi = Counter()
+    monthly = Counter()
+    by_department = Counter()
+    by_leave_type = Counter()
+    for row in stats:
+        if not row["total"]:
+            continue
+        for key in ("total", "pending", "approved", "rejected", "cancelled"):
+            kpi[key] += row[key] or 0
+        monthly[row["month"]] += row["total"]
+        by_department[row["department__name"] or "No Dept"] += row["total"]
+        by_leave_type[row["leave_type__name"]] += row["total"]
+
+    # ✅ ใช้เฉพาะใบที่ Approved สำหรับการนับ "วันลา" (อ่านจากวันลาแยกปีที่บันทึกไว้)
+    # view นี้อ่านอย่างเดียว ใบเก่าที่ยังไม่เคยบันทึกวันลาให้รัน `backfill_leave_days` ก่อน
+    # อ่านจาก LeaveDayAllocation (วันทำงานที่ตัดเสาร์-อาทิตย์และวันหยุดไว้แล้วตอนบันทึก)
+    # ดึงกลับมาแค่ยอดรวมกับ 5 อันดับ ไม่ขึ้นกับจำนวนพนักงาน
+    approved_days = LeaveDayAllocation.objects.filter(
+        year=year,
+        leave_request__status=LeaveRequest.STATUS_APPROVED,
     )
 
     # ---------- KPI: total & avg leave days ----------
-    total_leave_days = 0.0
-
-    # สำหรับอันดับแผนก / พนักงาน
-    dept_days: dict[str, float] = {}
-    emp_days: dict[EmployeeProfile, float] = {}
-
-    for leave in approved_qs_year:
-        days = float(
-            calculate_working_days(
-                leave.start_date,
-                leave.end_date,
-                leave.half_day,
-            )
-        )
-        total_leave_days += days
-
-        # รวมวันลาเป็นรายแผนก
-        dept_name = leave.employee.department.name if leave.employee.department else "No Dept"
-        dept_days[dept_name] = dept_days.get(dept_name, 0.0) + days
-
-        # รวมวันลาเป็นรายพนักงาน
-        emp = leave.employee
-        emp_days[emp] = emp_days.get(emp, 0.0) + days
+    total_leave_days = float(approved_days.aggregate(total=Sum("days"))["total"] or 0)
 
     avg_leave_days_per_employee = (
         total_leave_days / total_employees if total_employees else 0.0
     )
 
-    # ---------- Top Departments (by leave days) ----------
-    top_departments = sorted(
-        dept_days.items(),
-        key=lambda x: x[1],
-        reverse=True,
-    )[:5]
-
+    # ---------- Top Departments / Top Employees (by leave days) ----------
     top_departments = [
-        {"name": name, "days": days} for name, days in top_departments
+        {
+            "name": row["leave_request__employee__department__name"] or "No Dept",
+            "days": float(row["days"]),
+        }
+        for row in approved_days.values("leave_request__employee__department__name")
+        .annotate(days=Sum("days"))
+        # ยอดเท่ากันเรียงตามชื่อ แถวที่ไม่มีแผนกไว้ท้าย (SQLite / PostgreSQL เรียง NULL ต่างกัน)
+        .order_by("-days", F("leave_request__employee__department__name").asc(nulls_last=True))[:5]
     ]
 
-    # ---------- Top Employees (by leave days) ----------
-    top_employees_raw = sorted(
-        emp_days.items(),
-        key=lambda x: x[1],
-        reverse=True,
-    )[:5]
-
     top_employees = []
-    for emp, days in top_employees_raw:
-        user = emp.user
+    for row in (
+        approved_days.values(
+            "leave_request__employee",
+            "leave_request__employee__employee_code",
+            "leave_request__employee__user__first_name",
+            "leave_request__employee__user__last_name",
+            "leave_request__employee__user__username",
+            "leave_request__employee__department__name",
+        )
+        .annotate(days=Sum("days"))
+        .order_by("-days", "leave_request__employee__employee_code")[:5]
+    ):
+        full_name = (
+            f"{row['leave_request__employee__user__first_name']} "
+            f"{row['leave_request__employee__user__last_name']}"
+        ).strip()
         top_employees.append(
             {
-                "employee": emp,
-                "code": emp.employee_code,
-                "name": user.get_full_name() or user.username,
-                "department": emp.department.name if emp.department else "-",
-                "days": days,
+                "code": row["leave_request__employee__employee_code"],
+                "name": full_name or row["leave_request__employee__user__username"],
+                "department": row["leave_request__employee__department__name"] or "-",
+                "days": float(row["days"]),
             }
         )
 
-    # ---------- กราฟจำนวนคำขอลาต่อเดือน ----------
-    monthly_qs = (
-        qs_year.annotate(month=TruncMonth("start_date"))
-        .values("month")
-        .annotate(count=Count("id"))
-        .order_by("month")
-    )
+    # ---------- กราฟจำนวนคำขอลาต่อเดือน / ตามแผนก / ตามประเภทการลา ----------
+    months = sorted(monthly)
+    monthly_labels = [date(year, m, 1).strftime("%b") for m in months]
+    monthly_counts = [monthly[m] for m in months]
 
-    monthly_labels = [item["month"].strftime("%b") for item in monthly_qs]
-    monthly_counts = [item["count"] for item in monthly_qs]
+    department_labels, department_counts = _chart_series(by_department)
+    leave_type_labels, leave_type_counts = _chart_series(by_leave_type)
 
-    # ---------- กราฟตามแผนก ----------
-    dept_qs = (
-        qs_year.values("employee__department__name")
-        .annotate(count=Count("id"))
-        .order_by("-count")
-    )
+    return {
+        "total_employees": total_employees,
+        "total_requests": kpi["total"],
+        "pending_count": kpi["pending"],
+        "approved_count": kpi["approved"],
+        "rejected_count": kpi["rejected"],
+        "cancelled_count": kpi["cancelled"],
+        "total_leave_days": total_leave_days,
+        "avg_leave_days_per_employee": avg_leave_days_per_employee,
+        "top_departments": top_departments,
+        "top_employees": top_employees,
+        "monthly_labels_json": json.dumps(monthly_labels),
+        "monthly_counts_json": json.dumps(monthly_counts),
+        "department_labels_json": json.dumps(department_labels),
+        "department_counts_json": json.dumps(department_counts),
+        "leave_type_labels_json": json.dumps(leave_type_labels),
+        "leave_type_counts_json": json.dumps(leave_type_counts),
+    }
 
-    department_labels = [
-        (item["employee__department__name"] or "No Dept") for item in dept_qs
-    ]
-    department_counts = [item["count"] for item in dept_qs]
 
-    # ---------- กราฟตามประเภทการลา ----------
-    type_qs = (
-        qs_year.values("leave_type__name")
-        .annotate(count=Count("id"))
-        .order_by("-count")
-    )
+@user_passes_test(is_ceo)
+def ceo_dashboard(request):
+    year_param = request.GET.get("year")
+    try:
+        year = int(year_param) if year_param else timezone.now().year
+    except ValueError:
+        year = timezone.now().year
 
-    leave_type_labels = [item["leave_type__name"] for item in type_qs]
-    leave_type_counts = [item["count"] for item in type_qs]
+    # สถิติทั้งปีอ่านจาก cache ที่ผูกกับ version ของข้อมูล (ข้อมูลเปลี่ยน → key ใหม่ → คำนวณใหม่ครั้งเดียว)
+    stats = get_or_compute(
+        versioned_cache_key("ceo_dashboard", DASHBOARD_VERSION_KEY, year),
+        lambda: _dashboard_stats(year),
+    )
 
     # ✅ ตารางลาช่วงนี้ (วันนี้ + 7 วันถัดไป) เฉพาะ Approved
     today = timezone.now().date()
@@ -153,22 +172,7 @@ def ceo_dashboard(request):
 
     context = {
         "year": year,
-        "total_employees": total_employees,
-        "total_requests": total_requests,
-        "pending_count": pending_count,
-        "approved_count": approved_count,
-        "rejected_count": rejected_count,
-        "cancelled_count": cancelled_count,
-        "total_leave_days": total_leave_days,
-        "avg_leave_days_per_employee": avg_leave_days_per_employee,
-        "top_departments": top_departments,
-        "top_employees": top_employees,
-        "monthly_labels_json": json.dumps(monthly_labels),
-        "monthly_counts_json": json.dumps(monthly_counts),
-        "department_labels_json": json.dumps(department_labels),
-        "department_counts_json": json.dumps(department_counts),
-        "leave_type_labels_json": json.dumps(leave_type_labels),
-        "leave_type_counts_json": json.dumps(leave_type_counts),
+        **stats,
         "upcoming_leaves": upcoming_leaves,
     }
     return render(request, "leave_app/ceo/ceo_dashboard.html", context)
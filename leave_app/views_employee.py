@@ -1,11 +1,18 @@
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 
 from .forms import LeaveRequestForm
 from .models import EmployeeProfile, LeaveBalance, LeaveRequest
-from .services import notify_leave_submitted, get_employee_leave_balances
+from .services import (
+    get_employee_leave_balances,
+    notify_leave_submitted,
+    save_leave_request,
+    store_leave_days,
+)
 
 
 @login_required
@@ -47,11 +54,19 @@ def leave_request_create(request):
             employee_profile=employee,
         )
         if form.is_valid():
-            leave = form.save(commit=False)
-            leave.employee = employee
-            leave.save()
-            messages.success(request, "ส่งคำขอลาเรียบร้อยแล้ว")
-            return redirect("leave_app:leave_request_list")
+            try:
+                with transaction.atomic():
+                    leave = form.save(commit=False)
+                    leave.employee = employee
+                    save_leave_request(leave)
+                    store_leave_days(leave)
+                    notify_leave_submitted(leave)
+            except ValidationError as exc:
+                # ช่วงวันซ้อนกับคำขอเดิม (constraint ของฐานข้อมูล)
+                form.add_error(None, exc)
+            else:
+                messages.success(request, "ส่งคำขอลาเรียบร้อยแล้ว")
+                return redirect("leave_app:leave_request_list")
     else:
         form = LeaveRequestForm(employee_profile=employee)
 
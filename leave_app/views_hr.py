@@ -1,29 +1,53 @@
-import csv
 import json
 
-import openpyxl
-from zipfile import BadZipFile
+import zipfile
+from urllib.parse import urlencode
 
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import user_passes_test
-from django.contrib.sessions.models import Session
-from django.db.models import Q
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import transaction
 from django.forms import modelformset_factory
-from django.http import HttpResponse
+from django.http import FileResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.utils import timezone
-from django.utils.dateparse import parse_date
 
+from .employee_import import retry_import_job
+from .exports import (
+    LEAVE_EXPORT_SYNC_MAX_ROWS,
+    XLSX_CONTENT_TYPE,
+    export_params,
+    filter_leaves,
+    iter_leaves_csv,
+    spooled_leaves_xlsx,
+)
 from .forms import (
     EmployeeImportForm,
     HREmployeeCreateForm,
     HREmployeeUpdateForm,
     LeaveBalanceForm,
 )
-from .models import Department, EmployeeProfile, LeaveBalance, LeaveRequest, LeaveType
-from .services import create_default_leave_balances
+from .models import (
+    Department,
+    EmployeeImportJob,
+    EmployeeProfile,
+    LeaveBalance,
+    LeaveExportJob,
+    LeaveRequest,
+    LeaveType,
+)
+from .pagination import PAGE_SIZE_CHOICES, capped_count, get_page_size, keyset_paginate
+from .roles import ROLE_HR, has_role
+from .services import (
+    create_default_leave_balances,
+    provision_leave_balances,
+    revoke_user_sessions,
+    search_employee_directory,
+    search_employees,
+)
 
 User = get_user_model()
 
@@ -32,7 +56,7 @@ def is_hr(user):
     return (
         user.is_superuser
         or user.is_staff
-        or user.groups.filter(name="HR").exists()
+        or has_role(user, ROLE_HR)
     )
 
 
@@ -47,18 +71,29 @@ def hr_leave_dashboard(request):
     date_from = request.GET.get("date_from") or ""
     date_to = request.GET.get("date_to") or ""
 
+    page = keyset_paginate(qs, request.GET)
+    total_count, total_capped = capped_count(qs)
+
     context = {
-        "leaves": qs,
+        "leaves": page.items,
+        "page": page,
+        "next_query": page.next_query(request.GET),
+        "previous_query": page.previous_query(request.GET),
+        "page_size_choices": PAGE_SIZE_CHOICES,
+        "total_count": total_count,
+        "total_capped": total_capped,
         "statuses": LeaveRequest.STATUS_CHOICES,
         "departments": Department.objects.all(),
         "leave_types": LeaveType.objects.all(),
-        "employees": EmployeeProfile.objects.select_related("user").all(),
+        "filter_employee_obj": _get_selected_employee(employee_id),
         "filter_status": status,
         "filter_department": department_id,
         "filter_leave_type": leave_type_id,
         "filter_employee": employee_id,
         "filter_date_from": date_from,
         "filter_date_to": date_to,
+        "query_string": page.url_params(request.GET),
+        "export_jobs": LeaveExportJob.objects.select_related("created_by")[:5],
     }
     return render(request, "leave_app/hr/hr_leave_dashboard.html", context)
 
@@ -102,13 +137,7 @@ def hr_employee_list(request):
         "user", "department", "manager"
     )
 
-    if q:
-        employees = employees.filter(
-            Q(employee_code__icontains=q)
-            | Q(user__username__icontains=q)
-            | Q(user__first_name__icontains=q)
-            | Q(user__last_name__icontains=q)
-        )
+    employees = search_employee_directory(employees, q)
 
     if department_id:
         employees = employees.filter(department_id=department_id)
@@ -119,9 +148,14 @@ def hr_employee_list(request):
         employees = employees.filter(user__is_active=False)
 
     employees = employees.order_by("employee_code")
+    page_obj = Paginator(employees, get_page_size(request.GET)).get_page(request.GET.get("page"))
 
     context = {
-        "employees": employees,
+        "employees": page_obj.object_list,
+        "page_obj": page_obj,
+        "page_query": urlencode(
+            [(k, v) for k, v in request.GET.items() if k != "page" and v]
+        ),
         "departments": Department.objects.all(),
         "q": q,
         "filter_department": department_id,
@@ -139,13 +173,22 @@ def hr_employee_edit(request, pk):
     user_obj = profile.user
 
     if request.method == "POST":
+        was_active = user_obj.is_active
         form = HREmployeeUpdateForm(request.POST, instance=profile)
         if form.is_valid():
-            form.save()
-            messages.success(request, "อัปเดตข้อมูลพนักงานเรียบร้อยแล้ว")
-            if "stay" in request.POST:
-                return redirect("leave_app:hr_employee_edit", pk=pk)
-            return redirect("leave_app:hr_employee_list")
+            try:
+                # user + profile ใน transaction เดียว ถ้าสายงานวนตอนบันทึกจริง (อีกคนเพิ่งย้ายสายงาน) ไม่บันทึกอะไรเลย
+                with transaction.atomic():
+                    form.save()
+            except ValidationError as exc:
+                form.add_error("manager", exc)
+            else:
+                if was_active and not user_obj.is_active:
+                    revoke_user_sessions(user_obj)
+                messages.success(request, "อัปเดตข้อมูลพนักงานเรียบร้อยแล้ว")
+                if "stay" in request.POST:
+                    return redirect("leave_app:hr_employee_edit", pk=pk)
+                return redirect("leave_app:hr_employee_list")
     else:
         form = HREmployeeUpdateForm(instance=profile)
 
@@ -167,11 +210,7 @@ def hr_employee_toggle_active(request, pk):
         
         # ถ้าปิดการใช้งาน → เคลียร์ทุก session ของ user นี้
         if not user.is_active:
-            sessions = Session.objects.filter(expire_date__gte=timezone.now())
-            for s in sessions:
-                data = s.get_decoded()
-                if data.get("_auth_user_id") == str(user.id):
-                    s.delete()
+            revoke_user_sessions(user)
         
         status = "เปิดใช้งาน" if user.is_active else "ปิดการใช้งาน"
         messages.success(request, f"{status}บัญชีผู้ใช้เรียบร้อยแล้ว")
@@ -184,67 +223,97 @@ def hr_employee_import(request):
         form = EmployeeImportForm(request.POST, request.FILES)
         if form.is_valid():
             file = form.cleaned_data["file"]
-            try:
-                wb = openpyxl.load_workbook(file)
-            except BadZipFile:
+            if not zipfile.is_zipfile(file):
                 messages.error(
                     request,
                     "ไฟล์นี้ไม่ใช่ Excel .xlsx กรุณาส่งออกเป็น .xlsx แล้วลองใหม่อีกครั้ง",
                 )
                 return redirect("leave_app:hr_employee_import")
+            file.seek(0)
 
-            ws = wb.active
-            created_count = 0
-
-            for idx, row in enumerate(
-                ws.iter_rows(min_row=2, values_only=True), start=2
-            ):
-                username, password, employee_code, dept_code, manager_username = row[:5]
-                if not username:
-                    continue
-
-                user, user_created = User.objects.get_or_create(username=username)
-                if user_created:
-                    user.set_password(password or username)
-                    user.save()
-
-                department = None
-                if dept_code:
-                    department, _ = Department.objects.get_or_create(
-                        code=str(dept_code),
-                        defaults={"name": str(dept_code)},
-                    )
-
-                manager = None
-                if manager_username:
-                    manager = User.objects.filter(
-                        username=str(manager_username)
-                    ).first()
-
-                profile, prof_created = EmployeeProfile.objects.get_or_create(
-                    user=user,
-                    defaults={
-                        "employee_code": employee_code or f"EMP{user.id:04d}",
-                        "department": department,
-                        "manager": manager,
-                    },
-                )
-
-                create_default_leave_balances(profile)
-                created_count += 1
-
-            messages.success(request, f"นำเข้าพนักงานสำเร็จ {created_count} รายการ")
-            return redirect("leave_app:hr_employee_list")
+            # ไฟล์ใหญ่ประมวลผลใน request ไม่ทัน → สร้าง job ให้ worker `run_import_jobs` ทำเบื้องหลัง
+            job = EmployeeImportJob.objects.create(file=file, created_by=request.user)
+            messages.success(request, "อัปโหลดไฟล์แล้ว ระบบกำลังนำเข้าพนักงานเบื้องหลัง")
+            return redirect("leave_app:hr_employee_import_job", pk=job.pk)
     else:
         form = EmployeeImportForm()
 
-    return render(request, "leave_app/hr/hr_employee_import.html", {"form": form})
+    recent_jobs = EmployeeImportJob.objects.select_related("created_by")[:5]
+    return render(
+        request,
+        "leave_app/hr/hr_employee_import.html",
+        {"form": form, "recent_jobs": recent_jobs},
+    )
+
+
+def _import_job_payload(job: EmployeeImportJob) -> dict:
+    rate = job.rows_per_second
+    eta = job.eta_seconds
+    return {
+        "id": job.pk,
+        "status": job.status,
+        "status_display": job.get_status_display(),
+        "total_rows": job.total_rows,
+        "rows_done": job.rows_done,
+        "processed": job.processed,
+        "created": job.created_count,
+        "error_count": len(job.errors),
+        "errors": job.errors[:50],
+        "error_message": job.error_message,
+        "rows_per_second": round(rate, 1) if rate else None,
+        "eta_seconds": int(eta) if eta is not None else None,
+    }
+
+
+@user_passes_test(is_hr)
+def hr_employee_import_job(request, pk):
+    job = get_object_or_404(EmployeeImportJob, pk=pk)
+    return render(
+        request,
+        "leave_app/hr/hr_employee_import_job.html",
+        {"job": job, "payload": _import_job_payload(job)},
+    )
 
 
 @user_passes_test(is_hr)
-def hr_leave_balance_manage(request):
-    employees = EmployeeProfile.objects.select_related("user").all()
+def hr_employee_import_job_retry(request, pk):
+    job = get_object_or_404(EmployeeImportJob, pk=pk)
+    if request.method == "POST":
+        if retry_import_job(job):
+            messages.success(request, f"ส่งงานนำเข้ากลับเข้าคิวแล้ว จะทำต่อจากแถว {job.last_row + 1}")
+        else:
+            messages.error(request, "ลองใหม่ได้เฉพาะงานนำเข้าที่ล้มเหลวและไฟล์ยังไม่ถูกลบเท่านั้น")
+    return redirect("leave_app:hr_employee_import_job", pk=pk)
 
+
+@user_passes_test(is_hr)
+def hr_employee_import_job_status(request, pk):
+    job = get_object_or_404(EmployeeImportJob, pk=pk)
+    return JsonResponse(_import_job_payload(job))
+
+
+def _employee_label(emp: EmployeeProfile) -> str:
+    return f"{emp.employee_code} - {emp.user.get_full_name() or emp.user.username}"
+
+
+def _get_selected_employee(employee_id):
+    """พนักงานที่เลือกไว้ในช่อง autocomplete (สำหรับแสดงชื่อเดิมในฟอร์ม)"""
+    if not employee_id or not str(employee_id).isdigit():
+        return None
+    return EmployeeProfile.objects.select_related("user").filter(pk=employee_id).first()
+
+
+@user_passes_test(is_hr)
+def hr_employee_autocomplete(request):
+    results = [
+        {"id": emp.pk, "label": _employee_label(emp)}
+        for emp in search_employees(request.GET.get("q", ""))
+    ]
+    return JsonResponse({"results": results})
+
+
+@user_passes_test(is_hr)
+def hr_leave_balance_manage(request):
     year_param = request.GET.get("year")
     employee_id = request.GET.get("employee")
 
@@ -256,11 +325,16 @@ def hr_leave_balance_manage(request):
     selected_employee = None
     formset = None
 
+    # สร้างโควต้าที่ยังขาดของปีนี้ให้พนักงานทุกคนในครั้งเดียว (เช่น ตอนขึ้นปีใหม่)
+    if request.method == "POST" and "provision" in request.POST:
+        created = provision_leave_balances(year)
+        messages.success(request, f"สร้างโควต้าวันลาปี {year} เพิ่ม {created} รายการ")
+        url = reverse("leave_app:hr_leave_balance_manage")
+        return redirect(f"{url}?employee={employee_id or ''}&year={year}")
+
     if employee_id:
         selected_employee = get_object_or_404(EmployeeProfile, pk=employee_id)
 
-        create_default_leave_balances(selected_employee, year)
-
         qs = LeaveBalance.objects.filter(
             employee=selected_employee, year=year
         ).select_related("leave_type")
@@ -282,7 +356,6 @@ def hr_leave_balance_manage(request):
             formset = LeaveBalanceFormSet(queryset=qs)
 
     context = {
-        "employees": employees,
         "selected_employee": selected_employee,
         "year": year,
         "formset": formset,
@@ -292,80 +365,15 @@ def hr_leave_balance_manage(request):
 
 
 def _get_filtered_leaves(request):
-    qs = (
-        LeaveRequest.objects.select_related(
-            "employee__user",
-            "employee__department",
-            "leave_type",
-        )
-        .order_by("-created_at")
-    )
-
-    status = request.GET.get("status") or ""
-    department_id = request.GET.get("department") or ""
-    leave_type_id = request.GET.get("leave_type") or ""
-    employee_id = request.GET.get("employee") or ""
-    date_from = request.GET.get("date_from") or ""
-    date_to = request.GET.get("date_to") or ""
-
-    if status:
-        qs = qs.filter(status=status)
-    if department_id:
-        qs = qs.filter(employee__department_id=department_id)
-    if leave_type_id:
-        qs = qs.filter(leave_type_id=leave_type_id)
-    if employee_id:
-        qs = qs.filter(employee_id=employee_id)
-    if date_from:
-        qs = qs.filter(start_date__gte=parse_date(date_from))
-    if date_to:
-        qs = qs.filter(end_date__lte=parse_date(date_to))
-
-    return qs
+    return filter_leaves(request.GET)
 
 
 @user_passes_test(is_hr)
 def hr_export_leaves_csv(request):
     qs = _get_filtered_leaves(request)
-
-    response = HttpResponse(content_type="text/csv")
+    response = StreamingHttpResponse(iter_leaves_csv(qs), content_type="text/csv")
     filename = f"leave_requests_{timezone.now().date()}.csv"
     response["Content-Disposition"] = f'attachment; filename="{filename}"'
-
-    writer = csv.writer(response)
-    writer.writerow(
-        [
-            "Created at",
-            "Employee code",
-            "Employee name",
-            "Department",
-            "Leave type",
-            "Start date",
-            "End date",
-            "Half day",
-            "Status",
-            "Reason",
-        ]
-    )
-
-    for leave in qs:
-        emp = leave.employee
-        user = emp.user
-        writer.writerow(
-            [
-                leave.created_at.strftime("%Y-%m-%d %H:%M"),
-                emp.employee_code,
-                user.get_full_name() or user.username,
-                emp.department.name if emp.department else "",
-                leave.leave_type.name,
-                leave.start_date,
-                leave.end_date,
-                "Yes" if leave.half_day else "No",
-                leave.get_status_display(),
-                leave.reason.replace("\n", " "),
-            ]
-        )
-
     return response
 
 
@@ -373,46 +381,32 @@ def hr_export_leaves_csv(request):
 def hr_export_leaves_excel(request):
     qs = _get_filtered_leaves(request)
 
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Leave Requests"
-
-    headers = [
-        "Created at",
-        "Employee code",
-        "Employee name",
-        "Department",
-        "Leave type",
-        "Start date",
-        "End date",
-        "Half day",
-        "Status",
-        "Reason",
-    ]
-    ws.append(headers)
-
-    for leave in qs:
-        emp = leave.employee
-        user = emp.user
-        ws.append(
-            [
-                leave.created_at.strftime("%Y-%m-%d %H:%M"),
-                emp.employee_code,
-                user.get_full_name() or user.username,
-                emp.department.name if emp.department else "",
-                leave.leave_type.name,
-                leave.start_date.isoformat(),
-                leave.end_date.isoformat(),
-                "Yes" if leave.half_day else "No",
-                leave.get_status_display(),
-                leave.reason,
-            ]
+    if qs.count() > LEAVE_EXPORT_SYNC_MAX_ROWS:
+        job = LeaveExportJob.objects.create(
+            created_by=request.user,
+            params=export_params(request.GET),
+        )
+        messages.info(
+            request,
+            f"ข้อมูลมีจำนวนมาก ระบบกำลังสร้างไฟล์ Excel เบื้องหลัง (งาน #{job.pk}) "
+            "ดาวน์โหลดได้จากหน้านี้เมื่อเสร็จ",
         )
+        return redirect(f"{reverse('leave_app:hr_leave_dashboard')}?{request.GET.urlencode()}")
 
-    response = HttpResponse(
-        content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    return FileResponse(
+        spooled_leaves_xlsx(qs),
+        as_attachment=True,
+        filename=f"leave_requests_{timezone.now().date()}.xlsx",
+        content_type=XLSX_CONTENT_TYPE,
+    )
+
+
+@user_passes_test(is_hr)
+def hr_export_job_download(request, pk):
+    job = get_object_or_404(LeaveExportJob, pk=pk, status=LeaveExportJob.STATUS_DONE)
+    return FileResponse(
+        job.file.open("rb"),
+        as_attachment=True,
+        filename=job.filename,
+        content_type=XLSX_CONTENT_TYPE,
     )
-    filename = f"leave_requests_{timezone.now().date()}.xlsx"
-    response["Content-Disposition"] = f'attachment; filename="{filename}"'
-    wb.save(response)
-    return response
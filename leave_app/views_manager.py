@@ -1,40 +1,151 @@
 from django.contrib import messages
 from django.contrib.auth.decorators import user_passes_test
 from django.core.exceptions import ValidationError
-from django.http import HttpResponseForbidden
+from django.db.models import Count, Q
+from django.http import HttpResponseForbidden, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.urls import reverse
 
-from .models import EmployeeProfile, LeaveRequest
-from .services import approve_leave_request, reject_leave_request
+from .hierarchy import manages, subordinate_leaves, subordinate_profiles
+from .models import LeaveRequest
+from .pagination import keyset_paginate
+from .roles import ROLE_MANAGER, has_role
+from .services import (
+    approve_leave_request,
+    bulk_decide_leave_requests,
+    reject_leave_request,
+    search_employees,
+)
 
 
 def is_manager(user):
-    return user.is_superuser or user.groups.filter(name="MANAGER").exists()
+    return user.is_superuser or has_role(user, ROLE_MANAGER)
 
 
 @user_passes_test(is_manager)
 def manager_leave_list(request):
-    subordinates = EmployeeProfile.objects.filter(manager=request.user)
-
-    pending_leaves = LeaveRequest.objects.filter(
-        employee__in=subordinates,
-        status=LeaveRequest.STATUS_PENDING,
-    ).select_related("employee", "leave_type")
-
-    history_leaves = (
-        LeaveRequest.objects.filter(employee__in=subordinates)
-        .exclude(status=LeaveRequest.STATUS_PENDING)
-        .select_related("employee", "leave_type", "approver")
-        .order_by("-updated_at")
+    # ?scope=all → ลูกน้องทั้งสายงาน (ทุกระดับ ผ่าน OrgClosure) ไม่ใช่แค่ลูกน้องโดยตรง
+    scope = "all" if request.GET.get("scope", request.POST.get("scope")) == "all" else "direct"
+    max_depth = None if scope == "all" else 1
+    subordinates = subordinate_profiles(request.user, max_depth)
+
+    # อนุมัติ / ปฏิเสธหลายใบพร้อมกัน
+    if request.method == "POST":
+        action = request.POST.get("action")
+        comment = request.POST.get("comment", "")
+        leave_ids = [pk for pk in request.POST.getlist("leave_ids") if pk.isdigit()]
+
+        leaves = LeaveRequest.objects.filter(pk__in=leave_ids)
+        if not request.user.is_superuser:
+            # อนุมัติข้ามระดับได้ ถ้าเป็นลูกน้องในสายงาน
+            leaves = subordinate_leaves(request.user, max_depth=None).filter(pk__in=leave_ids)
+
+        if not leave_ids:
+            messages.error(request, "กรุณาเลือกคำขออย่างน้อย 1 รายการ")
+        elif action not in ("approve", "reject"):
+            messages.error(request, "คำสั่งไม่ถูกต้อง")
+        else:
+            allowed_ids = set(leaves.values_list("pk", flat=True))
+            # id ที่เลือกมาแต่ไม่อยู่ในสายงาน (หรือไม่มีแล้ว) แจ้งเป็น error รายใบ ไม่ตัดทิ้งเงียบ ๆ
+            for pk in dict.fromkeys(int(pk) for pk in leave_ids):
+                if pk not in allowed_ids:
+                    messages.error(request, f"คำขอ #{pk}: ไม่พบคำขอ หรือไม่ได้อยู่ในสายงานของคุณ")
+
+            results = bulk_decide_leave_requests(
+                [int(pk) for pk in dict.fromkeys(leave_ids) if int(pk) in allowed_ids],
+                approver=request.user,
+                action=action,
+                comment=comment,
+            )
+            for result in results:
+                leave = result["leave"]
+                user = leave.employee.user
+                label = (
+                    f"{user.get_full_name() or user.username} "
+                    f"({leave.start_date} - {leave.end_date})"
+                )
+                if result["ok"]:
+                    messages.success(request, f"{label}: {result['message']}")
+                else:
+                    messages.error(request, f"{label}: {result['message']}")
+
+        url = reverse("leave_app:manager_leave_list")
+        return redirect(f"{url}?scope=all" if scope == "all" else url)
+
+    team_leaves = subordinate_leaves(request.user, max_depth)
+
+    # กรองเฉพาะลูกน้องคนเดียว (?employee=<id>) เลือกผ่านช่อง autocomplete ไม่ render ลูกน้องทั้งสายงานเป็น <select>
+    selected_employee = request.GET.get("employee", "")
+    selected_profile = None
+    if selected_employee.isdigit():
+        team_leaves = team_leaves.filter(employee_id=selected_employee)
+        selected_profile = subordinates.select_related("user").filter(pk=selected_employee).first()
+    else:
+        selected_employee = ""
+
+    # จำนวนคำขอแต่ละสถานะ (badge) ใน query เดียว
+    status_counts = team_leaves.aggregate(
+        **{
+            status.lower(): Count("id", filter=Q(status=status))
+            for status, _ in LeaveRequest.STATUS_CHOICES
+        }
+    )
+
+    # รออนุมัติ: keyset แยก cursor ของตัวเอง (?pending_after= / ?pending_before=)
+    pending_page = keyset_paginate(
+        team_leaves.filter(status=LeaveRequest.STATUS_PENDING)
+        .select_related("employee__user", "leave_type"),
+        request.GET,
+        prefix="pending_",
+    )
+
+    # ประวัติ: keyset บน (updated_at, id) ไม่ดึงทั้งหมดในครั้งเดียว (?status= กรองตามสถานะ)
+    history_status = request.GET.get("status", "")
+    history_leaves = team_leaves.exclude(status=LeaveRequest.STATUS_PENDING)
+    if history_status in dict(LeaveRequest.STATUS_CHOICES) and history_status != LeaveRequest.STATUS_PENDING:
+        history_leaves = history_leaves.filter(status=history_status)
+    else:
+        history_status = ""
+    page = keyset_paginate(
+        history_leaves.select_related("employee__user", "leave_type", "approver"),
+        request.GET,
+        field="updated_at",
     )
 
     context = {
-        "pending_leaves": pending_leaves,
-        "history_leaves": history_leaves,
+        "pending_leaves": pending_page.items,
+        "pending_page": pending_page,
+        "pending_next_query": pending_page.next_query(request.GET),
+        "pending_previous_query": pending_page.previous_query(request.GET),
+        "history_leaves": page.items,
+        "page": page,
+        "next_query": page.next_query(request.GET),
+        "previous_query": page.previous_query(request.GET),
+        "status_counts": status_counts,
+        "history_status": history_status,
+        "selected_employee": selected_employee,
+        "selected_profile": selected_profile,
+        "scope": scope,
     }
     return render(request, "leave_app/manager/manager_leave_list.html", context)
 
 
+@user_passes_test(is_manager)
+def manager_subordinate_autocomplete(request):
+    # ค้นเฉพาะลูกน้องตาม scope เดียวกับหน้ารายการ
+    max_depth = None if request.GET.get("scope") == "all" else 1
+    results = [
+        {
+            "id": emp.pk,
+            "label": f"{emp.employee_code} - {emp.user.get_full_name() or emp.user.username}",
+        }
+        for emp in search_employees(
+            request.GET.get("q", ""), queryset=subordinate_profiles(request.user, max_depth)
+        )
+    ]
+    return JsonResponse({"results": results})
+
+
 @user_passes_test(is_manager)
 def manager_leave_detail(request, pk):
     leave_req = get_object_or_404(
@@ -42,7 +153,7 @@ def manager_leave_detail(request, pk):
         pk=pk,
     )
 
-    if leave_req.employee.manager != request.user and not request.user.is_superuser:
+    if not request.user.is_superuser and not manages(request.user, leave_req.employee):
         return HttpResponseForbidden("คุณไม่มีสิทธิ์ดูคำขอนี้")
 
     if request.method == "POST":